@@ -37,8 +37,9 @@ setup(name='tilequeue',
           'edtf',
           'hiredis',
           'Jinja2',
-          'mapbox-vector-tile',
+          'mapbox-vector-tile==1.2.1',
           'ModestMaps',
+          'numpy',
           'protobuf',
           'psycopg2',
           'pyproj',
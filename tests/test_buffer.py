@@ -235,6 +235,156 @@ class ClipBoundsTest(unittest.TestCase):
         self.assertEquals(result, exp_bounds)
 
 
+class ClipCacheTest(unittest.TestCase):
+
+    def _call_fut(self, format, buffer_cfg, clip_cache):
+        from shapely.geometry import LineString
+        from tilequeue.transform import transform_feature_layers_shape
+        shape = LineString([(-1, 0.5), (3, 0.5)])
+        feature_layers = [dict(
+            name='foo',
+            features=[(shape, {}, 1)],
+            layer_datum=dict(is_clipped=True, clip_factor=1.0),
+        )]
+        result = transform_feature_layers_shape(
+            feature_layers, format, 4096, (0, 0, 2, 2), 1, buffer_cfg,
+            clip_cache)
+        return result[0]['features']
+
+    def _format(self, ext):
+        return type(ext, (), dict(
+            extension=ext, supports_shapely_geometry=True))
+
+    def test_shared_between_formats(self):
+        clip_cache = {}
+        features_a = self._call_fut(self._format('a'), {}, clip_cache)
+        features_b = self._call_fut(self._format('b'), {}, clip_cache)
+        self.assertEquals(1, len(clip_cache))
+        self.assertIs(features_a[0][0], features_b[0][0])
+        self.assertEquals((0, 0.5, 2, 0.5), features_a[0][0].bounds)
+
+    def test_buffered_bounds_differ(self):
+        clip_cache = {}
+        buffer_cfg = dict(b=dict(geometry=dict(line=1)))
+        features_a = self._call_fut(self._format('a'), buffer_cfg, clip_cache)
+        features_b = self._call_fut(self._format('b'), buffer_cfg, clip_cache)
+        self.assertEquals(
+            2, sum(len(by_bounds) for by_bounds in clip_cache.values()))
+        self.assertEquals((0, 0.5, 2, 0.5), features_a[0][0].bounds)
+        self.assertEquals((-1, 0.5, 3, 0.5), features_b[0][0].bounds)
+
+    def test_reclip_from_larger_bounds(self):
+        clip_cache = {}
+        buffer_cfg = dict(b=dict(geometry=dict(line=1)))
+        features_b = self._call_fut(self._format('b'), buffer_cfg, clip_cache)
+        features_a = self._call_fut(self._format('a'), buffer_cfg, clip_cache)
+        self.assertEquals((-1, 0.5, 3, 0.5), features_b[0][0].bounds)
+        self.assertEquals((0, 0.5, 2, 0.5), features_a[0][0].bounds)
+
+    def test_reclip_within_smaller_bounds(self):
+        from shapely.geometry import LineString
+        from tilequeue.transform import transform_feature_layers_shape
+        shape = LineString([(0.5, 0.5), (1.5, 0.5)])
+        feature_layers = [dict(
+            name='foo',
+            features=[(shape, {}, 1)],
+            layer_datum=dict(is_clipped=True, clip_factor=1.0),
+        )]
+        buffer_cfg = dict(b=dict(geometry=dict(line=1)))
+        clip_cache = {}
+        features = []
+        for ext in ('b', 'a'):
+            result = transform_feature_layers_shape(
+                feature_layers, self._format(ext), 4096, (0, 0, 2, 2), 1,
+                buffer_cfg, clip_cache)
+            features.append(result[0]['features'][0][0])
+        # the shape clipped to the larger bounds is kept for the smaller
+        self.assertIs(features[0], features[1])
+
+    def test_reclip_multipolygon_drops_padding_parts(self):
+        from shapely.geometry import box
+        from shapely.geometry import MultiPolygon
+        from tilequeue.transform import _clip_shape
+        from tilequeue.transform import _clip_shape_reusing
+        # the second part is outside the smaller buffered bounds, but
+        # within their clip factor expansion.
+        shape = MultiPolygon([box(0.5, 0.5, 1.5, 1.5),
+                              box(2.2, 0.5, 2.4, 0.6)])
+        larger_bounds = (-1, -1, 3, 3)
+        smaller_bounds = (0, 0, 2, 2)
+        clipped_by_bounds = {
+            larger_bounds: {0: _clip_shape(shape, larger_bounds, True, 2.0)},
+        }
+        reused = _clip_shape_reusing(
+            shape, 0, smaller_bounds, True, 2.0, clipped_by_bounds)
+        expected = _clip_shape(shape, smaller_bounds, True, 2.0)
+        self.assertEquals(1, len(expected.geoms))
+        self.assertTrue(expected.equals(reused))
+
+    def test_reclip_concave_polygon_keeps_split_parts(self):
+        from shapely.geometry import Polygon
+        from tilequeue.transform import _clip_shape
+        from tilequeue.transform import _clip_shape_reusing
+        # a u shape, whose arms are joined outside the clip factor
+        # expansion of the larger bounds, so clipping to them splits it in
+        # two. the right arm is outside the smaller buffered bounds, but
+        # within their clip factor expansion.
+        shape = Polygon([(0.5, 0.5), (1.5, 0.5), (1.5, 5.5), (2.2, 5.5),
+                         (2.2, 0.5), (2.4, 0.5), (2.4, 6), (0.5, 6)])
+        larger_bounds = (-1, -1, 3, 3)
+        smaller_bounds = (0, 0, 2, 2)
+        larger_shape = _clip_shape(shape, larger_bounds, True, 2.0)
+        self.assertEquals('MultiPolygon', larger_shape.type)
+        clipped_by_bounds = {larger_bounds: {0: larger_shape}}
+        reused = _clip_shape_reusing(
+            shape, 0, smaller_bounds, True, 2.0, clipped_by_bounds)
+        expected = _clip_shape(shape, smaller_bounds, True, 2.0)
+        self.assertEquals(2, len(expected.geoms))
+        self.assertTrue(expected.equals(reused))
+
+
+class TransformArraysTest(unittest.TestCase):
+
+    def _assert_same(self, point_fn, arrays_fn, shape):
+        from tilequeue.transform import apply_to_all_coord_arrays
+        from tilequeue.transform import apply_to_all_coords
+        expected = apply_to_all_coords(point_fn)(shape)
+        result = apply_to_all_coord_arrays(arrays_fn)(shape)
+        self.assertEquals(expected.type, result.type)
+        self.assertEquals(expected.wkb, result.wkb)
+
+    def _shapes(self):
+        from shapely.geometry import MultiPolygon
+        from shapely.geometry import Point
+        from shapely.geometry import Polygon
+        hole = [(2e6, 2e6), (2e6, 3e6), (3e6, 3e6), (3e6, 2e6)]
+        poly = Polygon([(1e6, 1e6), (1e6, 4e6), (4e6, 4e6), (4e6, 1e6)],
+                       [hole])
+        return [
+            Point(1e6, -2e6),
+            poly,
+            MultiPolygon([poly, Polygon([(-1, -1), (-1, 1), (1, 1)])]),
+        ]
+
+    def test_lnglat(self):
+        from tilequeue.transform import mercator_point_to_lnglat
+        from tilequeue.transform import mercator_to_lnglat_arrays
+        for shape in self._shapes():
+            self._assert_same(
+                mercator_point_to_lnglat, mercator_to_lnglat_arrays, shape)
+
+    def test_rescale(self):
+        from tilequeue.transform import rescale_arrays
+        from tilequeue.transform import rescale_point
+        # the half pixel offsets check rounding matches round()
+        bounds = (-0.5, -0.5, 5e6 - 0.5, 5e6 - 0.5)
+        for scale in (4096, 5e6):
+            for shape in self._shapes():
+                self._assert_same(
+                    rescale_point(bounds, scale),
+                    rescale_arrays(bounds, scale), shape)
+
+
 class MetersPerPixelDimTest(unittest.TestCase):
 
     def _call_fut(self, zoom):
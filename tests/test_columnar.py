@@ -0,0 +1,48 @@
+'''
+Tests for `tilequeue.columnar`.
+'''
+
+import unittest
+
+
+class TestColumnarFeatures(unittest.TestCase):
+
+    def test_from_dict_rows(self):
+        from tilequeue.columnar import ColumnarFeatures
+        rows = [
+            dict(__id__=1, __geometry__=buffer('wkb-1'), foo='bar'),
+            dict(__id__=2, __geometry__='wkb-22', baz=3, foo=None),
+            dict(__id__=3, __geometry__='wkb-333'),
+        ]
+        features = ColumnarFeatures.from_dict_rows(rows)
+        self.assertEqual(3, len(features))
+        self.assertEqual([1, 2, 3], features.ids)
+        self.assertEqual('wkb-1wkb-22wkb-333', features.wkb)
+        self.assertEqual('wkb-22', features.geometry(1))
+        self.assertEqual(
+            dict(foo=['bar', None, None], baz=[None, 3, None]),
+            features.properties)
+
+        self.assertEqual([
+            dict(__id__=1, __geometry__='wkb-1', foo='bar'),
+            dict(__id__=2, __geometry__='wkb-22', baz=3),
+            dict(__id__=3, __geometry__='wkb-333'),
+        ], list(features))
+
+    def test_from_tuple_rows(self):
+        from tilequeue.columnar import ColumnarFeatures
+        columns = ['__id__', 'foo', '__geometry__']
+        rows = [(1, 'bar', 'wkb-1'), (2, None, 'wkb-22')]
+        features = ColumnarFeatures.from_tuple_rows(columns, rows)
+        self.assertEqual([
+            ('wkb-1', 1, [('foo', 'bar')]),
+            ('wkb-22', 2, []),
+        ], list(features.iter_feature_rows()))
+
+    def test_pickle(self):
+        from tilequeue.columnar import ColumnarFeatures
+        import cPickle as pickle
+        rows = [dict(__id__=1, __geometry__='wkb-1', foo='bar')]
+        features = ColumnarFeatures.from_dict_rows(rows)
+        result = pickle.loads(pickle.dumps(features, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(list(features), list(result))
@@ -0,0 +1,70 @@
+import unittest
+
+
+class GeoJSONEncodeTest(unittest.TestCase):
+
+    def _encode_multiple_layers(self, features_by_layer, zoom):
+        from cStringIO import StringIO
+        from tilequeue.format.geojson import encode_multiple_layers
+        import json
+        fp = StringIO()
+        encode_multiple_layers(fp, features_by_layer, zoom)
+        return json.loads(fp.getvalue())
+
+    def test_multiple_layers(self):
+        from shapely.geometry import LineString
+        from shapely.geometry import Point
+        result = self._encode_multiple_layers(dict(
+            pois=[(Point(1.123456789, 2.987654321), dict(kind='cafe'), 1)],
+            roads=[(LineString([(0, 0), (1.00000001, 1)]), {}, None),
+                   (LineString([(1, 1), (2, 2)]), {}, None)],
+            water=[],
+        ), 10)
+
+        self.assertEqual(set(['pois', 'roads', 'water']), set(result))
+        self.assertEqual(
+            dict(type='FeatureCollection', features=[]), result['water'])
+        self.assertEqual(dict(
+            type='Feature', id=1, properties=dict(kind='cafe'),
+            geometry=dict(type='Point', coordinates=[1.12346, 2.98765]),
+        ), result['pois']['features'][0])
+        self.assertEqual(
+            [[[0, 0], [1, 1]], [[1, 1], [2, 2]]],
+            [f['geometry']['coordinates']
+             for f in result['roads']['features']])
+
+    def test_rounds_halves_away_from_zero(self):
+        from shapely.geometry import LineString
+        from shapely.geometry import Point
+        from tilequeue.format.geojson import trim_precision
+        _, geometry = trim_precision(Point(-122.125, 0.375), 2)
+        self.assertEqual([-122.13, 0.38], geometry['coordinates'])
+        line = LineString([(-122.125, 0.375), (1, 1)])
+        _, geometry = trim_precision(line, 2)
+        self.assertEqual(
+            [round(-122.125, 2), round(0.375, 2)], geometry['coordinates'][0])
+
+    def test_invalid_after_rounding(self):
+        from shapely.geometry import Polygon
+        # a sliver which collapses to a line when rounded
+        polygon = Polygon([(0, 0), (1, 0.0000001), (1, 0)])
+        result = self._encode_multiple_layers(
+            dict(landuse=[(polygon, {}, None)]), 10)
+        geometry = result['landuse']['features'][0]['geometry']
+        self.assertEqual('Polygon', geometry['type'])
+        self.assertEqual(
+            [[list(c) for c in polygon.exterior.coords]],
+            geometry['coordinates'])
+
+    def test_empty_shapes(self):
+        from shapely.geometry import LineString
+        from shapely.geometry import Polygon
+        from tilequeue.format.geojson import JsonFeatureCreator
+        from tilequeue.format.geojson import trim_precision
+        create_json_feature = JsonFeatureCreator(5)
+        for shape in (LineString(), Polygon()):
+            rounded_shape, geometry = trim_precision(shape, 5)
+            self.assertIsNone(rounded_shape)
+            self.assertEqual(shape.__geo_interface__, geometry)
+            feature = create_json_feature((shape, {}, None))
+            self.assertEqual(shape.__geo_interface__, feature['geometry'])
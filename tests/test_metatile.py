@@ -110,6 +110,46 @@ class TestMetatile(unittest.TestCase):
         self.assertTrue(metatiles_are_equal(
             metatile_1[0]['tile'], metatile_2[0]['tile']))
 
+    def test_metatile_deterministic(self):
+        tiles = [
+            dict(tile="{\"json\":true}", coord=Coordinate(0, 0, 0),
+                 format=json_format, layer='all'),
+            dict(tile="{\"topojson\":true}", coord=Coordinate(0, 0, 0),
+                 format=topojson_format, layer='all'),
+        ]
+
+        metatile_1 = make_metatiles(1, tiles, deterministic=True)
+        metatile_2 = make_metatiles(1, tiles[::-1], deterministic=True)
+        self.assertEqual(metatile_1[0]['tile'], metatile_2[0]['tile'])
+
+        buf = StringIO.StringIO(metatile_1[0]['tile'])
+        with zipfile.ZipFile(buf, mode='r') as z:
+            self.assertEqual(['0/0/0.json', '0/0/0.topojson'], z.namelist())
+            self.assertEqual((1980, 1, 1, 0, 0, 0),
+                             z.getinfo('0/0/0.json').date_time)
+
+    def test_metatile_contents_hash(self):
+        from tilequeue.metatile import metatile_contents_hash
+
+        json = "{\"json\":true}"
+        tiles = [dict(tile=json, coord=Coordinate(0, 0, 0),
+                      format=json_format, layer='all')]
+        other_tiles = [dict(tile="{}", coord=Coordinate(0, 0, 0),
+                            format=json_format, layer='all')]
+
+        # timestamps are ignored, as in metatiles_are_equal
+        metatile_1 = make_metatiles(1, tiles, (2000, 1, 1, 0, 0, 0))
+        metatile_2 = make_metatiles(1, tiles, (2017, 6, 1, 12, 0, 0))
+        metatile_3 = make_metatiles(1, other_tiles, (2000, 1, 1, 0, 0, 0))
+
+        hash_1 = metatile_contents_hash(metatile_1[0]['tile'])
+        self.assertIsNotNone(hash_1)
+        self.assertEqual(
+            hash_1, metatile_contents_hash(metatile_2[0]['tile']))
+        self.assertNotEqual(
+            hash_1, metatile_contents_hash(metatile_3[0]['tile']))
+        self.assertIsNone(metatile_contents_hash('not a zip'))
+
     def test_metatile_common_parent(self):
         from tilequeue.metatile import _common_parent
 
@@ -156,3 +196,62 @@ class TestMetatile(unittest.TestCase):
         self.assertEqual(
             tile(1, 1, 1),
             _common_parent(tile(5, 16, 16), tile(4, 15, 15)))
+
+
+class TestIndexedMetatile(unittest.TestCase):
+
+    def _tiles(self):
+        return [
+            dict(tile='{"json":true}', coord=Coordinate(123, 456, 17),
+                 format=json_format, layer='all'),
+            dict(tile='{"json":false}' * 10, coord=Coordinate(123, 457, 17),
+                 format=json_format, layer='all'),
+            dict(tile='{"topojson":true}', coord=Coordinate(123, 456, 17),
+                 format=topojson_format, layer='all'),
+        ]
+
+    def test_extract(self):
+        from tilequeue.format import indexed_metatile_format
+        from tilequeue.metatile import extract_indexed_metatile
+
+        for compress in (False, True):
+            metatiles = make_metatiles(
+                1, self._tiles(), metatile_format=indexed_metatile_format,
+                compress=compress)
+            self.assertEqual(1, len(metatiles))
+            meta = metatiles[0]
+            self.assertEqual(Coordinate(61, 228, 16), meta['coord'])
+            self.assertEqual(indexed_metatile_format, meta['format'])
+
+            buf = StringIO.StringIO(meta['tile'])
+            for tile in self._tiles():
+                offset = Coordinate(
+                    zoom=1, column=tile['coord'].column - 456,
+                    row=tile['coord'].row - 122)
+                self.assertEqual(tile['tile'], extract_indexed_metatile(
+                    buf, tile['format'], offset))
+            self.assertIsNone(extract_indexed_metatile(
+                buf, topojson_format, Coordinate(zoom=1, column=1, row=1)))
+            self.assertIsNone(extract_indexed_metatile(buf, json_format))
+
+    def test_range_reads(self):
+        from tilequeue.format import indexed_metatile_format
+        from tilequeue.metatile import INDEXED_METATILE_HEADER
+        from tilequeue.metatile import find_indexed_metatile_member
+        from tilequeue.metatile import read_indexed_metatile_header
+
+        tiles = self._tiles()
+        data = make_metatiles(
+            1, tiles, metatile_format=indexed_metatile_format)[0]['tile']
+        # the same tiles in another order make the same metatile
+        reversed_data = make_metatiles(
+            1, tiles[::-1], metatile_format=indexed_metatile_format)[0]['tile']
+        self.assertEqual(data, reversed_data)
+
+        header_size = INDEXED_METATILE_HEADER.size
+        index_size = read_indexed_metatile_header(data[:header_size])
+        index = data[header_size:header_size + index_size]
+        offset, length, compression = find_indexed_metatile_member(
+            index, topojson_format, Coordinate(zoom=1, column=0, row=1))
+        self.assertEqual('{"topojson":true}', data[offset:offset + length])
+        self.assertEqual(0, compression)
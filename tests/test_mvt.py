@@ -0,0 +1,115 @@
+import unittest
+
+
+class MvtEncodeTest(unittest.TestCase):
+
+    bounds = (0.0, 0.0, 1000.0, 1000.0)
+
+    def _feature_layers(self):
+        from shapely.geometry import LineString
+        from shapely.geometry import MultiLineString
+        from shapely.geometry import MultiPoint
+        from shapely.geometry import MultiPolygon
+        from shapely.geometry import Point
+        from shapely.geometry import Polygon
+        square = Polygon([(0, 0), (0, 100), (100, 100), (100, 0)],
+                         [[(10, 10), (20, 10), (20, 20), (10, 20)]])
+        shapes = [
+            Point(1.5, 2.5),
+            MultiPoint([(1, 1), (1, 1), (2, 2)]),
+            LineString([(0, 0), (0, 0.01), (10, 10.5), (-3, -2.5)]),
+            MultiLineString([[(0, 0), (1, 1)], [(1, 1), (400, 4)]]),
+            square,
+            MultiPolygon([square, Polygon([(200, 0), (300, 0), (300, 50)])]),
+            # invalid once quantised, and needs making valid
+            MultiPolygon([Polygon([(0, 0), (100, 0), (100, 100)]),
+                          Polygon([(100.1, 0), (200, 0), (200, 100)])]),
+            # collapses when quantised
+            Polygon([(0, 0), (0.1, 0), (0.1, 0.1)]),
+        ]
+        features = []
+        for i, shape in enumerate(shapes):
+            props = dict(kind='thing', flag=bool(i % 2), one=1, half=0.5,
+                         name=u'caf\xe9', skipped=[1])
+            features.append((shape, props, i))
+        return [dict(name='things', features=features),
+                dict(name='more', features=features[:3])]
+
+    def _mvt_layers(self, feature_layers):
+        layers = []
+        for feature_layer in feature_layers:
+            features = [dict(geometry=shape, properties=props, id=fid)
+                        for shape, props, fid in feature_layer['features']]
+            layers.append(dict(name=feature_layer['name'], features=features))
+        return layers
+
+    def _lib_encode(self, feature_layers):
+        from mapbox_vector_tile import encode
+        from mapbox_vector_tile.encoder import on_invalid_geometry_make_valid
+        return encode(self._mvt_layers(feature_layers),
+                      quantize_bounds=self.bounds,
+                      on_invalid_geometry=on_invalid_geometry_make_valid,
+                      round_fn=round)
+
+    def _encode(self, feature_layers, attr_cache=None):
+        from cStringIO import StringIO
+        from tilequeue.format.mvt import encode_features
+        fp = StringIO()
+        encode_features(fp, feature_layers, self.bounds, attr_cache)
+        return fp.getvalue()
+
+    def test_matches_mapbox_vector_tile(self):
+        feature_layers = self._feature_layers()
+        self.assertEqual(
+            self._lib_encode(feature_layers), self._encode(feature_layers))
+
+    def test_encode_mvt_layers(self):
+        from cStringIO import StringIO
+        from tilequeue.format.mvt import encode
+        feature_layers = self._feature_layers()
+        fp = StringIO()
+        encode(fp, self._mvt_layers(feature_layers), self.bounds)
+        self.assertEqual(self._encode(feature_layers), fp.getvalue())
+
+    def test_shared_attr_cache(self):
+        feature_layers = self._feature_layers()
+        attr_cache = {}
+        first = self._encode(feature_layers, attr_cache)
+        self.assertTrue(attr_cache)
+        second = self._encode(feature_layers, attr_cache)
+        self.assertEqual(first, second)
+
+
+class VectorTileInternalsTest(unittest.TestCase):
+    """
+    TileVectorTile depends on these internals of mapbox_vector_tile's
+    VectorTile, which aren't part of its public API. If this fails, the
+    library has changed under the pinned version, and TileVectorTile needs
+    updating to match it.
+    """
+
+    def test_vector_tile_internals(self):
+        from mapbox_vector_tile.encoder import on_invalid_geometry_make_valid
+        from mapbox_vector_tile.encoder import VectorTile
+        tile = VectorTile(4096, on_invalid_geometry_make_valid,
+                          round_fn=round)
+        self.assertEqual(4096, tile.extents)
+        self.assertTrue(hasattr(tile.tile, 'layers'))
+
+        tile.addFeatures([], 'layer')
+        self.assertEqual(0, tile.key_idx)
+        self.assertEqual(0, tile.val_idx)
+        self.assertEqual({}, tile.seen_keys_idx)
+        self.assertEqual({}, tile.seen_values_idx)
+        self.assertEqual({}, tile.seen_values_bool_idx)
+
+        from shapely.geometry import LineString
+        from shapely.geometry import Polygon
+        square = Polygon([(0, 0), (0, 10), (10, 10), (10, 0)])
+        oriented = tile.enforce_winding_order(square, False)
+        self.assertEqual('Polygon', oriented.type)
+        self.assertEqual(3, tile._get_feature_type(oriented))
+        self.assertEqual(2, tile._get_feature_type(
+            LineString([(0, 0), (1, 1)])))
+        self.assertTrue(tile._can_handle_attr('kind', 'thing'))
+        self.assertFalse(tile._can_handle_attr('kind', [1]))
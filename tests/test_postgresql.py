@@ -0,0 +1,110 @@
+'''
+Tests for `tilequeue.postgresql`.
+'''
+
+import unittest
+
+
+class FakeConnection(object):
+
+    def __init__(self, dbname):
+        self.dbname = dbname
+        self.closed = 0
+
+    def get_transaction_status(self):
+        from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+        return TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class TestDBAffinityConnectionsPool(unittest.TestCase):
+
+    def _make_pool(self, dbnames=('a',), max_conns_per_db=4, **kwargs):
+        from tilequeue.postgresql import DBAffinityConnectionsPool
+        pool = DBAffinityConnectionsPool(
+            dbnames, {}, max_conns_per_db, **kwargs)
+        self.made = []
+
+        def _make_conn(conn_info):
+            conn = FakeConnection(conn_info['dbname'])
+            self.made.append(conn)
+            return conn
+        pool._make_conn = _make_conn
+        return pool
+
+    def test_reuses_connections(self):
+        pool = self._make_pool()
+        conns = pool.get_conns(3)
+        pool.put_conns(conns)
+        conns_again = pool.get_conns(3)
+        self.assertEqual(set(conns), set(conns_again))
+        self.assertEqual(3, len(self.made))
+
+        stats = pool.get_stats()
+        self.assertEqual(3, stats['hits'])
+        self.assertEqual(3, stats['misses'])
+        self.assertEqual(3, stats['in_use'])
+
+    def test_db_affinity(self):
+        pool = self._make_pool(dbnames=('a', 'b'))
+        conns_a = pool.get_conns(2)
+        conns_b = pool.get_conns(2)
+        self.assertEqual(set(['a']), set(c.dbname for c in conns_a))
+        self.assertEqual(set(['b']), set(c.dbname for c in conns_b))
+
+    def test_closed_connections_replaced(self):
+        pool = self._make_pool()
+        conns = pool.get_conns(2)
+        # execute_query closes connections which raised errors
+        conns[0].close()
+        pool.put_conns(conns)
+
+        conns_again = pool.get_conns(2)
+        self.assertNotIn(conns[0], conns_again)
+        self.assertIn(conns[1], conns_again)
+        self.assertEqual(1, pool.get_stats()['discarded'])
+
+    def test_max_idle_eviction(self):
+        pool = self._make_pool(max_idle_seconds=0)
+        conns = pool.get_conns(2)
+        pool.put_conns(conns)
+
+        import time
+        time.sleep(0.01)
+        conns_again = pool.get_conns(2)
+        self.assertFalse(set(conns) & set(conns_again))
+        self.assertTrue(all(c.closed for c in conns))
+
+    def test_max_lifetime_eviction(self):
+        pool = self._make_pool(max_lifetime_seconds=0)
+        conns = pool.get_conns(1)
+
+        import time
+        time.sleep(0.01)
+        pool.put_conns(conns)
+        self.assertTrue(conns[0].closed)
+        self.assertEqual(0, pool.get_stats()['idle'])
+
+    def test_bounded_wait_timeout(self):
+        pool = self._make_pool(max_conns_per_db=2, wait_timeout_seconds=0.01)
+        pool.get_conns(2)
+        with self.assertRaises(RuntimeError):
+            pool.get_conns(1)
+        self.assertTrue(pool.get_stats()['wait_seconds'] > 0)
+
+    def test_waits_for_returned_connections(self):
+        import threading
+        pool = self._make_pool(max_conns_per_db=2)
+        conns = pool.get_conns(2)
+        result = []
+
+        def _get():
+            result.extend(pool.get_conns(2))
+        t = threading.Thread(target=_get)
+        t.start()
+        pool.put_conns(conns)
+        t.join(5)
+        self.assertEqual(set(conns), set(result))
+        self.assertEqual(2, len(self.made))
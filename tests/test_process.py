@@ -63,6 +63,39 @@ class TestProcess(unittest.TestCase):
         self.assertEqual([], tiles)
         self.assertEqual({'size': {}}, extra)
 
+    def test_process_coord_no_format_size(self):
+        from shapely.geometry import Point
+        from sys import getsizeof
+        from tilequeue.process import process_coord_no_format
+        from tilequeue.tile import coord_to_mercator_bounds
+
+        coord = Coordinate(0, 0, 0)
+        unpadded_bounds = coord_to_mercator_bounds(coord)
+        wkb = Point(0, 0).wkb
+        feature_layers = [dict(
+            layer_datum=dict(
+                name=name,
+                geometry_types=['Point'],
+                transform_fn_names=[],
+                sort_fn_name=None,
+                is_clipped=False
+            ),
+            padded_bounds=dict(point=unpadded_bounds),
+            features=features,
+        ) for name, features in (
+            ('empty', []),
+            ('points', [dict(__geometry__=wkb, __id__=1, kind='x',
+                             name='yy') for _ in range(2)]),
+        )]
+
+        _, extra = process_coord_no_format(
+            feature_layers, coord.zoom, unpadded_bounds, {})
+
+        feature_size = getsizeof(1) + len(wkb) + len('kind') + len('x') + \
+            len('name') + len('yy')
+        self.assertEqual(dict(size=dict(empty=0, points=2 * feature_size)),
+                         extra)
+
     def test_process_coord_single_layer(self):
         self.maxDiff = 10000
 
@@ -152,6 +185,243 @@ class TestProcess(unittest.TestCase):
         self.assertEqual([90.0, 40.0],
                          tile_1['features'][0]['geometry']['coordinates'])
 
+    def test_process_coord_tuple_rows(self):
+        from tilequeue.process import process_coord_no_format
+        from tilequeue.tile import coord_to_mercator_bounds
+
+        coord = Coordinate(0, 0, 0)
+        unpadded_bounds = coord_to_mercator_bounds(coord)
+        feature_layers = [dict(
+            layer_datum=dict(
+                name='fake_layer',
+                geometry_types=['Point'],
+                transform_fn_names=[],
+                sort_fn_name=None,
+                is_clipped=False
+            ),
+            padded_bounds=dict(point=unpadded_bounds),
+            columns=['__id__', '__geometry__', 'foo', 'bar'],
+            features=[(
+                1,
+                # this is a point at (90, 40) in mercator
+                '\x01\x01\x00\x00\x00\xd7\xa3pE\xf8\x1b' +
+                'cA\x1f\x85\xeb\x91\xe5\x8fRA',
+                'baz',
+                None,
+            )],
+        )]
+
+        processed_layers, extra = process_coord_no_format(
+            feature_layers, coord.zoom, unpadded_bounds, [])
+        self.assertEqual(1, len(processed_layers))
+        features = processed_layers[0]['features']
+        self.assertEqual(1, len(features))
+        shape, props, fid = features[0]
+        self.assertEqual(1, fid)
+        self.assertEqual(dict(foo='baz'), props)
+        self.assertEqual('Point', shape.type)
+
+    def test_process_coord_columnar(self):
+        from tilequeue.columnar import ColumnarFeatures
+        from tilequeue.process import process_coord_no_format
+        from tilequeue.tile import coord_to_mercator_bounds
+
+        coord = Coordinate(0, 0, 0)
+        unpadded_bounds = coord_to_mercator_bounds(coord)
+        features = ColumnarFeatures.from_dict_rows([dict(
+            __id__=1,
+            # this is a point at (90, 40) in mercator
+            __geometry__='\x01\x01\x00\x00\x00\xd7\xa3pE\xf8\x1b' +
+            'cA\x1f\x85\xeb\x91\xe5\x8fRA',
+            foo='bar',
+        )])
+        feature_layers = [dict(
+            layer_datum=dict(
+                name='fake_layer',
+                geometry_types=['Point'],
+                transform_fn_names=[],
+                sort_fn_name=None,
+                is_clipped=False
+            ),
+            padded_bounds=dict(point=unpadded_bounds),
+            features=features,
+        )]
+
+        processed_layers, extra = process_coord_no_format(
+            feature_layers, coord.zoom, unpadded_bounds, [])
+        shape, props, fid = processed_layers[0]['features'][0]
+        self.assertEqual(1, fid)
+        self.assertEqual(dict(foo='bar'), props)
+        self.assertEqual('Point', shape.type)
+
+    def test_process_coord_cut_coords_parallel(self):
+        from tilequeue.tile import coord_children_range
+
+        coord = Coordinate(0, 0, 0)
+        cut_coords = list(coord_children_range(coord, 2))
+        features = [dict(
+            __id__=1,
+            # this is a point at (90, 40) in mercator
+            __geometry__='\x01\x01\x00\x00\x00\xd7\xa3pE\xf8\x1b' + \
+            'cA\x1f\x85\xeb\x91\xe5\x8fRA',
+            foo="bar"
+        )]
+
+        def _tiles(**kwargs):
+            from tilequeue.process import process_coord
+            from tilequeue.tile import coord_to_mercator_bounds
+            from tilequeue.format import json_format
+
+            unpadded_bounds = coord_to_mercator_bounds(coord)
+            feature_layers = [dict(
+                layer_datum=dict(
+                    name='fake_layer',
+                    geometry_types=['Point'],
+                    transform_fn_names=[],
+                    sort_fn_name=None,
+                    is_clipped=False
+                ),
+                padded_bounds=dict(point=unpadded_bounds),
+                features=[dict(f) for f in features],
+            )]
+            tiles, extra = process_coord(
+                coord, coord.zoom, feature_layers, [], [json_format],
+                unpadded_bounds, cut_coords, {}, **kwargs)
+            return [(t['coord'], t['tile']) for t in tiles]
+
+        sequential_tiles = _tiles()
+        parallel_tiles = _tiles(cut_processes=3)
+        self.assertEqual(1 + len(cut_coords), len(parallel_tiles))
+        self.assertEqual(sequential_tiles, parallel_tiles)
+
+
+class TestFeatureIndex(unittest.TestCase):
+
+    def test_candidates_in_layer_order(self):
+        from shapely.geometry import Point
+        from tilequeue.process import FeatureIndex
+        shared_shape = Point(5, 5)
+        features = [
+            (Point(1, 1), {}, 1),
+            (shared_shape, {}, 2),
+            (Point(9, 9), {}, 3),
+            (Point(), {}, 4),
+            (shared_shape, {}, 5),
+            (Point(2, 2), {}, 6),
+        ]
+        index = FeatureIndex(features)
+        candidates = index.candidates((0, 0, 6, 6))
+        self.assertEqual([1, 2, 5, 6], [fid for s, p, fid in candidates])
+        self.assertEqual([], index.candidates((20, 20, 30, 30)))
+
+    def test_empty_layer(self):
+        from tilequeue.process import FeatureIndex
+        self.assertEqual([], FeatureIndex([]).candidates((0, 0, 1, 1)))
+
+
+class TestResolveFns(unittest.TestCase):
+
+    def test_resolve_fn_cached(self):
+        from tilequeue.process import resolve_fn
+        from tilequeue.process import _resolved_fns
+        fn = resolve_fn('tests.test_process._only_zoom_zero')
+        self.assertIs(_only_zoom_zero, fn)
+        self.assertIs(fn, _resolved_fns['tests.test_process._only_zoom_zero'])
+
+    def test_layer_transform_fn_cached(self):
+        from tilequeue.process import resolve_layer_transform_fn
+        names = ['tests.test_process._add_foo']
+        fn = resolve_layer_transform_fn(names)
+        self.assertIs(fn, resolve_layer_transform_fn(list(names)))
+        self.assertEqual(
+            (None, dict(foo='bar'), 1), fn(None, {}, 1, 0))
+        self.assertIsNone(resolve_layer_transform_fn([]))
+
+    def test_cached_resolve_faster_than_per_tile(self):
+        # times resolving the dotted names of a config with many post
+        # process steps for each tile, as was done before they were
+        # cached, against the cached lookup.
+        from timeit import repeat
+        from tilequeue.process import resolve_fn
+        from zope.dottedname.resolve import resolve
+        names = [
+            'tests.test_process._only_zoom_zero',
+            'tests.test_process._only_zoom_one',
+            'tests.test_process._add_foo',
+            'tilequeue.process.make_transform_fn',
+            'tilequeue.transform.transform_feature_layers_shape',
+            'tilequeue.tile.coord_to_mercator_bounds',
+        ] * 7
+
+        def per_tile():
+            for name in names:
+                resolve(name)
+
+        def cached():
+            for name in names:
+                resolve_fn(name)
+
+        cached()
+        per_tile_seconds = min(repeat(per_tile, number=100, repeat=3))
+        cached_seconds = min(repeat(cached, number=100, repeat=3))
+        self.assertLess(cached_seconds, per_tile_seconds)
+
+    def test_postprocess_uses_resolved_fn(self):
+        from tilequeue.process import _postprocess_data
+        calls = []
+
+        def _fn(ctx):
+            calls.append(ctx.params)
+            return None
+
+        post_process_data = [dict(
+            fn_name='does.not.exist', fn=_fn, params={'a': 1},
+            resources={})]
+        _postprocess_data([], post_process_data, 0, (0, 0, 1, 1))
+        self.assertEqual([{'a': 1}], calls)
+
+    def test_postprocess_step_seconds(self):
+        from tilequeue.process import _postprocess_data
+
+        def _fn(ctx):
+            return None
+
+        post_process_data = [
+            dict(fn_name=name, fn=_fn, params={}, resources={})
+            for name in ('a.b', 'c', 'a.b')]
+        step_seconds = {}
+        _postprocess_data([], post_process_data, 0, (0, 0, 1, 1),
+                          step_seconds)
+        self.assertEqual(set(['a.b', 'c']), set(step_seconds))
+
+
+class TestPaddedBoundsFilter(unittest.TestCase):
+
+    def _make_filter(self, bounds):
+        from tilequeue.process import PaddedBoundsFilter
+        return PaddedBoundsFilter(dict(
+            point=bounds, line=bounds, polygon=bounds))
+
+    def test_bounds_outside(self):
+        from shapely.geometry import Point
+        intersects = self._make_filter((0, 0, 1, 1))
+        self.assertFalse(intersects(Point(2, 2)))
+        self.assertEqual({}, intersects.prepared_boxes)
+
+    def test_bounds_inside(self):
+        from shapely.geometry import box
+        intersects = self._make_filter((0, 0, 1, 1))
+        self.assertTrue(intersects(box(0.25, 0.25, 0.75, 0.75)))
+        self.assertEqual({}, intersects.prepared_boxes)
+
+    def test_bounds_overlap(self):
+        from shapely.geometry import LineString
+        intersects = self._make_filter((0, 0, 1, 1))
+        # bounding box overlaps, but the line doesn't
+        self.assertFalse(intersects(LineString([(1.5, 0.8), (0.8, 1.5)])))
+        self.assertTrue(intersects(LineString([(0.5, 0.5), (2, 2)])))
+        self.assertEqual(['line'], intersects.prepared_boxes.keys())
+
 
 def _only_zoom(ctx, zoom):
     layer = ctx.feature_layers[0]
@@ -171,3 +441,8 @@ def _only_zoom_zero(ctx):
 
 def _only_zoom_one(ctx):
     return _only_zoom(ctx, 1)
+
+
+def _add_foo(shape, props, fid, zoom):
+    props['foo'] = 'bar'
+    return shape, props, fid
@@ -0,0 +1,224 @@
+'''
+Tests for `tilequeue.query`.
+'''
+
+import unittest
+
+
+class FakeCursor(object):
+
+    def __init__(self, rows, description=None):
+        self.rows = rows
+        self.queries = []
+        self.description = description
+        self.closed = False
+
+    def execute(self, query):
+        self.queries.append(query)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection(object):
+
+    def __init__(self, rows, description=None):
+        self.cursor_obj = FakeCursor(rows, description)
+        self.cursor_kwargs = None
+        self.autocommit = True
+        self.rollbacks = []
+
+    def cursor(self, **kwargs):
+        self.cursor_kwargs = kwargs
+        return self.cursor_obj
+
+    def rollback(self):
+        self.rollbacks.append(self.autocommit)
+
+
+class TestBatchedQuery(unittest.TestCase):
+
+    def test_build_batched_query(self):
+        from tilequeue.query import build_batched_query
+        queries = [
+            (dict(name='a'), 'SELECT 1;', None),
+            (dict(name='b'), None, None),
+            (dict(name='c'), 'SELECT 2', None),
+        ]
+        layer_columns = {
+            0: ['__id__', '__geometry__', 'kind'],
+            2: ['__geometry__'],
+        }
+        query = build_batched_query(queries, layer_columns)
+        parts = query.split('\nUNION ALL\n')
+        self.assertEqual(2, len(parts))
+        self.assertIn('0 AS __layer_index__', parts[0])
+        self.assertIn('SELECT 1\n', parts[0])
+        # the geometry is only selected once, outside the json
+        self.assertIn(
+            '(SELECT row_to_json(r) FROM (SELECT q."__id__", q."kind") AS r)',
+            parts[0])
+        self.assertEqual(1, parts[0].count('__geometry__ AS'))
+        self.assertIn('2 AS __layer_index__', parts[1])
+        self.assertIn('SELECT 2\n', parts[1])
+        self.assertIn("'{}'::json AS __row__", parts[1])
+
+    def test_build_batched_query_all_empty(self):
+        from tilequeue.query import build_batched_query
+        queries = [(dict(name='a'), None, None)]
+        self.assertIsNone(build_batched_query(queries, {}))
+
+    def test_execute_batched_query_splits_layers(self):
+        from tilequeue.query import execute_batched_query
+        layer_a = dict(name='a')
+        layer_b = dict(name='b')
+        queries = [
+            (layer_a, 'SELECT a', 'bounds-a'),
+            (layer_b, 'SELECT b', 'bounds-b'),
+        ]
+        from tilequeue.query import _batched_layer_columns
+        _batched_layer_columns.clear()
+        _batched_layer_columns['a', 10] = ['__id__', '__geometry__']
+        description = [('__id__',), ('__geometry__',), ('kind',)]
+        conn = FakeConnection([
+            (1, 'geom-b', {u'__id__': 2, u'kind': u'x'}),
+            (0, 'geom-a', {u'__id__': 1}),
+        ], description)
+        results = execute_batched_query(conn, queries, 10)
+        # the columns of b are looked up before the batched query
+        self.assertEqual(2, len(conn.cursor_obj.queries))
+        self.assertIn('LIMIT 0', conn.cursor_obj.queries[0])
+        self.assertIn('q."kind"', conn.cursor_obj.queries[1])
+        self.assertEqual(['__id__', '__geometry__', 'kind'],
+                         _batched_layer_columns['b', 10])
+        self.assertEqual(2, len(results))
+
+        # and only the batched query is needed once they're known
+        execute_batched_query(conn, queries, 10)
+        self.assertEqual(3, len(conn.cursor_obj.queries))
+        _batched_layer_columns.clear()
+
+        rows_a, datum_a, bounds_a = results[0]
+        self.assertIs(layer_a, datum_a)
+        self.assertEqual('bounds-a', bounds_a)
+        self.assertEqual([dict(__id__=1, __geometry__='geom-a')], rows_a)
+
+        rows_b, datum_b, bounds_b = results[1]
+        self.assertIs(layer_b, datum_b)
+        self.assertEqual(
+            [dict(__id__=2, kind='x', __geometry__='geom-b')], rows_b)
+        self.assertIsInstance(rows_b[0]['kind'], str)
+
+    def test_execute_batched_query_without_column_cache(self):
+        from tilequeue.query import _batched_layer_columns
+        from tilequeue.query import execute_batched_query
+        queries = [(dict(name='a'), 'SELECT a', 'bounds')]
+        _batched_layer_columns.clear()
+        description = [('__id__',), ('__geometry__',)]
+        conn = FakeConnection([], description)
+        execute_batched_query(conn, queries, 10, cache_columns=False)
+        execute_batched_query(conn, queries, 10, cache_columns=False)
+        # the columns are looked up for each query, and not kept
+        self.assertEqual(4, len(conn.cursor_obj.queries))
+        self.assertIn('LIMIT 0', conn.cursor_obj.queries[2])
+        self.assertEqual({}, _batched_layer_columns)
+
+    def test_enqueue_batched_query_reloaded_templates(self):
+        from tilequeue.query import DevJinjaQueryGenerator
+        from tilequeue.query import enqueue_batched_query
+        from tilequeue.query import JinjaQueryGenerator
+
+        class FakeTemplate(object):
+            def render(self, bounds, zoom):
+                return 'SELECT a'
+
+        class FakeEnvironment(object):
+            def get_template(self, name):
+                return FakeTemplate()
+
+        class FakeThreadPool(object):
+            def apply_async(self, fn, args):
+                self.args = args
+
+        def layer_data(query_generator):
+            return [dict(
+                name='a', query_generator=query_generator,
+                query_bounds_pad_fn=lambda bounds, meters: bounds)]
+
+        thread_pool = FakeThreadPool()
+        enqueue_batched_query(
+            None, thread_pool,
+            layer_data(JinjaQueryGenerator(FakeTemplate(), 0)), 10, None)
+        fn, (conn, queries, zoom, cache_columns) = thread_pool.args
+        self.assertTrue(cache_columns)
+
+        enqueue_batched_query(
+            None, thread_pool,
+            layer_data(DevJinjaQueryGenerator(FakeEnvironment(), 'a', 0)),
+            10, None)
+        fn, (conn, queries, zoom, cache_columns) = thread_pool.args
+        self.assertFalse(cache_columns)
+
+    def test_execute_batched_query_encodes_nested_values(self):
+        from tilequeue.query import _batched_layer_columns
+        from tilequeue.query import execute_batched_query
+        layer_datum = dict(name='a')
+        queries = [(layer_datum, 'SELECT a', 'bounds')]
+        _batched_layer_columns.clear()
+        _batched_layer_columns['a', 10] = ['__geometry__', 'tags', 'names']
+        # an hstore column comes back as a json object, and a json column
+        # of a list as an array
+        conn = FakeConnection([
+            (0, 'geom', {
+                u'tags': {u'name:de': u'M\xfcnchen', u'kind': u'city'},
+                u'names': [u'M\xfcnchen', {u'en': u'Munich'}],
+            }),
+        ])
+        results = execute_batched_query(conn, queries, 10)
+        _batched_layer_columns.clear()
+
+        rows, datum, bounds = results[0]
+        self.assertEqual(1, len(rows))
+        row = rows[0]
+        tags = row['tags']
+        self.assertEqual({'name:de': 'M\xc3\xbcnchen', 'kind': 'city'}, tags)
+        for k, v in tags.iteritems():
+            self.assertIsInstance(k, str)
+            self.assertIsInstance(v, str)
+        names = row['names']
+        self.assertEqual(['M\xc3\xbcnchen', {'en': 'Munich'}], names)
+        self.assertIsInstance(names[0], str)
+        self.assertIsInstance(names[1].keys()[0], str)
+        self.assertIsInstance(names[1]['en'], str)
+
+
+class TestStreamingQuery(unittest.TestCase):
+
+    def test_rows_are_read_tuples(self):
+        from tilequeue.query import execute_streaming_query
+        layer_datum = dict(name='a')
+        description = [('__id__',), ('__geometry__',), ('kind',)]
+        conn = FakeConnection([
+            (1, buffer('geom-1'), 'x'),
+            (2, buffer('geom-2'), None),
+        ], description)
+        rows, datum, bounds, columns = execute_streaming_query(
+            conn, 'SELECT a', layer_datum, 'bounds', 100)
+
+        self.assertIs(layer_datum, datum)
+        self.assertEqual('bounds', bounds)
+        self.assertEqual(['__id__', '__geometry__', 'kind'], columns)
+        self.assertEqual([(1, 'geom-1', 'x'), (2, 'geom-2', None)], rows)
+        self.assertIsInstance(rows[0][1], bytes)
+
+        self.assertTrue(conn.cursor_kwargs.get('name'))
+        self.assertFalse(conn.cursor_kwargs.get('withhold'))
+        self.assertEqual(100, conn.cursor_obj.itersize)
+        self.assertTrue(conn.cursor_obj.closed)
+
+        # the cursor is read in a transaction, which is ended afterwards
+        self.assertEqual([False], conn.rollbacks)
+        self.assertTrue(conn.autocommit)
@@ -124,3 +124,199 @@ class WriteTileIfChangedTest(unittest.TestCase):
         did_write = self._call_fut('data')
         self.assertFalse(did_write)
         self.assertIsNone(self._out)
+
+
+class WriteTileIfChangedHashTest(unittest.TestCase):
+
+    def setUp(self):
+        self._hash = None
+        self._out = None
+        self.store = type(
+            'test-store',
+            (),
+            dict(read_tile=self._read_tile, write_tile=self._write_tile,
+                 read_tile_hash=self._read_tile_hash)
+        )
+
+    def _read_tile(self, coord, format, layer):
+        self.fail('Tile data should not be read when the hash is available')
+
+    def _read_tile_hash(self, coord, format, layer):
+        return self._hash
+
+    def _write_tile(self, tile_data, coord, format, layer, data_hash=None):
+        self._out = tile_data, data_hash
+
+    def _call_fut(self, tile_data):
+        from tilequeue.store import write_tile_if_changed
+        from tilequeue.format import json_format
+        coord = layer = None
+        result = write_tile_if_changed(
+            self.store, tile_data, coord, json_format, layer)
+        return result
+
+    def test_no_data(self):
+        import hashlib
+        did_write = self._call_fut('data')
+        self.assertTrue(did_write)
+        self.assertEquals(('data', hashlib.md5('data').hexdigest()), self._out)
+
+    def test_diff_data(self):
+        import hashlib
+        self._hash = hashlib.md5('different data').hexdigest()
+        did_write = self._call_fut('data')
+        self.assertTrue(did_write)
+        self.assertEquals('data', self._out[0])
+
+    def test_same_data(self):
+        import hashlib
+        self._hash = hashlib.md5('data').hexdigest()
+        did_write = self._call_fut('data')
+        self.assertFalse(did_write)
+        self.assertIsNone(self._out)
+
+
+class TestTileDirectoryHash(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir_path)
+
+    def test_read_tile_hash(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.store import TileDirectory
+        from tilequeue.store import tile_data_hash
+        from tilequeue.store import write_tile_if_changed
+        import os
+        tile_dir = TileDirectory(self.dir_path)
+        coord = Coordinate(row=3, column=2, zoom=1)
+        self.assertIsNone(tile_dir.read_tile_hash(coord, json_format, 'all'))
+
+        self.assertTrue(write_tile_if_changed(
+            tile_dir, 'tile', coord, json_format, 'all'))
+        self.assertEqual(tile_data_hash('tile', json_format),
+                         tile_dir.read_tile_hash(coord, json_format, 'all'))
+        self.assertFalse(write_tile_if_changed(
+            tile_dir, 'tile', coord, json_format, 'all'))
+
+        # tiles without a hash alongside them are hashed when read
+        hash_path = os.path.join(self.dir_path, 'all/1/2/3.json.md5')
+        self.assertTrue(os.path.isfile(hash_path))
+        os.remove(hash_path)
+        self.assertEqual(tile_data_hash('tile', json_format),
+                         tile_dir.read_tile_hash(coord, json_format, 'all'))
+
+        self.assertEqual(
+            1, tile_dir.delete_tiles([coord], json_format, 'all'))
+        self.assertIsNone(tile_dir.read_tile_hash(coord, json_format, 'all'))
+
+
+class WrittenTileHashesTest(unittest.TestCase):
+
+    def test_least_recently_used_dropped(self):
+        from ModestMaps.Core import Coordinate
+        from tilequeue.format import json_format
+        from tilequeue.format import mvt_format
+        from tilequeue.store import WrittenTileHashes
+        written_hashes = WrittenTileHashes(2)
+        coord_1 = Coordinate(row=1, column=1, zoom=1)
+        coord_2 = Coordinate(row=0, column=1, zoom=1)
+
+        written_hashes.set(coord_1, json_format, 'all', 'a')
+        written_hashes.set(coord_1, mvt_format, 'all', 'b')
+        self.assertEqual('a', written_hashes.get(coord_1, json_format, 'all'))
+
+        # the mvt tile is now the least recently used
+        written_hashes.set(coord_2, json_format, 'all', 'c')
+        self.assertIsNone(written_hashes.get(coord_1, mvt_format, 'all'))
+        self.assertEqual('a', written_hashes.get(coord_1, json_format, 'all'))
+        self.assertEqual('c', written_hashes.get(coord_2, json_format, 'all'))
+
+        written_hashes.set(coord_2, json_format, 'all', 'd')
+        self.assertEqual('d', written_hashes.get(coord_2, json_format, 'all'))
+        self.assertEqual(2, len(written_hashes.hashes))
+
+
+class StoreWriterPoolTest(unittest.TestCase):
+
+    def _make_pool(self, **kwargs):
+        from tilequeue.store import StoreWriterPool
+        logger = type('test-logger', (), dict(warn=lambda self, msg: None))()
+        pool = StoreWriterPool(2, logger, **kwargs)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_retry(self):
+        pool = self._make_pool(max_retries=2, retry_backoff_seconds=0)
+        calls = []
+
+        def flaky(result):
+            calls.append(result)
+            if len(calls) < 3:
+                raise IOError('flaky')
+            return result
+
+        self.assertEqual('ok', pool.apply_async(flaky, ('ok',), 10).get())
+        self.assertEqual(3, len(calls))
+        self.assertEqual(0, pool.in_flight_bytes)
+
+        def broken():
+            calls.append(None)
+            raise IOError('broken')
+
+        del calls[:]
+        self.assertRaises(IOError, pool.apply_async(broken, (), 10).get)
+        self.assertEqual(3, len(calls))
+        self.assertEqual(0, pool.in_flight_bytes)
+
+    def test_max_in_flight_bytes(self):
+        import threading
+        pool = self._make_pool(max_in_flight_bytes=100)
+        release = threading.Event()
+        first = pool.apply_async(release.wait, (), 60)
+
+        # this would take the data in flight over the maximum, so waits
+        # until the first write is done.
+        started = threading.Event()
+
+        def second_write():
+            pool.apply_async(lambda: None, (), 60).get()
+            started.set()
+
+        thread = threading.Thread(target=second_write)
+        thread.start()
+        self.assertFalse(started.wait(0.1))
+        self.assertEqual(60, pool.in_flight_bytes)
+
+        release.set()
+        first.get()
+        thread.join()
+        self.assertTrue(started.is_set())
+        self.assertEqual(0, pool.in_flight_bytes)
+
+
+class MakeS3StoreTest(unittest.TestCase):
+
+    def test_connects_per_thread_when_used(self):
+        from mock import patch
+        from tilequeue.store import make_s3_store
+        import threading
+        with patch('tilequeue.store.connect_s3') as connect_s3:
+            store = make_s3_store('bucket-name')
+            self.assertFalse(connect_s3.called)
+
+            buckets = [store.bucket, store.bucket]
+            thread = threading.Thread(
+                target=lambda: buckets.append(store.bucket))
+            thread.start()
+            thread.join()
+
+        self.assertEqual(2, connect_s3.call_count)
+        self.assertIs(buckets[0], buckets[1])
+        self.assertIsNot(buckets[0], buckets[2])
+        self.assertEqual('bucket-name', buckets[0].name)
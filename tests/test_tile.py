@@ -180,3 +180,12 @@ class CoordIntZoomTest(unittest.TestCase):
             exp_int = coord_marshall_int(parent_coord)
             act_int = coord_int_zoom_up(coord_int)
             self.assertEquals(exp_int, act_int)
+
+
+class RoundHalfAwayFromZeroTest(unittest.TestCase):
+
+    def test_halves(self):
+        from tilequeue.tile import round_half_away_from_zero
+        values = [-2.5, -1.5, -0.5, 0.0, 0.5, 1.5, 2.5, 1.2, -1.7]
+        self.assertEquals([-3, -2, -1, 0, 1, 2, 3, 1, -2],
+                          round_half_away_from_zero(values).tolist())
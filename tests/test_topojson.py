@@ -0,0 +1,89 @@
+import unittest
+
+
+class TopoJSONEncodeTest(unittest.TestCase):
+
+    def _encode(self, features_by_layer):
+        from cStringIO import StringIO
+        from tilequeue.format.topojson import encode
+        import json
+        fp = StringIO()
+        encode(fp, features_by_layer, (0.0, 0.0, 1.0, 1.0))
+        return json.loads(fp.getvalue())
+
+    def _decode_arcs(self, topology, arc_indexes):
+        points = []
+        for arc_index in arc_indexes:
+            if arc_index < 0:
+                arc = self._decode_arc(topology['arcs'][~arc_index])[::-1]
+            else:
+                arc = self._decode_arc(topology['arcs'][arc_index])
+            points.extend(arc if not points else arc[1:])
+        return points
+
+    def _decode_arc(self, arc):
+        x = y = 0
+        points = []
+        for dx, dy in arc:
+            x += dx
+            y += dy
+            points.append((x, y))
+        return points
+
+    def _box(self, minx, miny, maxx, maxy):
+        from shapely.geometry import Polygon
+        return Polygon([(minx, miny), (maxx, miny), (maxx, maxy),
+                        (minx, maxy)])
+
+    def test_shared_boundary(self):
+        from shapely.geometry import Polygon
+        left = self._box(0.25, 0.25, 0.5, 0.75)
+        right = self._box(0.5, 0.25, 0.75, 0.75)
+        topology = self._encode(dict(landuse=[
+            (left, {}, 1), (right, {}, 2)]))
+
+        # two arcs for the outer boundary, and one shared between them
+        self.assertEqual(3, len(topology['arcs']))
+
+        geometries = topology['objects']['landuse']['geometries']
+        self.assertEqual([1, 2], [g['id'] for g in geometries])
+        left_arcs, right_arcs = [g['arcs'][0] for g in geometries]
+        shared = set(left_arcs) & set(~i for i in right_arcs)
+        self.assertEqual(1, len(shared))
+
+        for geometry, shape in zip(geometries, (left, right)):
+            self.assertEqual('Polygon', geometry['type'])
+            ring = self._decode_arcs(topology, geometry['arcs'][0])
+            self.assertEqual(ring[0], ring[-1])
+            self.assertEqual(shape.area * 4096 * 4096, Polygon(ring).area)
+
+    def test_identical_rings(self):
+        ring = self._box(0.25, 0.25, 0.5, 0.5)
+        rotated = self._box(0.25, 0.25, 0.5, 0.5)
+        rotated = type(rotated)(list(rotated.exterior.coords)[2:-1] +
+                                list(rotated.exterior.coords)[:3])
+        topology = self._encode(dict(water=[
+            (ring, {}, None), (rotated, {}, None)]))
+        self.assertEqual(1, len(topology['arcs']))
+
+    def test_line_and_points(self):
+        from shapely.geometry import LineString
+        from shapely.geometry import MultiPoint
+        from shapely.geometry import Point
+        line = LineString([(0, 0), (0.5, 0.5), (0.5, 0.5), (1, 0)])
+        topology = self._encode(dict(things=[
+            (line, dict(kind='road'), None),
+            (Point(0.25, 0.75), {}, 7),
+            (MultiPoint([(0, 0), (1, 1)]), {}, None),
+        ]))
+        line_geom, point_geom, multi_geom = \
+            topology['objects']['things']['geometries']
+
+        self.assertEqual('LineString', line_geom['type'])
+        self.assertEqual(dict(kind='road'), line_geom['properties'])
+        self.assertEqual([(0, 0), (2048, 2048), (4096, 0)],
+                         self._decode_arcs(topology, line_geom['arcs']))
+
+        self.assertEqual(7, point_geom['id'])
+        self.assertEqual([1024, 3072], point_geom['coordinates'])
+        self.assertEqual([[0, 0], [4096, 4096]], multi_geom['coordinates'])
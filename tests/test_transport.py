@@ -0,0 +1,74 @@
+'''
+Tests for `tilequeue.transport`.
+'''
+
+import unittest
+
+
+class TestMmapFeatureLayersTransport(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.dir_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir_path)
+
+    def _make_transport(self):
+        from tilequeue.transport import MmapFeatureLayersTransport
+        return MmapFeatureLayersTransport(self.dir_path)
+
+    def test_round_trip_dict_rows(self):
+        import os
+        transport = self._make_transport()
+        feature_layers = [
+            dict(name='a', layer_datum=dict(name='a'), padded_bounds=None,
+                 features=[
+                     dict(__id__=1, __geometry__='wkb-1', foo='bar'),
+                     dict(__id__=2, __geometry__='', baz=3),
+                 ]),
+            dict(name='b', layer_datum=dict(name='b'), padded_bounds=None,
+                 features=[]),
+        ]
+        handle = transport.write(feature_layers)
+        self.assertTrue(os.path.exists(handle))
+
+        result = transport.read(handle)
+        self.assertEqual(feature_layers, result)
+        self.assertFalse(os.path.exists(handle))
+
+    def test_round_trip_tuple_rows(self):
+        transport = self._make_transport()
+        feature_layers = [
+            dict(name='a', layer_datum=dict(name='a'), padded_bounds=None,
+                 columns=['__id__', 'foo', '__geometry__'],
+                 features=[(1, 'bar', 'wkb-1'), (2, None, 'wkb-22')]),
+        ]
+        handle = transport.write(feature_layers)
+        result = transport.read(handle)
+        self.assertEqual(feature_layers, result)
+
+    def test_round_trip_columnar(self):
+        from tilequeue.columnar import ColumnarFeatures
+        transport = self._make_transport()
+        features = ColumnarFeatures.from_dict_rows([
+            dict(__id__=1, __geometry__='wkb-1', foo='bar'),
+            dict(__id__=2, __geometry__='wkb-22'),
+        ])
+        feature_layers = [
+            dict(name='a', layer_datum=dict(name='a'), padded_bounds=None,
+                 features=features),
+        ]
+        handle = transport.write(feature_layers)
+        result = transport.read(handle)
+        self.assertEqual(1, len(result))
+        self.assertEqual(list(features), list(result[0]['features']))
+
+    def test_discard(self):
+        import os
+        transport = self._make_transport()
+        handle = transport.write([])
+        transport.discard(handle)
+        self.assertFalse(os.path.exists(handle))
+        self.assertEqual([], os.listdir(self.dir_path))
@@ -0,0 +1,35 @@
+import unittest
+
+
+class StatsThreadPoolTest(unittest.TestCase):
+
+    def test_get_stats(self):
+        from tilequeue.utils import StatsThreadPool
+        import threading
+        pool = StatsThreadPool(2)
+        self.addCleanup(pool.join)
+        self.addCleanup(pool.close)
+
+        release = threading.Event()
+        results = [pool.apply_async(release.wait, (60,)) for i in range(3)]
+
+        # wait for the two threads to pick up a job each
+        for i in range(100):
+            if pool.get_stats()['active'] == 2:
+                break
+            release.wait(0.01)
+        stats = pool.get_stats()
+        self.assertEqual(2, stats['threads'])
+        self.assertEqual(2, stats['active'])
+        self.assertEqual(1, stats['queued'])
+        self.assertEqual(0, stats['done'])
+        # both threads have been busy since the last call
+        self.assertAlmostEqual(1.0, stats['utilisation'], places=2)
+
+        release.set()
+        for result in results:
+            result.get()
+        stats = pool.get_stats()
+        self.assertEqual(0, stats['active'])
+        self.assertEqual(0, stats['queued'])
+        self.assertEqual(3, stats['done'])
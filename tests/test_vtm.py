@@ -0,0 +1,53 @@
+import unittest
+
+
+class GeomEncoderTest(unittest.TestCase):
+
+    def _shapes(self):
+        from shapely.geometry import LineString
+        from shapely.geometry import MultiLineString
+        from shapely.geometry import MultiPoint
+        from shapely.geometry import MultiPolygon
+        from shapely.geometry import Point
+        from shapely.geometry import Polygon
+        polygon = Polygon(
+            [(0, 0), (100, 0), (100, 0.4), (100, 100), (0, 100)],
+            [[(10, 10), (20, 10), (20, 20.5), (10, 20)]])
+        return [
+            Point(1.5, 2.5),
+            MultiPoint([(1, 1), (1, 1), (2, 2)]),
+            LineString([(0, 0), (0, 0), (10, 10.5), (-3, -2.5)]),
+            MultiLineString([[(0, 0), (1, 1)], [(1, 1), (4, 4)]]),
+            polygon,
+            MultiPolygon([polygon, Polygon([(0, 0), (5, 0), (5, 5)])]),
+        ]
+
+    def test_encode_shape_matches_wkb(self):
+        from tilequeue.format.OSciMap4.GeomEncoder import GeomEncoder
+        for shape in self._shapes():
+            expected = GeomEncoder(4096)
+            expected.parseGeometry(shape.wkb)
+            result = GeomEncoder(4096)
+            result.encodeShape(shape)
+            for attr in ('coordinates', 'index', 'isPoint', 'isPoly',
+                         'dropped'):
+                self.assertEqual(
+                    getattr(expected, attr), getattr(result, attr),
+                    '%s differs for %s' % (attr, shape.type))
+
+    def test_merge_matches_wkb(self):
+        from cStringIO import StringIO
+        from tilequeue.format.vtm import merge
+        props = dict(kind='park', layer=1, height=3.5, area='yes', flag=True,
+                     one=1)
+        features = [(shape, dict(props, name='n%d' % (i % 2)), i)
+                    for i, shape in enumerate(self._shapes())]
+
+        def _merge(features):
+            fp = StringIO()
+            merge(fp, [dict(name='buildings', features=features),
+                       dict(name='landuse', features=features)])
+            return fp.getvalue()
+
+        wkb_features = [(shape.wkb, p, i) for shape, p, i in features]
+        self.assertEqual(_merge(wkb_features), _merge(features))
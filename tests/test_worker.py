@@ -0,0 +1,177 @@
+import unittest
+
+
+class FakeQueue(object):
+
+    def __init__(self, depth):
+        self.depth = depth
+
+    def qsize(self):
+        return self.depth
+
+
+class PipelineControllerTest(unittest.TestCase):
+
+    def _make_controller(self, fetch_depth, store_depth):
+        from tilequeue.worker import PipelineController
+        from tilequeue.worker import StageLimit
+        import threading
+        logger = type('test-logger', (), dict(info=lambda self, msg: None))()
+        return PipelineController(
+            StageLimit(2, 4), StageLimit(2, 4), FakeQueue(fetch_depth), 10,
+            FakeQueue(store_depth), 10, 4, 1, logger, threading.Event())
+
+    def test_grow_fetch_when_processors_wait(self):
+        controller = self._make_controller(0, 5)
+        controller.adjust()
+        self.assertEqual(3, controller.fetch_limit.limit)
+        self.assertEqual(2, controller.store_limit.limit)
+        controller.adjust()
+        controller.adjust()
+        self.assertEqual(4, controller.fetch_limit.limit)
+
+    def test_shrink_fetch_when_processors_behind(self):
+        controller = self._make_controller(10, 5)
+        controller.adjust()
+        controller.adjust()
+        self.assertEqual(1, controller.fetch_limit.limit)
+
+    def test_grow_store_when_full(self):
+        controller = self._make_controller(5, 10)
+        controller.adjust()
+        self.assertEqual(2, controller.fetch_limit.limit)
+        self.assertEqual(3, controller.store_limit.limit)
+
+    def test_timings(self):
+        controller = self._make_controller(5, 5)
+        # with 4 processors, fetching takes half as long as processing, so
+        # 2 fetch threads keep up, and storing a quarter, so 1 does.
+        controller.observe(dict(
+            fetch_seconds=1.0, process_seconds=2.0, s3_seconds=0.5))
+        controller.adjust()
+        self.assertEqual(2, controller.fetch_limit.limit)
+        self.assertEqual(1, controller.store_limit.limit)
+
+
+class StageLimitTest(unittest.TestCase):
+
+    def test_wait_for_turn(self):
+        from tilequeue.worker import StageLimit
+        import threading
+        limit = StageLimit(1, 2)
+        stop = threading.Event()
+        first, second = limit.take_slot(), limit.take_slot()
+        self.assertTrue(limit.wait_for_turn(first, stop))
+
+        turns = []
+        thread = threading.Thread(
+            target=lambda: turns.append(limit.wait_for_turn(second, stop)))
+        thread.start()
+        thread.join(0.1)
+        self.assertEqual([], turns)
+
+        self.assertEqual(2, limit.set_limit(5))
+        thread.join()
+        self.assertEqual([True], turns)
+
+        limit.set_limit(1)
+        stop.set()
+        self.assertFalse(limit.wait_for_turn(second, stop))
+
+
+class MemoryBudgetTest(unittest.TestCase):
+
+    def test_reserve_and_release(self):
+        from tilequeue.worker import MemoryBudget
+        import threading
+        budget = MemoryBudget(100, 40)
+        stop = threading.Event()
+
+        first = budget.reserve(10, stop)
+        budget.reserve(10, stop)
+        self.assertEqual((10, 40), first)
+        self.assertEqual(80, budget.reserved_bytes)
+
+        # a third wouldn't fit, so waits for one to be released
+        reserved = []
+        thread = threading.Thread(
+            target=lambda: reserved.append(budget.reserve(11, stop)))
+        thread.start()
+        thread.join(0.1)
+        self.assertEqual([], reserved)
+
+        # and the size found for the first improves the estimate at z10
+        budget.release(first, 20)
+        thread.join()
+        self.assertEqual([(11, 40)], reserved)
+        self.assertEqual((10, 20), budget.reserve(10, stop))
+        self.assertEqual(100, budget.reserved_bytes)
+
+        stop.set()
+        self.assertIsNone(budget.reserve(10, stop))
+
+    def test_always_admits_one(self):
+        from tilequeue.worker import MemoryBudget
+        import threading
+        budget = MemoryBudget(100, 1000)
+        reservation = budget.reserve(10, threading.Event())
+        self.assertEqual(1000, budget.reserved_bytes)
+        budget.release(reservation)
+        self.assertEqual(0, budget.reserved_bytes)
+
+
+class FakeStats(object):
+
+    def __init__(self):
+        self.timings = {}
+        self.counts = {}
+        self.sent = False
+
+    def pipeline(self):
+        return self
+
+    def timing(self, name, ms):
+        self.timings[name] = ms
+
+    def incr(self, name, count=1):
+        self.counts[name] = self.counts.get(name, 0) + count
+
+    def send(self):
+        self.sent = True
+
+
+class SqsQueueWriterStatsTest(unittest.TestCase):
+
+    def test_send_stats(self):
+        from tilequeue.worker import SqsQueueWriter
+        stats = FakeStats()
+        writer = SqsQueueWriter(None, None, None, None, stats=stats)
+        metadata = dict(
+            timing=dict(
+                fetch_seconds=1.0,
+                process_seconds=2.0,
+                s3_seconds=0.5,
+                ack_seconds=0.25,
+                layer_fetch_seconds=dict(roads=0.75),
+                post_process_seconds={'vectordatasource.transform.fn': 0.1},
+                encode_seconds=dict(mvt=0.2),
+            ),
+            format_bytes=dict(mvt=1234),
+            store=dict(stored=3, not_stored=1),
+        )
+        writer._send_stats(metadata, 4.0)
+
+        self.assertTrue(stats.sent)
+        self.assertEqual({
+            'process.fetch': 1000.0,
+            'process.process': 2000.0,
+            'process.s3': 500.0,
+            'process.ack': 250.0,
+            'process.sqs': 4000.0,
+            'process.fetch.layer.roads': 750.0,
+            'process.post-process.vectordatasource_transform_fn': 100.0,
+            'process.encode.mvt': 200.0,
+            'process.encode.mvt.bytes': 1234,
+        }, stats.timings)
+        self.assertEqual(
+            {'process.stored': 3, 'process.not-stored': 1}, stats.counts)
@@ -0,0 +1,117 @@
+from array import array
+
+
+def _intern(k):
+    # only byte strings can be interned
+    if isinstance(k, str):
+        return intern(k)
+    return k
+
+
+class ColumnarFeatures(object):
+    """
+    Compact storage for the rows fetched for a single layer.
+
+    Rather than a dict per row, which repeats every key string in every
+    row, this keeps a list of the feature ids, all the WKB concatenated
+    into a single byte string with an array of offsets into it, and a
+    list of values per property column, keyed by the interned column
+    name. Properties missing from a row are stored as None.
+
+    Iterating over it yields a dict per row, in the same form as the rows
+    read from the database, for code which expects those.
+    """
+
+    def __init__(self, ids, wkb, offsets, properties):
+        self.ids = ids
+        self.wkb = wkb
+        # offsets has one more element than ids, so that the WKB for row
+        # i is wkb[offsets[i]:offsets[i + 1]]
+        self.offsets = offsets
+        self.properties = properties
+
+    @classmethod
+    def from_dict_rows(cls, rows):
+        """
+        Build from dict rows, reading any buffers into bytes along the way
+        and skipping None values, as DataFetcher does for dict rows.
+        """
+
+        ids = []
+        wkbs = []
+        offsets = array('L', [0])
+        properties = {}
+        offset = 0
+        for i, row in enumerate(rows):
+            for k, v in row.iteritems():
+                if isinstance(v, buffer):
+                    v = bytes(v)
+                if k == '__geometry__':
+                    wkbs.append(v)
+                    offset += len(v)
+                    offsets.append(offset)
+                elif k == '__id__':
+                    ids.append(v)
+                elif v is not None:
+                    column = properties.get(k)
+                    if column is None:
+                        column = properties[_intern(k)] = [None] * i
+                    column.append(v)
+            for column in properties.itervalues():
+                if len(column) <= i:
+                    column.append(None)
+
+        return cls(ids, ''.join(wkbs), offsets, properties)
+
+    @classmethod
+    def from_tuple_rows(cls, columns, rows):
+        """
+        Build from tuple rows which all share the list of column names.
+        """
+
+        geometry_index = columns.index('__geometry__')
+        id_index = columns.index('__id__')
+        property_columns = [
+            (i, _intern(k)) for i, k in enumerate(columns)
+            if i not in (geometry_index, id_index)]
+
+        ids = []
+        wkbs = []
+        offsets = array('L', [0])
+        properties = dict((k, []) for i, k in property_columns)
+        offset = 0
+        for row in rows:
+            ids.append(row[id_index])
+            wkb = row[geometry_index]
+            wkbs.append(wkb)
+            offset += len(wkb)
+            offsets.append(offset)
+            for i, k in property_columns:
+                properties[k].append(row[i])
+
+        return cls(ids, ''.join(wkbs), offsets, properties)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def geometry(self, i):
+        return self.wkb[self.offsets[i]:self.offsets[i + 1]]
+
+    def iter_feature_rows(self):
+        """
+        Yields (wkb, feature id, list of (key, value) properties) for each
+        row, skipping None property values.
+        """
+
+        columns = self.properties.items()
+        for i, feature_id in enumerate(self.ids):
+            props = [(k, values[i]) for k, values in columns
+                     if values[i] is not None]
+            yield self.geometry(i), feature_id, props
+
+    def __iter__(self):
+        for wkb, feature_id, props in self.iter_feature_rows():
+            row = dict(props)
+            row['__id__'] = feature_id
+            row['__geometry__'] = wkb
+            yield row
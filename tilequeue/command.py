@@ -5,10 +5,11 @@ from contextlib import closing
 from itertools import chain
 from jinja2 import Environment
 from jinja2 import FileSystemLoader
-from multiprocessing.pool import ThreadPool
 from tilequeue.config import create_query_bounds_pad_fn
 from tilequeue.config import make_config_from_argparse
+from tilequeue.format import indexed_metatile_format
 from tilequeue.format import lookup_format_by_extension
+from tilequeue.format import zip_format
 from tilequeue.metro_extract import city_bounds
 from tilequeue.metro_extract import parse_metro_extract
 from tilequeue.query import DataFetcher
@@ -20,6 +21,8 @@ from tilequeue.query import jinja_filter_bbox_padded_intersection
 from tilequeue.query import jinja_filter_geometry
 from tilequeue.queue import make_sqs_queue
 from tilequeue.store import s3_tile_key
+from tilequeue.store import StoreWriterPool
+from tilequeue.store import WrittenTileHashes
 from tilequeue.tile import coord_int_zoom_up
 from tilequeue.tile import coord_is_valid
 from tilequeue.tile import coord_marshall_int
@@ -33,17 +36,24 @@ from tilequeue.tile import tile_generator_for_single_bounds
 from tilequeue.tile import zoom_mask
 from tilequeue.toi import load_set_from_fp
 from tilequeue.toi import save_set_to_fp
+from tilequeue.transport import default_transport_path
+from tilequeue.transport import make_feature_layers_transport
 from tilequeue.top_tiles import parse_top_tiles
 from tilequeue.utils import grouper
 from tilequeue.utils import parse_log_file
 from tilequeue.utils import mimic_prune_tiles_of_interest_sql_structure
+from tilequeue.utils import StatsThreadPool
 from tilequeue.worker import DataFetch
+from tilequeue.worker import MemoryBudget
+from tilequeue.worker import PipelineController
 from tilequeue.worker import ProcessAndFormatData
 from tilequeue.worker import QueuePrint
 from tilequeue.worker import S3Storage
 from tilequeue.worker import SqsQueueReader
 from tilequeue.worker import SqsQueueWriter
+from tilequeue.worker import StageLimit
 from tilequeue.postgresql import DBAffinityConnectionsNoLimit
+from tilequeue.postgresql import DBAffinityConnectionsPool
 from urllib2 import urlopen
 from zope.dottedname.resolve import resolve
 import argparse
@@ -55,8 +65,10 @@ import operator
 import os
 import os.path
 import Queue
+import shutil
 import signal
 import sys
+import tempfile
 import threading
 import time
 import traceback
@@ -601,8 +613,10 @@ def parse_layer_data(query_cfg, buffer_cfg, template_path, reload_templates,
 
         resources = _parse_postprocess_resources(post_process_item, cfg_path)
 
+        # resolve the function once here, rather than for each tile
         post_process_data.append(dict(
             fn_name=fn_name,
+            fn=resolve(fn_name),
             params=dict(params),
             resources=resources))
 
@@ -654,16 +668,67 @@ def tilequeue_process(cfg, peripherals):
         n_simultaneous_s3_storage = max(n_cpu / 2, 1)
     assert n_simultaneous_s3_storage > 0
 
-    # thread pool used for queries and uploading to s3
-    n_total_needed_query = n_layers * n_simultaneous_query_sets
-    n_total_needed_s3 = n_formats * n_simultaneous_s3_storage
-    n_total_needed = n_total_needed_query + n_total_needed_s3
+    # when the pipeline is adaptive, threads are started for up to the
+    # maximum number of query sets and s3 storage, but the controller
+    # decides how many of them work at once, starting from the numbers
+    # configured.
+    n_query_set_threads = n_simultaneous_query_sets
+    n_s3_storage_threads = n_simultaneous_s3_storage
+    fetch_limit = store_limit = None
+    if cfg.adaptive_pipeline:
+        n_query_set_threads = cfg.adaptive_pipeline_max_query_sets or \
+            2 * n_simultaneous_query_sets
+        n_s3_storage_threads = cfg.adaptive_pipeline_max_s3_storage or \
+            2 * n_simultaneous_s3_storage
+        fetch_limit = StageLimit(
+            n_simultaneous_query_sets, n_query_set_threads)
+        store_limit = StageLimit(
+            n_simultaneous_s3_storage, n_s3_storage_threads)
+
+    # when batching queries, each query set is a single query on a single
+    # connection, rather than one per layer.
+    n_conns_per_query_set = 1 if cfg.batch_queries else n_layers
+
+    # thread pool used for queries
+    n_total_needed_query = n_conns_per_query_set * n_query_set_threads
     n_max_io_workers = 50
-    n_io_workers = min(n_total_needed, n_max_io_workers)
-    io_pool = ThreadPool(n_io_workers)
+    n_io_workers = cfg.query_threads or \
+        min(n_total_needed_query, n_max_io_workers)
+    io_pool = StatsThreadPool(n_io_workers)
+
+    # writes to the store have their own threads, so that they can't hold
+    # up the queries.
+    n_store_writer_threads = cfg.store_writer_threads or \
+        min(n_formats * n_s3_storage_threads, n_max_io_workers)
+    store_writer_pool = StoreWriterPool(
+        n_store_writer_threads, logger,
+        max_in_flight_bytes=cfg.store_writer_max_in_flight_bytes,
+        max_retries=cfg.store_writer_retries,
+        retry_backoff_seconds=cfg.store_writer_retry_backoff_seconds)
+
+    # keep enough connections open to each database that all the query
+    # sets can be in flight against the same one at once.
+    sql_conn_info = dict(cfg.postgresql_conn_info)
+    dbnames = sql_conn_info.pop('dbnames')
+    max_conns_per_db = cfg.sql_conn_pool_max_conns_per_db or \
+        n_total_needed_query
+    # each query set takes all its connections from a single database at
+    # once, so would never get them with fewer than that.
+    assert max_conns_per_db >= n_conns_per_query_set, \
+        'sql-conn-pool max-conns-per-db is %d, but each query set needs ' \
+        '%d connections, one per layer unless batch-queries is set' % (
+            max_conns_per_db, n_conns_per_query_set)
+    sql_conn_pool = DBAffinityConnectionsPool(
+        dbnames, sql_conn_info, max_conns_per_db,
+        max_idle_seconds=cfg.sql_conn_pool_max_idle_seconds,
+        max_lifetime_seconds=cfg.sql_conn_pool_max_lifetime_seconds,
+        wait_timeout_seconds=cfg.sql_conn_pool_wait_timeout_seconds)
 
     feature_fetcher = DataFetcher(cfg.postgresql_conn_info, all_layer_data,
-                                  io_pool, n_layers)
+                                  io_pool, n_layers, sql_conn_pool,
+                                  cfg.batch_queries,
+                                  cfg.query_cursor_itersize,
+                                  cfg.columnar_feature_layers)
 
     # create all queues used to manage pipeline
 
@@ -688,20 +753,66 @@ def tilequeue_process(cfg, peripherals):
         sqs_queue, sqs_input_queue, logger, thread_sqs_queue_reader_stop,
         cfg.max_zoom)
 
+    # files for the feature layers transport go in a directory per run, so
+    # that anything left over on shutdown can be cleaned up.
+    if cfg.feature_layers_transport == 'mmap':
+        transport_dir = tempfile.mkdtemp(
+            prefix='tilequeue-', dir=cfg.feature_layers_transport_path or
+            default_transport_path())
+    else:
+        transport_dir = None
+    transport = make_feature_layers_transport(
+        cfg.feature_layers_transport, transport_dir)
+
+    # metatiles are only fetched while the memory reserved for those in
+    # the pipeline is within the budget, when one is configured.
+    memory_budget = None
+    if cfg.memory_budget_bytes:
+        memory_budget = MemoryBudget(
+            cfg.memory_budget_bytes,
+            cfg.memory_budget_initial_estimate_bytes or
+            cfg.memory_budget_bytes // 16)
+
     data_fetch = DataFetch(
         feature_fetcher, sqs_input_queue, sql_data_fetch_queue, io_pool,
-        logger, cfg.metatile_zoom, cfg.max_zoom)
+        logger, cfg.metatile_zoom, cfg.max_zoom, transport, fetch_limit,
+        memory_budget)
 
     data_processor = ProcessAndFormatData(
         post_process_data, formats, sql_data_fetch_queue, processor_queue,
-        cfg.buffer_cfg, logger)
+        cfg.buffer_cfg, logger, transport, cfg.cut_child_tiles_processes,
+        cfg.cut_child_tiles_min_coords)
+
+    metatile_format = lookup_format_by_extension(cfg.metatile_format)
+    assert metatile_format in (zip_format, indexed_metatile_format), \
+        'Unknown metatile format: %s' % cfg.metatile_format
+
+    written_hashes = None
+    if cfg.written_hashes_cache_size:
+        written_hashes = WrittenTileHashes(cfg.written_hashes_cache_size)
+
+    s3_storage = S3Storage(processor_queue, s3_store_queue, store_writer_pool,
+                           store, logger, cfg.metatile_size, written_hashes,
+                           cfg.metatile_deterministic, metatile_format,
+                           cfg.metatile_compress, store_limit,
+                           memory_budget)
 
-    s3_storage = S3Storage(processor_queue, s3_store_queue, io_pool, store,
-                           logger, cfg.metatile_size)
+    # create a data processor per cpu
+    n_data_processors = n_cpu
+
+    controller = None
+    if cfg.adaptive_pipeline:
+        controller_stop = threading.Event()
+        controller = PipelineController(
+            fetch_limit, store_limit, sql_data_fetch_queue,
+            sql_queue_buffer_size, processor_queue, proc_queue_buffer_size,
+            n_data_processors, cfg.adaptive_pipeline_interval_seconds,
+            logger, controller_stop)
 
     thread_sqs_writer_stop = threading.Event()
     sqs_queue_writer = SqsQueueWriter(sqs_queue, s3_store_queue, logger,
-                                      thread_sqs_writer_stop)
+                                      thread_sqs_writer_stop, controller,
+                                      peripherals.stats)
 
     def create_and_start_thread(fn, *args):
         t = threading.Thread(target=fn, args=args)
@@ -712,15 +823,13 @@ def tilequeue_process(cfg, peripherals):
 
     threads_data_fetch = []
     threads_data_fetch_stop = []
-    for i in range(n_simultaneous_query_sets):
+    for i in range(n_query_set_threads):
         thread_data_fetch_stop = threading.Event()
         thread_data_fetch = create_and_start_thread(data_fetch,
                                                     thread_data_fetch_stop)
         threads_data_fetch.append(thread_data_fetch)
         threads_data_fetch_stop.append(thread_data_fetch_stop)
 
-    # create a data processor per cpu
-    n_data_processors = n_cpu
     data_processors = []
     data_processors_stop = []
     for i in range(n_data_processors):
@@ -733,7 +842,7 @@ def tilequeue_process(cfg, peripherals):
 
     threads_s3_storage = []
     threads_s3_storage_stop = []
-    for i in range(n_simultaneous_s3_storage):
+    for i in range(n_s3_storage_threads):
         thread_s3_storage_stop = threading.Event()
         thread_s3_storage = create_and_start_thread(s3_storage,
                                                     thread_s3_storage_stop)
@@ -742,6 +851,11 @@ def tilequeue_process(cfg, peripherals):
 
     thread_sqs_writer = create_and_start_thread(sqs_queue_writer)
 
+    if controller:
+        controller_thread = create_and_start_thread(controller)
+    else:
+        controller_thread = None
+
     if cfg.log_queue_sizes:
         assert(cfg.log_queue_sizes_interval_seconds > 0)
         queue_data = (
@@ -751,9 +865,16 @@ def tilequeue_process(cfg, peripherals):
             (s3_store_queue, 's3'),
         )
         queue_printer_thread_stop = threading.Event()
+        pool_data = (
+            (sql_conn_pool, 'sql-conn-pool'),
+            (io_pool, 'query-pool'),
+            (store_writer_pool, 'store-writer-pool'),
+        )
+        if memory_budget:
+            pool_data += ((memory_budget, 'memory-budget'),)
         queue_printer = QueuePrint(
             cfg.log_queue_sizes_interval_seconds, queue_data, logger,
-            queue_printer_thread_stop)
+            queue_printer_thread_stop, pool_data, peripherals.stats)
         queue_printer_thread = create_and_start_thread(queue_printer)
     else:
         queue_printer_thread = None
@@ -778,6 +899,8 @@ def tilequeue_process(cfg, peripherals):
 
         if queue_printer_thread_stop:
             queue_printer_thread_stop.set()
+        if controller_thread:
+            controller_stop.set()
 
         logger.info('requesting all workers (threads and processes) stop ... '
                     'done')
@@ -826,6 +949,10 @@ def tilequeue_process(cfg, peripherals):
             logger.info('joining queue printer ...')
             queue_printer_thread.join()
             logger.info('joining queue printer ... done')
+        if controller_thread:
+            logger.info('joining pipeline controller ...')
+            controller_thread.join()
+            logger.info('joining pipeline controller ... done')
 
         logger.info('joining all workers ... done')
 
@@ -834,6 +961,14 @@ def tilequeue_process(cfg, peripherals):
         io_pool.join()
         logger.info('joining io pool ... done')
 
+        logger.info('joining store writer pool ...')
+        store_writer_pool.close()
+        logger.info('joining store writer pool ... done')
+
+        logger.info('closing sql connection pool ...')
+        sql_conn_pool.closeall()
+        logger.info('closing sql connection pool ... done')
+
         logger.info('joining multiprocess data fetch queue ...')
         sql_data_fetch_queue.close()
         sql_data_fetch_queue.join_thread()
@@ -844,6 +979,11 @@ def tilequeue_process(cfg, peripherals):
         processor_queue.join_thread()
         logger.info('joining multiprocess process queue ... done')
 
+        if transport_dir:
+            logger.info('removing feature layers transport files ...')
+            shutil.rmtree(transport_dir, ignore_errors=True)
+            logger.info('removing feature layers transport files ... done')
+
         logger.warn('tilequeue processing shutdown ... done')
         sys.exit(0)
 
@@ -1608,6 +1748,12 @@ class FakeStatsd(object):
     def timer(self, *args, **kwargs):
         return FakeStatsTimer()
 
+    def pipeline(self):
+        return self
+
+    def send(self):
+        pass
+
 
 class FakeStatsTimer(object):
     def __init__(self, *args, **kwargs):
@@ -24,6 +24,8 @@ class Configuration(object):
         self.s3_reduced_redundancy = self._cfg('store reduced-redundancy')
         self.s3_path = self._cfg('store path')
         self.s3_date_prefix = self._cfg('store date-prefix')
+        self.written_hashes_cache_size = self._cfg(
+            'store written-hashes-cache-size')
 
         seed_cfg = self.yml['tiles']['seed']
         self.seed_all_zoom_start = seed_cfg['all']['zoom-start']
@@ -100,6 +102,37 @@ class Configuration(object):
         self.reload_templates = process_cfg['reload-templates']
         self.output_formats = process_cfg['formats']
         self.buffer_cfg = process_cfg['buffer']
+        self.batch_queries = process_cfg['batch-queries']
+        self.query_cursor_itersize = process_cfg['query-cursor-itersize']
+        self.columnar_feature_layers = \
+            process_cfg['columnar-feature-layers']
+        self.cut_child_tiles_processes = self._cfg(
+            'process cut-child-tiles processes')
+        self.cut_child_tiles_min_coords = self._cfg(
+            'process cut-child-tiles min-coords')
+        self.feature_layers_transport = self._cfg(
+            'process feature-layers-transport type')
+        self.feature_layers_transport_path = self._cfg(
+            'process feature-layers-transport path')
+        self.query_threads = self._cfg('process query-threads')
+        self.memory_budget_bytes = self._cfg('process memory-budget bytes')
+        self.memory_budget_initial_estimate_bytes = self._cfg(
+            'process memory-budget initial-estimate-bytes')
+        self.adaptive_pipeline = self._cfg('process adaptive enabled')
+        self.adaptive_pipeline_interval_seconds = self._cfg(
+            'process adaptive interval-seconds')
+        self.adaptive_pipeline_max_query_sets = self._cfg(
+            'process adaptive max-query-sets')
+        self.adaptive_pipeline_max_s3_storage = self._cfg(
+            'process adaptive max-s3-storage')
+        self.store_writer_threads = self._cfg(
+            'process store-writer threads')
+        self.store_writer_max_in_flight_bytes = self._cfg(
+            'process store-writer max-in-flight-bytes')
+        self.store_writer_retries = self._cfg(
+            'process store-writer retries')
+        self.store_writer_retry_backoff_seconds = self._cfg(
+            'process store-writer retry-backoff-seconds')
 
         self.postgresql_conn_info = self.yml['postgresql']
         dbnames = self.postgresql_conn_info.get('dbnames')
@@ -108,9 +141,21 @@ class Configuration(object):
             "Expecting postgresql 'dbnames' to be a list"
         assert len(dbnames) > 0, 'No postgresql dbnames configured'
 
+        self.sql_conn_pool_max_conns_per_db = \
+            self._cfg('sql-conn-pool max-conns-per-db')
+        self.sql_conn_pool_max_idle_seconds = \
+            self._cfg('sql-conn-pool max-idle-seconds')
+        self.sql_conn_pool_max_lifetime_seconds = \
+            self._cfg('sql-conn-pool max-lifetime-seconds')
+        self.sql_conn_pool_wait_timeout_seconds = \
+            self._cfg('sql-conn-pool wait-timeout-seconds')
+
         self.wof = self.yml.get('wof')
 
         self.metatile_size = self._cfg('metatile size')
+        self.metatile_deterministic = self._cfg('metatile deterministic')
+        self.metatile_format = self._cfg('metatile format')
+        self.metatile_compress = self._cfg('metatile compress')
         if self.metatile_size is None:
             self.metatile_zoom = 0
         else:
@@ -150,6 +195,7 @@ def default_yml_config():
             'path': 'osm',
             'reduced-redundancy': False,
             'date-prefix': '',
+            'written-hashes-cache-size': 0,
         },
         'aws': {
             'credentials': {
@@ -202,6 +248,34 @@ def default_yml_config():
             'reload-templates': False,
             'formats': ['json'],
             'buffer': {},
+            'batch-queries': False,
+            'query-cursor-itersize': None,
+            'columnar-feature-layers': False,
+            'cut-child-tiles': {
+                'processes': 0,
+                'min-coords': 16,
+            },
+            'feature-layers-transport': {
+                'type': 'queue',
+                'path': None,
+            },
+            'query-threads': 0,
+            'memory-budget': {
+                'bytes': None,
+                'initial-estimate-bytes': None,
+            },
+            'adaptive': {
+                'enabled': False,
+                'interval-seconds': 10,
+                'max-query-sets': 0,
+                'max-s3-storage': 0,
+            },
+            'store-writer': {
+                'threads': 0,
+                'max-in-flight-bytes': None,
+                'retries': 3,
+                'retry-backoff-seconds': 0.5,
+            },
         },
         'logging': {
             'config': None
@@ -220,8 +294,17 @@ def default_yml_config():
             'user': 'osm',
             'password': None,
         },
+        'sql-conn-pool': {
+            'max-conns-per-db': None,
+            'max-idle-seconds': 300,
+            'max-lifetime-seconds': 3600,
+            'wait-timeout-seconds': None,
+        },
         'metatile': {
             'size': None,
+            'deterministic': False,
+            'format': 'zip',
+            'compress': False,
         },
         'queue_buffer_size': {
             'sql': None,
@@ -13,6 +13,8 @@ A parser for the Well Text Binary format of OpenGIS types.
 #
 
 import sys, traceback, struct
+import numpy as np
+from tilequeue.tile import round_half_away_from_zero
 
 
 # based on xdrlib.Unpacker
@@ -145,6 +147,81 @@ class GeomEncoder:
         self._dispatchNextType(reader)
         
 
+    def encodeShape(self, shape):
+        """
+        Encode a shapely geometry directly from its coordinate arrays, giving
+        the same result as parseGeometry on its WKB.
+        """
+
+        self.coordinates = []
+        self.index = []
+        self.isPoly = False
+        self.isPoint = True
+        self.dropped = 0
+
+        parts = []
+        shape_type = shape.type
+        if shape_type == 'Point':
+            parts.append(self._shapeCoords(shape.coords))
+        elif shape_type == 'MultiPoint':
+            # all the points are one part, so repeated points are dropped
+            # between them too.
+            parts.append(self._shapeCoords(
+                [point.coords[0] for point in shape.geoms]))
+        elif shape_type == 'LineString':
+            self.isPoint = False
+            parts.append(self._shapeCoords(shape.coords))
+        elif shape_type == 'MultiLineString':
+            self.isPoint = False
+            for line in shape.geoms:
+                parts.append(self._shapeCoords(line.coords))
+        elif shape_type in ('Polygon', 'MultiPolygon'):
+            self.isPoint = False
+            self.isPoly = True
+            polygons = shape.geoms if shape_type == 'MultiPolygon' \
+                else [shape]
+            for n, polygon in enumerate(polygons):
+                if n > 0:
+                    # polygons are separated by an empty part
+                    parts.append(None)
+                for ring in [polygon.exterior] + list(polygon.interiors):
+                    # skip the closing point
+                    parts.append(self._shapeCoords(ring.coords)[:-1])
+        else:
+            self.parseGeometry(shape.wkb)
+            return
+
+        kept = []
+        for part in parts:
+            if part is None:
+                self.index.append(0)
+                continue
+            # the first point of each part is always kept, others only if
+            # they differ from the point before.
+            keep = np.ones(len(part), dtype=bool)
+            keep[1:] = np.any(part[1:] != part[:-1], axis=1)
+            part = part[keep]
+            self.dropped += len(keep) - len(part)
+            kept.append(part)
+            if not self.isPoint:
+                self.index.append(len(part))
+
+        if not kept:
+            return
+        points = np.concatenate(kept)
+        # each point is relative to the one before, across parts too
+        deltas = np.empty_like(points)
+        deltas[:1] = points[:1]
+        deltas[1:] = points[1:] - points[:-1]
+        self.coordinates = deltas.ravel().tolist()
+
+    def _shapeCoords(self, coords):
+        coords = np.asarray(coords, dtype=np.float64)[:, :2]
+        points = round_half_away_from_zero(coords).astype(np.int64)
+        # flip upside down
+        points[:, 1] = self.tileSize - points[:, 1]
+        return points
+
     def _dispatchNextType(self,reader):
         """
         Read a type id from the binary stream (reader) and call the correct method to parse it.
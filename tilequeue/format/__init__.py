@@ -1,6 +1,6 @@
 from tilequeue.format.geojson import encode_multiple_layers as json_encode_multiple_layers  # noqa
 from tilequeue.format.geojson import encode_single_layer as json_encode_single_layer  # noqa
-from tilequeue.format.mvt import encode as mvt_encode
+from tilequeue.format.mvt import encode_features as mvt_encode_features
 from tilequeue.format.topojson import encode as topojson_encode
 from tilequeue.format.vtm import merge as vtm_encode
 
@@ -30,9 +30,11 @@ class OutputFormat(object):
         return self.extension == other.extension
 
     def format_tile(self, tile_data_file, feature_layers, zoom, bounds_merc,
-                    bounds_lnglat):
+                    bounds_lnglat, format_cache=None):
+        # format_cache is an optional dict, shared between the formats for
+        # the same tile, in which formats can keep work to reuse.
         self.format_fn(tile_data_file, feature_layers, zoom, bounds_merc,
-                       bounds_lnglat)
+                       bounds_lnglat, format_cache)
 
 
 def convert_feature_layers_to_dict(feature_layers):
@@ -47,7 +49,8 @@ def convert_feature_layers_to_dict(feature_layers):
 
 
 # consistent facade around all formatters that we use
-def format_json(fp, feature_layers, zoom, bounds_merc, bounds_lnglat):
+def format_json(fp, feature_layers, zoom, bounds_merc, bounds_lnglat,
+                format_cache=None):
     if len(feature_layers) == 1:
         json_encode_single_layer(fp, feature_layers[0]['features'], zoom)
         return
@@ -56,31 +59,26 @@ def format_json(fp, feature_layers, zoom, bounds_merc, bounds_lnglat):
         json_encode_multiple_layers(fp, features_by_layer, zoom)
 
 
-def format_topojson(fp, feature_layers, zoom, bounds_merc, bounds_lnglat):
+def format_topojson(fp, feature_layers, zoom, bounds_merc, bounds_lnglat,
+                    format_cache=None):
     features_by_layer = convert_feature_layers_to_dict(feature_layers)
     topojson_encode(fp, features_by_layer, bounds_lnglat)
 
 
-def format_mvt(fp, feature_layers, zoom, bounds_merc, bounds_lnglat):
-    mvt_layers = []
-    for feature_layer in feature_layers:
-        mvt_features = []
-        for shape, props, feature_id in feature_layer['features']:
-            mvt_feature = dict(
-                geometry=shape,
-                properties=props,
-                id=feature_id,
-            )
-            mvt_features.append(mvt_feature)
-        mvt_layer = dict(
-            name=feature_layer['name'],
-            features=mvt_features,
-        )
-        mvt_layers.append(mvt_layer)
-    mvt_encode(fp, mvt_layers, bounds_merc)
-
-
-def format_vtm(fp, feature_layers, zoom, bounds_merc, bounds_lnglat):
+def format_mvt(fp, feature_layers, zoom, bounds_merc, bounds_lnglat,
+               format_cache=None):
+    # mvt and mvtb encode the same properties for a tile, and many of the
+    # same shapes, where those clipped for mvtb are within the mvt bounds.
+    attr_cache = geometry_cache = None
+    if format_cache is not None:
+        attr_cache = format_cache.setdefault('mvt_attrs', {})
+        geometry_cache = format_cache.setdefault('mvt_geometries', {})
+    mvt_encode_features(
+        fp, feature_layers, bounds_merc, attr_cache, geometry_cache)
+
+
+def format_vtm(fp, feature_layers, zoom, bounds_merc, bounds_lnglat,
+               format_cache=None):
     vtm_encode(fp, feature_layers)
 
 
@@ -91,7 +89,7 @@ topojson_format = OutputFormat('TopoJSON', 'topojson', 'application/json',
                                format_topojson, 2, supports_shapely_geom)
 # TODO image/png mimetype? app doesn't work unless image/png?
 vtm_format = OutputFormat('OpenScienceMap', 'vtm', 'image/png', format_vtm, 3,
-                          not supports_shapely_geom)
+                          supports_shapely_geom)
 mvt_format = OutputFormat('MVT', 'mvt', 'application/x-protobuf',
                           format_mvt, 4, supports_shapely_geom)
 # buffered mvt - same exact format as mvt, exception for extension and
@@ -101,6 +99,10 @@ mvtb_format = OutputFormat('MVT Buffered', 'mvtb', 'application/x-protobuf',
 # package of tiles as a metatile zip
 zip_format = OutputFormat('ZIP Metatile', 'zip', 'application/zip',
                           None, None, None)
+# package of tiles as a metatile with an index of its members, see
+# tilequeue.metatile.make_multi_indexed_metatile
+indexed_metatile_format = OutputFormat(
+    'Indexed Metatile', 'tqm', 'application/octet-stream', None, None, None)
 
 extension_to_format = dict(
     json=json_format,
@@ -108,7 +110,8 @@ extension_to_format = dict(
     vtm=vtm_format,
     mvt=mvt_format,
     mvtb=mvtb_format,
-    zip=zip_format
+    zip=zip_format,
+    tqm=indexed_metatile_format,
 )
 
 name_to_format = {
@@ -117,7 +120,8 @@ name_to_format = {
     'TopoJSON': topojson_format,
     'MVT': mvt_format,
     'MVT Buffered': mvtb_format,
-    'ZIP Metatile': zip_format
+    'ZIP Metatile': zip_format,
+    'Indexed Metatile': indexed_metatile_format,
 }
 
 
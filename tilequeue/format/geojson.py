@@ -1,5 +1,7 @@
 from math import ceil
 from math import log
+from tilequeue.tile import round_half_away_from_zero
+import numpy as np
 import ujson as json
 import shapely.geometry
 import shapely.ops
@@ -11,14 +13,79 @@ precisions = [int(ceil(log(1 << zoom + 8+2) / log(10)) - 2)
 precisions[16] = 8
 
 
+def _round_coords(coords, precision):
+    scale = 10.0 ** precision
+    coords = np.asarray(coords, dtype=np.float64)[:, :2]
+    return round_half_away_from_zero(coords * scale) / scale
+
+
+def _round_polygon(polygon, precision):
+    return [_round_coords(ring.coords, precision)
+            for ring in [polygon.exterior] + list(polygon.interiors)]
+
+
+def trim_precision(shape, precision):
+    """
+    Round the coordinates of the shape to precision decimal places, working
+    on arrays of the coordinates rather than each coordinate in turn.
+
+    Returns the rounded shape, or None where rounding can't change the
+    validity of the shape, and its GeoJSON geometry.
+    """
+
+    # empty shapes have no coordinates to round
+    if shape.is_empty:
+        return None, shape.__geo_interface__
+
+    shape_type = shape.type
+    if shape_type == 'Point':
+        coords = _round_coords(shape.coords, precision)[0]
+        return None, dict(type='Point', coordinates=coords.tolist())
+
+    elif shape_type == 'MultiPoint':
+        coords = _round_coords(
+            [point.coords[0] for point in shape.geoms], precision)
+        return None, dict(type='MultiPoint', coordinates=coords.tolist())
+
+    elif shape_type == 'LineString':
+        coords = _round_coords(shape.coords, precision)
+        return (shapely.geometry.LineString(coords),
+                dict(type='LineString', coordinates=coords.tolist()))
+
+    elif shape_type == 'MultiLineString':
+        lines = [_round_coords(line.coords, precision)
+                 for line in shape.geoms]
+        return (shapely.geometry.MultiLineString(lines),
+                dict(type='MultiLineString',
+                     coordinates=[line.tolist() for line in lines]))
+
+    elif shape_type == 'Polygon':
+        rings = _round_polygon(shape, precision)
+        return (shapely.geometry.Polygon(rings[0], rings[1:]),
+                dict(type='Polygon',
+                     coordinates=[ring.tolist() for ring in rings]))
+
+    elif shape_type == 'MultiPolygon':
+        polygons = [_round_polygon(polygon, precision)
+                    for polygon in shape.geoms]
+        return (shapely.geometry.MultiPolygon(
+                    [(rings[0], rings[1:]) for rings in polygons]),
+                dict(type='MultiPolygon',
+                     coordinates=[[ring.tolist() for ring in rings]
+                                  for rings in polygons]))
+
+    else:
+        rounded_shape = shapely.ops.transform(
+            lambda x, y, z=None: (round(x, precision), round(y, precision)),
+            shape)
+        return rounded_shape, rounded_shape.__geo_interface__
+
+
 class JsonFeatureCreator(object):
 
     def __init__(self, precision=None):
         self.precision = precision
 
-    def _trim_precision(self, x, y, z=None):
-        return round(x, self.precision), round(y, self.precision)
-
     def __call__(self, feature):
         assert len(feature) == 3
         wkb_or_shape, props, fid = feature
@@ -27,13 +94,16 @@ class JsonFeatureCreator(object):
         else:
             shape = shapely.wkb.loads(wkb_or_shape)
 
+        geometry = None
         if self.precision:
-            truncated_precision_shape = shapely.ops.transform(
-                self._trim_precision, shape)
-            if truncated_precision_shape.is_valid:
-                shape = truncated_precision_shape
-
-        geometry = shape.__geo_interface__
+            truncated_precision_shape, truncated_geometry = trim_precision(
+                shape, self.precision)
+            if truncated_precision_shape is None or \
+               truncated_precision_shape.is_valid:
+                geometry = truncated_geometry
+
+        if geometry is None:
+            geometry = shape.__geo_interface__
         result = dict(type='Feature', properties=props, geometry=geometry)
         if fid is not None:
             result['id'] = fid
@@ -53,6 +123,20 @@ def precision_for_zoom(zoom):
     return precision
 
 
+def write_layer_feature_collection(out, features, precision):
+    """
+    Write the features to out as a GeoJSON FeatureCollection, one feature
+    at a time, rather than building the whole collection first.
+    """
+    create_json_feature = JsonFeatureCreator(precision)
+    out.write('{"type":"FeatureCollection","features":[')
+    for i, feature in enumerate(features):
+        if i:
+            out.write(',')
+        json.dump(create_json_feature(feature), out)
+    out.write(']}')
+
+
 def encode_single_layer(out, features, zoom):
     """
     Encode a list of (WKB|shapely, property dict, id) features into a
@@ -63,8 +147,7 @@ def encode_single_layer(out, features, zoom):
     Geometries in the features list are assumed to be lon, lats.
     """
     precision = precision_for_zoom(zoom)
-    fs = create_layer_feature_collection(features, precision)
-    json.dump(fs, out)
+    write_layer_feature_collection(out, features, precision)
 
 
 def encode_multiple_layers(out, features_by_layer, zoom):
@@ -72,8 +155,11 @@ def encode_multiple_layers(out, features_by_layer, zoom):
     features_by_layer should be a dict: layer_name -> feature tuples
     """
     precision = precision_for_zoom(zoom)
-    geojson = {}
-    for layer_name, features in features_by_layer.items():
-        fs = create_layer_feature_collection(features, precision)
-        geojson[layer_name] = fs
-    json.dump(geojson, out)
+    out.write('{')
+    for i, (layer_name, features) in enumerate(features_by_layer.items()):
+        if i:
+            out.write(',')
+        json.dump(layer_name, out)
+        out.write(':')
+        write_layer_feature_collection(out, features, precision)
+    out.write('}')
@@ -1,5 +1,328 @@
-from mapbox_vector_tile.encoder import on_invalid_geometry_make_valid
 from mapbox_vector_tile import encode as mvt_encode
+from mapbox_vector_tile.encoder import on_invalid_geometry_make_valid
+from mapbox_vector_tile.encoder import VectorTile
+from numbers import Number
+from shapely.geometry import LineString
+from shapely.geometry import MultiLineString
+from shapely.geometry import MultiPoint
+from shapely.geometry import MultiPolygon
+from shapely.geometry import Point
+from shapely.geometry import Polygon
+from tilequeue.tile import round_half_away_from_zero
+import numpy as np
+
+
+CMD_MOVE_TO = 1
+CMD_LINE_TO = 2
+CMD_SEG_END = 7
+
+
+def _command(cmd, length):
+    return (length << 3) | (cmd & 0x7)
+
+
+def _zigzag(deltas):
+    return (deltas << 1) ^ (deltas >> 31)
+
+
+def _transform_coords(fn, shape):
+    shape_type = shape.type
+    if shape_type == 'Point':
+        return Point(fn(shape.coords)[0])
+    elif shape_type == 'LineString':
+        return LineString(fn(shape.coords))
+    elif shape_type == 'Polygon':
+        return Polygon(fn(shape.exterior.coords),
+                       [fn(ring.coords) for ring in shape.interiors])
+    elif shape_type == 'MultiPoint':
+        return MultiPoint(fn([p.coords[0] for p in shape.geoms]))
+    elif shape_type == 'MultiLineString':
+        return MultiLineString([fn(line.coords) for line in shape.geoms])
+    elif shape_type == 'MultiPolygon':
+        return MultiPolygon([_transform_coords(fn, p) for p in shape.geoms])
+    else:
+        raise ValueError('Cannot encode unknown geometry type: %s' %
+                         shape_type)
+
+
+class GeometryEncoder(object):
+    """
+    Encodes geometry to MVT commands from arrays of the coordinates of each
+    line or ring, giving the same commands as mapbox_vector_tile's encoder.
+    """
+
+    def __init__(self, y_coord_down, extents):
+        self.y_coord_down = y_coord_down
+        self.extents = extents
+        self.geometry = []
+        self.last = np.zeros(2, dtype=np.int64)
+
+    def points_on_grid(self, coords):
+        points = round_half_away_from_zero(
+            np.asarray(coords, dtype=np.float64)[:, :2]).astype(np.int64)
+        if not self.y_coord_down:
+            points[:, 1] = self.extents - points[:, 1]
+        return points
+
+    def encode_arc(self, points):
+        # returns False, without adding anything, if the arc doesn't have at
+        # least two distinct points.
+        deltas = np.empty_like(points)
+        deltas[0] = points[0] - self.last
+        deltas[1:] = points[1:] - points[:-1]
+        line_deltas = deltas[1:][np.any(deltas[1:] != 0, axis=1)]
+        if not len(line_deltas):
+            return False
+        move_x, move_y = _zigzag(deltas[0]).tolist()
+        self.geometry.extend((
+            _command(CMD_MOVE_TO, 1), move_x, move_y,
+            _command(CMD_LINE_TO, len(line_deltas))))
+        self.geometry.extend(_zigzag(line_deltas).ravel().tolist())
+        self.last = points[-1]
+        return True
+
+    def encode_ring(self, ring):
+        # rings are closed implicitly, so the last point is left out
+        if not self.encode_arc(self.points_on_grid(ring.coords)[:-1]):
+            return False
+        self.geometry.append(_command(CMD_SEG_END, 1))
+        return True
+
+    def encode_polygon(self, polygon):
+        if not self.encode_ring(polygon.exterior):
+            return
+        for ring in polygon.interiors:
+            self.encode_ring(ring)
+
+    def encode(self, shape):
+        shape_type = shape.type
+        if shape_type in ('Point', 'MultiPoint'):
+            if shape_type == 'Point':
+                coords = shape.coords
+            else:
+                coords = [point.coords[0] for point in shape.geoms]
+            points = self.points_on_grid(coords)
+            deltas = np.empty_like(points)
+            deltas[0] = points[0]
+            deltas[1:] = points[1:] - points[:-1]
+            self.geometry = [_command(CMD_MOVE_TO, len(points))]
+            self.geometry.extend(_zigzag(deltas).ravel().tolist())
+        elif shape_type == 'LineString':
+            self.encode_arc(self.points_on_grid(shape.coords))
+        elif shape_type == 'MultiLineString':
+            for line in shape.geoms:
+                self.encode_arc(self.points_on_grid(line.coords))
+        elif shape_type == 'Polygon':
+            self.encode_polygon(shape)
+        elif shape_type == 'MultiPolygon':
+            for polygon in shape.geoms:
+                self.encode_polygon(polygon)
+        elif shape_type != 'GeometryCollection':
+            raise NotImplementedError("Can't do %s geometries" % shape_type)
+        return self.geometry
+
+
+class TileVectorTile(VectorTile):
+    """
+    VectorTile which takes tilequeue's (shape, props, id) features, and
+    quantises and encodes each geometry with arrays of its coordinates
+    rather than a Python call per coordinate.
+
+    The shapes coming out of processing and clipping are already valid, so
+    polygons are oriented and checked for validity once, after they have
+    been quantised. Only those which quantising made invalid go through
+    mapbox_vector_tile's per part checks and make valid handling.
+
+    The attr_cache dict keeps the protobuf value for each property, and
+    the geometry_cache dict the encoded geometry for each shape, and both
+    can be shared between the mvt and mvtb encodings of a tile.
+
+    This relies on internals of mapbox_vector_tile's VectorTile, so the
+    library is pinned to a version the tiles are tested to be identical
+    with, and the internals used are checked by the tests.
+    """
+
+    def __init__(self, extents, attr_cache=None, geometry_cache=None):
+        VectorTile.__init__(
+            self, extents, on_invalid_geometry_make_valid, round_fn=round)
+        self.attr_cache = {} if attr_cache is None else attr_cache
+        self.geometry_cache = {} if geometry_cache is None else geometry_cache
+
+    def addFeatures(self, features, layer_name='',
+                    quantize_bounds=None, y_coord_down=False):
+        self.layer = self.tile.layers.add()
+        self.layer.name = layer_name
+        self.layer.version = 1
+        self.layer.extent = self.extents
+
+        self.key_idx = 0
+        self.val_idx = 0
+        self.seen_keys_idx = {}
+        self.seen_values_idx = {}
+        self.seen_values_bool_idx = {}
+
+        if quantize_bounds:
+            quantize_bounds = tuple(quantize_bounds)
+
+        for shape, props, fid in features:
+            if shape is None or shape.is_empty:
+                continue
+
+            encoded = self.encodeGeometry(
+                shape, quantize_bounds, y_coord_down)
+            if encoded is not None:
+                feature_type, geometry = encoded
+                self.addTileFeature(feature_type, geometry, props, fid)
+
+    def encodeGeometry(self, shape, quantize_bounds, y_coord_down):
+        """
+        Return the feature type and geometry commands for the shape, or
+        None if nothing is left of it once quantised.
+        """
+
+        # the shape is kept in the cache with its encoding, so its id can't
+        # be reused by another shape while the cache is alive.
+        cache_key = id(shape), quantize_bounds, y_coord_down
+        cached = self.geometry_cache.get(cache_key)
+        if cached is not None and cached[0] is shape:
+            return cached[1]
+
+        encoded = None
+        if not quantize_bounds:
+            quantized_shape = self.enforce_winding_order(shape, y_coord_down)
+        else:
+            quantized_shape = self.quantize_and_orient(
+                shape, quantize_bounds, y_coord_down)
+            if quantized_shape.type in ('Polygon', 'MultiPolygon') and \
+               not quantized_shape.is_valid:
+                quantized_shape = self.enforce_winding_order(
+                    quantized_shape, y_coord_down)
+
+        if quantized_shape is not None and not quantized_shape.is_empty:
+            geom_encoder = GeometryEncoder(y_coord_down, self.extents)
+            geometry = geom_encoder.encode(quantized_shape)
+            feature_type = self._get_feature_type(quantized_shape)
+            # Don't add geometry if it's too small
+            if len(geometry) > 0:
+                encoded = feature_type, geometry
+
+        self.geometry_cache[cache_key] = shape, encoded
+        return encoded
+
+    def quantize_and_orient(self, shape, bounds, y_coord_down):
+        """
+        Quantise the shape to the bounds, and orient its rings in the same
+        way that enforce_winding_order does.
+        """
+
+        minx, miny, maxx, maxy = bounds
+        xfac = self.extents / (maxx - minx)
+        yfac = self.extents / (maxy - miny)
+
+        def quantize(coords):
+            coords = np.asarray(coords, dtype=np.float64)
+            xs = round_half_away_from_zero(xfac * (coords[:, 0] - minx))
+            ys = round_half_away_from_zero(yfac * (coords[:, 1] - miny))
+            return np.column_stack((xs, ys))
+
+        sign = 1.0 if y_coord_down else -1.0
+
+        def quantize_ring(coords, exterior):
+            ring = quantize(coords)
+            # the coordinates are whole numbers, so the area is exact and
+            # has the same sign as shapely's signed_area would give.
+            xs, ys = ring[:, 0], ring[:, 1]
+            area = sign * (np.dot(xs[:-1], ys[1:]) - np.dot(xs[1:], ys[:-1]))
+            if (exterior and area < 0) or (not exterior and area > 0):
+                ring = ring[::-1]
+            return ring
+
+        def quantize_polygon(polygon):
+            return Polygon(
+                quantize_ring(polygon.exterior.coords, True),
+                [quantize_ring(ring.coords, False)
+                 for ring in polygon.interiors])
+
+        if shape.type == 'Polygon':
+            return quantize_polygon(shape)
+        elif shape.type == 'MultiPolygon':
+            parts = [quantize_polygon(part) for part in shape.geoms]
+            if len(parts) == 1:
+                return parts[0]
+            return MultiPolygon(parts)
+        return _transform_coords(quantize, shape)
+
+    def addTileFeature(self, feature_type, geometry, props, fid):
+        f = self.layer.features.add()
+
+        if fid is not None:
+            if isinstance(fid, Number) and fid >= 0:
+                f.id = fid
+
+        if props is not None:
+            self._handle_attr(self.layer, f, props)
+
+        f.type = feature_type
+        f.geometry.extend(geometry)
+
+    def _attr(self, k, v):
+        if not self._can_handle_attr(k, v):
+            return None
+
+        if isinstance(k, str):
+            k = k.decode('utf-8')
+
+        if isinstance(v, bool):
+            field = 'bool_value'
+        elif isinstance(v, str):
+            field = 'string_value'
+            v = v.decode('utf-8')
+        elif isinstance(v, unicode):
+            field = 'string_value'
+        elif isinstance(v, (int, long)):
+            field = 'int_value'
+        else:
+            field = 'double_value'
+
+        return k, field, v
+
+    def _handle_attr(self, layer, feature, props):
+        for k, v in props.items():
+            # values which compare equal can still be encoded differently,
+            # for example True and 1, so the type is part of the key.
+            attr_key = k, type(v), v
+            try:
+                attr = self.attr_cache.get(attr_key, False)
+            except TypeError:
+                # unhashable values can't be encoded anyway
+                continue
+            if attr is False:
+                attr = self.attr_cache[attr_key] = self._attr(k, v)
+            if attr is None:
+                continue
+
+            key, field, value = attr
+
+            key_idx = self.seen_keys_idx.get(key)
+            if key_idx is None:
+                layer.keys.append(key)
+                key_idx = self.seen_keys_idx[key] = self.key_idx
+                self.key_idx += 1
+            feature.tags.append(key_idx)
+
+            if field == 'bool_value':
+                values_idx = self.seen_values_bool_idx
+            else:
+                values_idx = self.seen_values_idx
+
+            # keyed by the original value, as mapbox_vector_tile does
+            val_idx = values_idx.get(v)
+            if val_idx is None:
+                val_idx = values_idx[v] = self.val_idx
+                self.val_idx += 1
+                val = layer.values.add()
+                setattr(val, field, value)
+            feature.tags.append(val_idx)
 
 
 def encode(fp, feature_layers, bounds_merc):
@@ -10,3 +333,18 @@ def encode(fp, feature_layers, bounds_merc):
         round_fn=round,
     )
     fp.write(tile)
+
+
+def encode_features(fp, feature_layers, bounds_merc, attr_cache=None,
+                    geometry_cache=None):
+    """
+    Encode the (shape, props, id) features in each of the feature layers
+    to an MVT tile, quantising to bounds_merc, and write it to fp. This
+    gives the same tile as encode does for the same features as dicts.
+    """
+
+    tile = TileVectorTile(4096, attr_cache, geometry_cache)
+    for feature_layer in feature_layers:
+        tile.addFeatures(
+            feature_layer['features'], feature_layer['name'], bounds_merc)
+    fp.write(tile.tile.SerializeToString())
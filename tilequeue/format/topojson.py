@@ -1,68 +1,194 @@
+from tilequeue.tile import round_half_away_from_zero
+import numpy as np
 import ujson as json
 
 
-def update_arc_indexes(geometry, merged_arcs, old_arcs):
-    """ Updated geometry arc indexes, and add arcs to merged_arcs along the way.
-
-        Arguments are modified in-place, and nothing is returned.
-    """
-    if geometry['type'] in ('Point', 'MultiPoint'):
-        return
-
-    elif geometry['type'] == 'LineString':
-        for arc_index, old_arc in enumerate(geometry['arcs']):
-            geometry['arcs'][arc_index] = len(merged_arcs)
-            merged_arcs.append(old_arcs[old_arc])
-
-    elif geometry['type'] == 'Polygon':
-        for ring in geometry['arcs']:
-            for arc_index, old_arc in enumerate(ring):
-                ring[arc_index] = len(merged_arcs)
-                merged_arcs.append(old_arcs[old_arc])
-
-    elif geometry['type'] == 'MultiLineString':
-        for part in geometry['arcs']:
-            for arc_index, old_arc in enumerate(part):
-                part[arc_index] = len(merged_arcs)
-                merged_arcs.append(old_arcs[old_arc])
-
-    elif geometry['type'] == 'MultiPolygon':
-        for part in geometry['arcs']:
-            for ring in part:
-                for arc_index, old_arc in enumerate(ring):
-                    ring[arc_index] = len(merged_arcs)
-                    merged_arcs.append(old_arcs[old_arc])
-
-    else:
-        raise NotImplementedError("Can't do %s geometries" % geometry['type'])
-
-
-def get_transform(bounds, size=4096):
-    """ Return a TopoJSON transform dictionary and a point-transforming function.
-
-        Size is the tile size in pixels and sets the implicit output
-        resolution.
+def get_array_transform(bounds, size=4096):
+    """ Return a TopoJSON transform dictionary and a function which
+        transforms an array of coordinates to TopoJSON integer space.
     """
     tx, ty = bounds[0], bounds[1]
     sx, sy = (bounds[2] - bounds[0]) / size, (bounds[3] - bounds[1]) / size
 
-    def forward(lon, lat):
-        """ Transform a longitude and latitude to TopoJSON integer space.
-        """
-        return int(round((lon - tx) / sx)), int(round((lat - ty) / sy))
+    def forward(coords):
+        coords = np.asarray(coords, dtype=np.float64)
+        result = np.empty((len(coords), 2), dtype=np.int64)
+        result[:, 0] = round_half_away_from_zero((coords[:, 0] - tx) / sx)
+        result[:, 1] = round_half_away_from_zero((coords[:, 1] - ty) / sy)
+        return result
 
     return dict(translate=(tx, ty), scale=(sx, sy)), forward
 
 
-def diff_encode(line, transform):
-    """ Differentially encode a shapely linestring or ring.
+def _remove_repeated_points(points):
+    if len(points) < 2:
+        return points
+    keep = np.empty(len(points), dtype=bool)
+    keep[0] = True
+    np.any(points[1:] != points[:-1], axis=1, out=keep[1:])
+    return points[keep]
+
+
+def _point_keys(points):
+    """ Return an array with a single value for each row of (x, y) points,
+        so that points can be compared and sorted as a whole.
     """
-    coords = [transform(x, y) for (x, y) in line.coords]
+    xs, ys = points[:, 0], points[:, 1]
+    min_x, min_y = int(xs.min()), int(ys.min())
+    height = int(ys.max()) - min_y + 1
+    if (int(xs.max()) - min_x + 1) * height < 2 ** 62:
+        return (xs - min_x) * height + (ys - min_y)
+
+    # too far apart to pack into an integer, so fall back to viewing each
+    # row as an opaque value, which is much slower to sort.
+    points = np.ascontiguousarray(points)
+    return points.view(np.dtype((np.void, points.dtype.itemsize * 2))).ravel()
+
+
+def find_junctions(lines):
+    """ Return a list with a boolean array for each line, which is True
+        for each point of the line at which arcs must be cut, so that
+        boundaries shared between lines and rings become separate arcs
+        which can be shared.
+
+        lines is a list of (points, is_ring) with points as an array of
+        integer coordinates, and rings closed. A point is a junction if it
+        is the end of a line, or if it is reached from different
+        neighbouring points in different places, which is where shared
+        boundaries begin and end.
+    """
+    if not lines:
+        return []
+
+    lengths = np.array([len(line[0]) for line in lines])
+    is_ring = np.array([line[1] for line in lines], dtype=bool)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+
+    all_points = np.concatenate([line[0] for line in lines])
+    unique_keys, ids = np.unique(_point_keys(all_points), return_inverse=True)
+    n_unique = len(unique_keys)
+
+    prev_ids = np.empty_like(ids)
+    prev_ids[1:] = ids[:-1]
+    next_ids = np.empty_like(ids)
+    next_ids[:-1] = ids[1:]
+
+    # the neighbours of the first point of a ring wrap around to the end
+    # of the ring, and the closing point is the same as the first.
+    ring_starts = starts[is_ring & (lengths > 1)]
+    ring_ends = ends[is_ring & (lengths > 1)]
+    prev_ids[ring_starts] = ids[ring_ends - 2]
+    in_core = np.ones(len(ids), dtype=bool)
+    in_core[ends[is_ring] - 1] = False
+
+    # the ends of lines are always junctions
+    is_junction = np.zeros(n_unique, dtype=bool)
+    line_starts = starts[~is_ring]
+    line_ends = ends[~is_ring] - 1
+    is_junction[ids[line_starts]] = True
+    is_junction[ids[line_ends]] = True
+    in_core[line_starts] = False
+    in_core[line_ends] = False
+
+    point_ids = ids[in_core]
+    prev_ids = prev_ids[in_core]
+    next_ids = next_ids[in_core]
+
+    # the neighbours of a point are the same whichever way a shared
+    # boundary is walked, so their order doesn't matter.
+    pair_keys = (np.minimum(prev_ids, next_ids) * n_unique +
+                 np.maximum(prev_ids, next_ids))
+
+    order = np.lexsort((pair_keys, point_ids))
+    point_ids = point_ids[order]
+    pair_keys = pair_keys[order]
+    differs = ((point_ids[1:] == point_ids[:-1]) &
+               (pair_keys[1:] != pair_keys[:-1]))
+    is_junction[point_ids[1:][differs]] = True
+
+    line_is_junction = is_junction[ids]
+    return [line_is_junction[start:end]
+            for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def _least_point_index(points):
+    return np.lexsort((points[:, 1], points[:, 0]))[0]
+
+
+def _rotate_ring(points, start):
+    # points is closed, so the rotated ring has to be closed again.
+    return np.concatenate((points[start:-1], points[:start + 1]))
+
+
+def cut_lines(lines, junctions):
+    """ Cut each of the lines at the junctions, as returned by
+        find_junctions, returning a list of the arcs for each line, each
+        arc being an array of points.
+
+        Rings which have no junctions are a single closed arc, rotated to
+        start at their least point, so that identical rings are identical
+        arcs whichever point they start at.
+    """
+    cut = []
+    for (points, is_ring), is_junction in zip(lines, junctions):
+        if len(points) < 2:
+            cut.append([points])
+            continue
+
+        indexes = np.flatnonzero(is_junction[:-1] if is_ring else is_junction)
+        if is_ring:
+            if not len(indexes):
+                least = _least_point_index(points[:-1])
+                cut.append([_rotate_ring(points, least)])
+                continue
+            points = _rotate_ring(points, indexes[0])
+            indexes = np.append(indexes - indexes[0], len(points) - 1)
 
-    pairs = zip(coords[:], coords[1:])
-    diffs = [(x2 - x1, y2 - y1) for ((x1, y1), (x2, y2)) in pairs]
+        indexes = indexes.tolist()
+        cut.append([points[start:end + 1]
+                    for start, end in zip(indexes, indexes[1:])])
+    return cut
 
-    return coords[:1] + [(x, y) for (x, y) in diffs if (x, y) != (0, 0)]
+
+class ArcIndex(object):
+    """ Keeps the unique arcs, returning the TopoJSON index of each arc
+        added, which is negative (one's complement) where it is the reverse
+        of an arc already added.
+    """
+
+    def __init__(self):
+        self.arcs = []
+        self.indexes = {}
+
+    def add(self, points, is_closed_ring=False):
+        key = points.tobytes()
+        index = self.indexes.get(key)
+        if index is not None:
+            return index
+
+        reversed_points = points[::-1]
+        if is_closed_ring and len(points) > 1:
+            start = _least_point_index(reversed_points[:-1])
+            reversed_points = _rotate_ring(reversed_points, start)
+        index = self.indexes.get(reversed_points.tobytes())
+        if index is not None:
+            return ~index
+
+        index = len(self.arcs)
+        self.arcs.append(points)
+        self.indexes[key] = index
+        return index
+
+
+def delta_encode(points):
+    """ Differentially encode an array of integer points as a list of
+        [x, y] lists.
+    """
+    deltas = np.empty_like(points)
+    deltas[:1] = points[:1]
+    deltas[1:] = points[1:] - points[:-1]
+    return deltas.tolist()
 
 
 def encode(file, features_by_layer, bounds):
@@ -74,9 +200,25 @@ def encode(file, features_by_layer, bounds):
         Geometries in the features list are assumed to be unprojected
         lon, lats.  Bounds are given in geographic coordinates as
         (xmin, ymin, xmax, ymax).
+
+        Boundaries shared between lines and rings, in any layer, are
+        encoded once as a shared arc.
     """
-    transform, forward = get_transform(bounds)
-    arcs = []
+    transform, forward = get_array_transform(bounds)
+
+    # the lines and rings of all the geometries are collected first, with
+    # the geometries referring to them by index in place of their arcs,
+    # so that shared boundaries can be found between all of them.
+    lines = []
+
+    def add_line(line, is_ring):
+        points = _remove_repeated_points(forward(line.coords))
+        lines.append((points, is_ring))
+        return len(lines) - 1
+
+    def add_polygon(polygon):
+        rings = [polygon.exterior] + list(polygon.interiors)
+        return [add_line(ring, True) for ring in rings]
 
     geometries_by_layer = {}
 
@@ -91,49 +233,34 @@ def encode(file, features_by_layer, bounds):
             if fid is not None:
                 geometry['id'] = fid
 
-            elif shape.type == 'Point':
+            if shape.type == 'Point':
                 geometry.update(dict(
                     type='Point',
-                    coordinates=forward(shape.x, shape.y)))
+                    coordinates=forward(shape.coords)[0].tolist()))
 
             elif shape.type == 'LineString':
-                geometry.update(dict(type='LineString', arcs=[len(arcs)]))
-                arcs.append(diff_encode(shape, forward))
+                geometry.update(dict(
+                    type='LineString', arcs=add_line(shape, False)))
 
             elif shape.type == 'Polygon':
-                geometry.update(dict(type='Polygon', arcs=[]))
-
-                rings = [shape.exterior] + list(shape.interiors)
-
-                for ring in rings:
-                    geometry['arcs'].append([len(arcs)])
-                    arcs.append(diff_encode(ring, forward))
+                geometry.update(dict(
+                    type='Polygon', arcs=add_polygon(shape)))
 
             elif shape.type == 'MultiPoint':
-                geometry.update(dict(type='MultiPoint', coordinates=[]))
-
-                for point in shape.geoms:
-                    geometry['coordinates'].append(forward(point.x, point.y))
+                geometry.update(dict(
+                    type='MultiPoint',
+                    coordinates=forward(
+                        [point.coords[0] for point in shape.geoms]).tolist()))
 
             elif shape.type == 'MultiLineString':
-                geometry.update(dict(type='MultiLineString', arcs=[]))
-
-                for line in shape.geoms:
-                    geometry['arcs'].append([len(arcs)])
-                    arcs.append(diff_encode(line, forward))
+                geometry.update(dict(
+                    type='MultiLineString',
+                    arcs=[add_line(line, False) for line in shape.geoms]))
 
             elif shape.type == 'MultiPolygon':
-                geometry.update(dict(type='MultiPolygon', arcs=[]))
-
-                for polygon in shape.geoms:
-                    rings = [polygon.exterior] + list(polygon.interiors)
-                    polygon_arcs = []
-
-                    for ring in rings:
-                        polygon_arcs.append([len(arcs)])
-                        arcs.append(diff_encode(ring, forward))
-
-                    geometry['arcs'].append(polygon_arcs)
+                geometry.update(dict(
+                    type='MultiPolygon',
+                    arcs=[add_polygon(polygon) for polygon in shape.geoms]))
 
             else:
                 raise NotImplementedError("Can't do %s geometries" %
@@ -146,11 +273,36 @@ def encode(file, features_by_layer, bounds):
             geometries=geometries,
         )
 
-    result = dict(
-        type='Topology',
-        transform=transform,
-        objects=geometries_by_layer,
-        arcs=arcs,
-    )
-
-    json.dump(result, file)
+    junctions = find_junctions(lines)
+    cut = cut_lines(lines, junctions)
+
+    arc_index = ArcIndex()
+    line_arcs = []
+    for (points, is_ring), line_cut in zip(lines, cut):
+        is_closed_ring = is_ring and len(line_cut) == 1
+        line_arcs.append([arc_index.add(arc, is_closed_ring)
+                          for arc in line_cut])
+
+    for geometries in geometries_by_layer.itervalues():
+        for geometry in geometries['geometries']:
+            geometry_type = geometry['type']
+            if geometry_type == 'LineString':
+                geometry['arcs'] = line_arcs[geometry['arcs']]
+            elif geometry_type in ('Polygon', 'MultiLineString'):
+                geometry['arcs'] = [line_arcs[i] for i in geometry['arcs']]
+            elif geometry_type == 'MultiPolygon':
+                geometry['arcs'] = [[line_arcs[i] for i in part]
+                                    for part in geometry['arcs']]
+
+    # the arcs are usually the bulk of the tile, so they are written out
+    # one at a time rather than building the whole document first.
+    file.write('{"type":"Topology","transform":')
+    json.dump(transform, file)
+    file.write(',"objects":')
+    json.dump(geometries_by_layer, file)
+    file.write(',"arcs":[')
+    for i, arc in enumerate(arc_index.arcs):
+        if i:
+            file.write(',')
+        json.dump(delta_encode(arc), file)
+    file.write(']}')
@@ -5,6 +5,7 @@ from OSciMap4.GeomEncoder import GeomEncoder
 from OSciMap4.StaticVals import getValues
 from OSciMap4.StaticKeys import getKeys
 from OSciMap4.TagRewrite import fixTag
+from shapely.geometry.base import BaseGeometry
 import logging
 import struct
 
@@ -69,6 +70,10 @@ class VectorTile:
         self.tagdict = {}
         self.num_tags = 0
 
+        # the same properties are repeated across many features, so the
+        # result of mapping each one to a tag is kept for the tile.
+        self.propdict = {}
+
         self.out = TileData_v4_pb2.Data()
         self.out.version = 4
 
@@ -100,33 +105,34 @@ class VectorTile:
             if v is None:
                 continue
 
-            # the vtm stylesheet expects the heights to be an integer,
-            # multiplied by 100
-            if this_layer == 'buildings' and k in ('height', 'min_height'):
-                try:
-                    v = int(v * 100)
-                except ValueError:
-                    logging.warning('vtm: Invalid %s value: %s' % (k, v))
-
-            tag = str(k), str(v)
-
-            # use unsigned int for layer. i.e. map to 0..10
-            if "layer" == tag[0]:
-                layer = self.getLayer(tag[1])
-                continue
-
-            tag = fixTag(tag)
-
-            if tag is None:
-                continue
-
-            tags.append(self.getTagId(tag))
+            # values which compare equal can still be written differently,
+            # for example True and 1, so the type is part of the key.
+            prop_key = this_layer, k, type(v), v
+            try:
+                prop = self.propdict.get(prop_key)
+            except TypeError:
+                # unhashable values can't be cached
+                prop_key = None
+                prop = None
+            if prop is None:
+                prop = self.getPropTag(this_layer, k, v)
+                if prop_key is not None:
+                    self.propdict[prop_key] = prop
+
+            prop_type, prop_value = prop
+            if prop_type == 'layer':
+                layer = prop_value
+            elif prop_type == 'tag':
+                tags.append(prop_value)
 
         if len(tags) == 0:
             logging.debug('missing tags')
             return
 
-        geom.parseGeometry(row[0])
+        if isinstance(row[0], BaseGeometry):
+            geom.encodeShape(row[0])
+        else:
+            geom.parseGeometry(row[0])
         feature = None
 
         geometry_type = None
@@ -175,6 +181,34 @@ class VectorTile:
 
         # logging.debug('tags %d, indices %d' %(len(tags),len(feature.indices)))  # noqa
 
+    def getPropTag(self, this_layer, k, v):
+        '''
+        Return ('layer', osm layer) for the layer property, ('tag', tag id)
+        for properties which are encoded as tags and (None, None) for those
+        which are dropped.
+        '''
+
+        # the vtm stylesheet expects the heights to be an integer,
+        # multiplied by 100
+        if this_layer == 'buildings' and k in ('height', 'min_height'):
+            try:
+                v = int(v * 100)
+            except ValueError:
+                logging.warning('vtm: Invalid %s value: %s' % (k, v))
+
+        tag = str(k), str(v)
+
+        # use unsigned int for layer. i.e. map to 0..10
+        if "layer" == tag[0]:
+            return 'layer', self.getLayer(tag[1])
+
+        tag = fixTag(tag)
+
+        if tag is None:
+            return None, None
+
+        return 'tag', self.getTagId(tag)
+
     def getLayer(self, val):
         try:
             l = max(min(10, int(val)) + 5, 0)
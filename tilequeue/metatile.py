@@ -1,16 +1,31 @@
 import zipfile
 import cStringIO as StringIO
+import hashlib
+import struct
+import zlib
+from bisect import bisect_left
 from collections import defaultdict
+from tilequeue.format import indexed_metatile_format
 from tilequeue.format import zip_format
 from time import gmtime
 
 
-def make_multi_metatile(parent, tiles, date_time=None):
+# timestamp of the members of deterministic metatiles. this is the earliest
+# time which can be stored in a zip file.
+DETERMINISTIC_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def make_multi_metatile(parent, tiles, date_time=None, deterministic=False):
     """
     Make a metatile containing a list of tiles all having the same layer,
     with coordinates relative to the given parent. Set date_time to a 6-tuple
     of (year, month, day, hour, minute, second) to set the timestamp for
     members. Otherwise the current wall clock time is used.
+
+    If deterministic is True, the members are written in order of their
+    names, with fixed attributes, and with DETERMINISTIC_DATE_TIME unless
+    date_time is given, so that metatiles of the same tiles are byte-wise
+    identical and can be compared by the hash of their data.
     """
 
     assert parent is not None, \
@@ -20,44 +35,144 @@ def make_multi_metatile(parent, tiles, date_time=None):
         return []
 
     if date_time is None:
-        date_time = gmtime()[0:6]
+        if deterministic:
+            date_time = DETERMINISTIC_DATE_TIME
+        else:
+            date_time = gmtime()[0:6]
 
     layer = tiles[0]['layer']
 
+    members = []
+    for tile in tiles:
+        assert tile['layer'] == layer
+        delta_z, delta_column, delta_row = _member_offset(parent, tile)
+        tile_name = '%d/%d/%d.%s' % \
+            (delta_z, delta_column, delta_row, tile['format'].extension)
+        members.append((tile_name, tile['tile']))
+
+    if deterministic:
+        members.sort()
+
     buf = StringIO.StringIO()
     with zipfile.ZipFile(buf, mode='w') as z:
-        for tile in tiles:
-            assert tile['layer'] == layer
-
-            coord = tile['coord']
-
-            # change in zoom level from parent to coord. since parent should
-            # be a parent, its zoom should always be equal or smaller to that
-            # of coord.
-            delta_z = coord.zoom - parent.zoom
-            assert delta_z >= 0, "Coordinates must be descendents of parent"
-
-            # change in row/col coordinates are relative to the upper left
-            # coordinate at that zoom. both should be positive.
-            delta_row = coord.row - (int(parent.row) << delta_z)
-            delta_column = coord.column - (int(parent.column) << delta_z)
-            assert delta_row >= 0, \
-                "Coordinates must be contained by their parent, but " + \
-                "row is not."
-            assert delta_column >= 0, \
-                "Coordinates must be contained by their parent, but " + \
-                "column is not."
-
-            tile_name = '%d/%d/%d.%s' % \
-                (delta_z, delta_column, delta_row, tile['format'].extension)
-            tile_data = tile['tile']
+        for tile_name, tile_data in members:
             info = zipfile.ZipInfo(tile_name, date_time)
+            if deterministic:
+                # these otherwise depend on the platform writing the zip
+                info.create_system = 3
+                info.external_attr = 0o644 << 16
             z.writestr(info, tile_data, zipfile.ZIP_DEFLATED)
 
     return [dict(tile=buf.getvalue(), format=zip_format, coord=parent,
                  layer=layer)]
 
 
+def _member_offset(parent, tile):
+    """
+    Returns the (zoom, column, row) of the tile's coordinate relative to the
+    parent, which is how it is named within a metatile.
+    """
+
+    coord = tile['coord']
+
+    # change in zoom level from parent to coord. since parent should
+    # be a parent, its zoom should always be equal or smaller to that
+    # of coord.
+    delta_z = coord.zoom - parent.zoom
+    assert delta_z >= 0, "Coordinates must be descendents of parent"
+
+    # change in row/col coordinates are relative to the upper left
+    # coordinate at that zoom. both should be positive.
+    delta_row = coord.row - (int(parent.row) << delta_z)
+    delta_column = coord.column - (int(parent.column) << delta_z)
+    assert delta_row >= 0, \
+        "Coordinates must be contained by their parent, but " + \
+        "row is not."
+    assert delta_column >= 0, \
+        "Coordinates must be contained by their parent, but " + \
+        "column is not."
+
+    return int(delta_z), int(delta_column), int(delta_row)
+
+
+# the indexed metatile container starts with a fixed size header of a magic
+# string, a version and the number of members. it's followed by an index
+# with a fixed size entry for each member, sorted by the key which starts
+# each entry, and then by the data of the members. everything is big endian,
+# so that the keys sort in the same order as their bytes.
+INDEXED_METATILE_MAGIC = 'TQMT'
+INDEXED_METATILE_VERSION = 1
+INDEXED_METATILE_HEADER = struct.Struct('>4sB3xI')
+# zoom, column and row relative to the parent, and extension of the format.
+INDEXED_METATILE_KEY = struct.Struct('>BII8s')
+# key, then offset from the start of the metatile and length of the member's
+# data, and how it's compressed.
+INDEXED_METATILE_ENTRY = struct.Struct('>17sQIB2x')
+
+INDEXED_METATILE_UNCOMPRESSED = 0
+INDEXED_METATILE_DEFLATED = 1
+
+
+def _indexed_metatile_key(offset, extension):
+    assert len(extension) <= 8, \
+        "Format extension %r is too long for an indexed metatile" % extension
+    zoom, column, row = offset
+    return INDEXED_METATILE_KEY.pack(zoom, column, row, extension)
+
+
+def make_multi_indexed_metatile(parent, tiles, compress=False):
+    """
+    Make an indexed metatile containing a list of tiles all having the same
+    layer, with coordinates relative to the given parent, as
+    make_multi_metatile does for zip metatiles.
+
+    The index at the start of the metatile gives the offset and length of
+    each tile, so that a single tile can be read from it without reading
+    the rest, for example with range requests. If compress is True, each
+    tile is deflated when that makes it smaller. There are no timestamps,
+    and the tiles are always in the same order, so metatiles of the same
+    tiles are byte-wise identical.
+    """
+
+    assert parent is not None, \
+        "Parent tile must be provided and not None to make a metatile."
+
+    if len(tiles) == 0:
+        return []
+
+    layer = tiles[0]['layer']
+
+    members = []
+    for tile in tiles:
+        assert tile['layer'] == layer
+        key = _indexed_metatile_key(
+            _member_offset(parent, tile), tile['format'].extension)
+        tile_data = tile['tile']
+        compression = INDEXED_METATILE_UNCOMPRESSED
+        if compress:
+            deflated = zlib.compress(tile_data)
+            if len(deflated) < len(tile_data):
+                tile_data = deflated
+                compression = INDEXED_METATILE_DEFLATED
+        members.append((key, tile_data, compression))
+    members.sort()
+
+    buf = StringIO.StringIO()
+    buf.write(INDEXED_METATILE_HEADER.pack(
+        INDEXED_METATILE_MAGIC, INDEXED_METATILE_VERSION, len(members)))
+    data_offset = INDEXED_METATILE_HEADER.size + \
+        INDEXED_METATILE_ENTRY.size * len(members)
+    for key, tile_data, compression in members:
+        buf.write(INDEXED_METATILE_ENTRY.pack(
+            key, data_offset, len(tile_data), compression))
+        data_offset += len(tile_data)
+    for key, tile_data, compression in members:
+        buf.write(tile_data)
+
+    return [dict(tile=buf.getvalue(), format=indexed_metatile_format,
+                 coord=parent, layer=layer)]
+
+
 def _common_parent(a, b):
     """
     Find the common parent tile of both a and b. The common parent is the tile
@@ -94,12 +209,19 @@ def _parent_tile(tiles):
     return parent
 
 
-def make_metatiles(size, tiles, date_time=None):
+def make_metatiles(size, tiles, date_time=None, deterministic=False,
+                   metatile_format=None, compress=False):
     """
     Group by layers, and make metatiles out of all the tiles which share those
     properties relative to the "top level" tile which is parent of them all.
     Provide a 6-tuple date_time to set the timestamp on each tile within the
-    metatile, or leave it as None to use the current time.
+    metatile, or leave it as None to use the current time. Set deterministic
+    to make metatiles which are byte-wise identical when their tiles are, as
+    described in make_multi_metatile.
+
+    The metatiles are zips unless metatile_format is the
+    indexed_metatile_format, in which case compress says whether to deflate
+    the tiles in them.
     """
 
     groups = defaultdict(list)
@@ -110,7 +232,12 @@ def make_metatiles(size, tiles, date_time=None):
     metatiles = []
     for group in groups.itervalues():
         parent = _parent_tile(t['coord'] for t in group)
-        metatiles.extend(make_multi_metatile(parent, group, date_time))
+        if metatile_format and metatile_format == indexed_metatile_format:
+            metatiles.extend(make_multi_indexed_metatile(
+                parent, group, compress))
+        else:
+            metatiles.extend(make_multi_metatile(
+                parent, group, date_time, deterministic))
 
     return metatiles
 
@@ -135,6 +262,89 @@ def extract_metatile(io, fmt, offset=None):
             return None
 
 
+def read_indexed_metatile_header(header_data):
+    """
+    Given the first INDEXED_METATILE_HEADER.size bytes of an indexed
+    metatile, return the size of the index which follows them.
+    """
+
+    magic, version, count = INDEXED_METATILE_HEADER.unpack(
+        header_data[:INDEXED_METATILE_HEADER.size])
+    if magic != INDEXED_METATILE_MAGIC:
+        raise ValueError('Not an indexed metatile')
+    if version != INDEXED_METATILE_VERSION:
+        raise ValueError('Unsupported indexed metatile version %d' % version)
+    return count * INDEXED_METATILE_ENTRY.size
+
+
+class _IndexKeys(object):
+    # the keys of the entries in an index, as a sequence which can be
+    # searched with bisect without unpacking every entry.
+
+    def __init__(self, index_data):
+        self.index_data = index_data
+
+    def __len__(self):
+        return len(self.index_data) // INDEXED_METATILE_ENTRY.size
+
+    def __getitem__(self, i):
+        start = i * INDEXED_METATILE_ENTRY.size
+        return self.index_data[start:start + INDEXED_METATILE_KEY.size]
+
+
+def find_indexed_metatile_member(index_data, fmt, offset=None):
+    """
+    Look up the tile at the given offset (defaults to 0/0/0) and format in
+    the index of an indexed metatile, which is the bytes following its
+    header. Returns the (offset, length, compression) of the tile's data
+    within the metatile, or None if it doesn't contain the tile.
+    """
+
+    if offset is None:
+        offset = (0, 0, 0)
+    else:
+        offset = (offset.zoom, offset.column, offset.row)
+    key = _indexed_metatile_key(offset, fmt.extension)
+
+    keys = _IndexKeys(index_data)
+    i = bisect_left(keys, key, 0, len(keys))
+    if i == len(keys) or keys[i] != key:
+        return None
+
+    _, data_offset, length, compression = INDEXED_METATILE_ENTRY.unpack_from(
+        index_data, i * INDEXED_METATILE_ENTRY.size)
+    return data_offset, length, compression
+
+
+def decompress_indexed_metatile_member(tile_data, compression):
+    if compression == INDEXED_METATILE_DEFLATED:
+        return zlib.decompress(tile_data)
+    elif compression == INDEXED_METATILE_UNCOMPRESSED:
+        return tile_data
+    else:
+        raise ValueError(
+            'Unknown indexed metatile compression %d' % compression)
+
+
+def extract_indexed_metatile(io, fmt, offset=None):
+    """
+    Extract the tile at the given offset (defaults to 0/0/0) and format from
+    the indexed metatile in the seekable file-like object io. Only the
+    header, the index and the tile's own data are read.
+    """
+
+    io.seek(0)
+    index_size = read_indexed_metatile_header(
+        io.read(INDEXED_METATILE_HEADER.size))
+    member = find_indexed_metatile_member(io.read(index_size), fmt, offset)
+    if member is None:
+        return None
+
+    data_offset, length, compression = member
+    io.seek(data_offset)
+    return decompress_indexed_metatile_member(io.read(length), compression)
+
+
 def _metatile_contents_equal(zip_1, zip_2):
     """
     Given two open zip files as arguments, this returns True if the zips
@@ -175,10 +385,36 @@ def metatiles_are_equal(tile_data_1, tile_data_2):
             with zipfile.ZipFile(buf_2, mode='r') as zip_2:
                 return _metatile_contents_equal(zip_1, zip_2)
 
-    except (StandardError, zipfile.BadZipFile, zipfile.LargeZipFile):
+    except (StandardError, zipfile.BadZipfile, zipfile.LargeZipFile):
         # errors, such as files not being proper zip files, or missing
         # some attributes or contents that we expect, are treated as not
         # equal.
         pass
 
     return False
+
+
+def metatile_contents_hash(tile_data):
+    """
+    Return a hex digest of the names and contents of the files in the zipped
+    metatile. As with metatiles_are_equal, this ignores the timestamps and
+    order of the files and any other metadata, so two metatiles which are
+    equal have the same hash. Returns None if the tile can't be read.
+    """
+
+    try:
+        buf = StringIO.StringIO(tile_data)
+        with zipfile.ZipFile(buf, mode='r') as z:
+            m = hashlib.md5()
+            for name in sorted(z.namelist()):
+                data = z.read(name)
+                # lengths are included so that the boundaries between names
+                # and contents can't be moved to give the same digest.
+                m.update('%d:%s%d:' % (len(name), name, len(data)))
+                m.update(data)
+            return m.hexdigest()
+
+    except (StandardError, zipfile.BadZipfile, zipfile.LargeZipFile):
+        pass
+
+    return None
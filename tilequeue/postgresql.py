@@ -1,7 +1,9 @@
 from itertools import cycle
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 from psycopg2.extras import register_hstore, register_json
 import psycopg2
 import threading
+import time
 import ujson
 
 
@@ -43,3 +45,185 @@ class DBAffinityConnectionsNoLimit(object):
     def closeall(self):
         raise Exception('DBAffinityConnectionsNoLimit pool does not track '
                         'connections')
+
+
+class DBAffinityConnectionsPool(object):
+
+    # Keeps a bounded set of connections open to each database, so
+    # that connections are reused across requests rather than being
+    # re-established for each one. As with the no limit pool, all the
+    # connections handed out for a single request are to the same
+    # database, and the databases are cycled through between requests.
+    #
+    # Connections are checked before being handed out and when being
+    # returned. Connections which have been closed, for example by
+    # execute_query after an error, or which are in an unexpected
+    # transaction state are discarded and replaced with new ones. Idle
+    # connections are also discarded after max_idle_seconds, and all
+    # connections after max_lifetime_seconds, so that long lived
+    # connections get recycled periodically.
+
+    def __init__(self, dbnames, conn_info, max_conns_per_db,
+                 readonly=True, max_idle_seconds=None,
+                 max_lifetime_seconds=None, wait_timeout_seconds=None):
+        assert max_conns_per_db > 0, 'Pool must allow at least 1 connection'
+        self.dbnames = cycle(dbnames)
+        self.conn_info = conn_info
+        self.max_conns_per_db = max_conns_per_db
+        self.readonly = readonly
+        self.max_idle_seconds = max_idle_seconds
+        self.max_lifetime_seconds = max_lifetime_seconds
+        self.wait_timeout_seconds = wait_timeout_seconds
+
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        # idle connections per dbname, as (conn, last_used) tuples
+        self.idle = dict((dbname, []) for dbname in dbnames)
+        # number of connections open per dbname, both idle and in use
+        self.n_open = dict((dbname, 0) for dbname in dbnames)
+        # connection -> (dbname, created)
+        self.conn_meta = {}
+
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_discarded = 0
+        self.wait_seconds = 0.0
+
+    def _make_conn(self, conn_info):
+        conn = psycopg2.connect(**conn_info)
+        conn.set_session(readonly=self.readonly, autocommit=True)
+        register_hstore(conn)
+        register_json(conn, loads=ujson.loads)
+        return conn
+
+    def _is_usable(self, conn, now):
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            return False
+        if self.max_lifetime_seconds is not None:
+            dbname, created = self.conn_meta[conn]
+            if now - created > self.max_lifetime_seconds:
+                return False
+        return True
+
+    def _discard(self, conn):
+        # expects the lock to be held
+        dbname, created = self.conn_meta.pop(conn)
+        self.n_open[dbname] -= 1
+        self.n_discarded += 1
+        try:
+            conn.close()
+        except:
+            pass
+
+    def _evict_idle(self, dbname, now):
+        # expects the lock to be held
+        keep = []
+        for conn, last_used in self.idle[dbname]:
+            if self.max_idle_seconds is not None and \
+                    now - last_used > self.max_idle_seconds:
+                self._discard(conn)
+            elif not self._is_usable(conn, now):
+                self._discard(conn)
+            else:
+                keep.append((conn, last_used))
+        self.idle[dbname][:] = keep
+
+    def get_conns(self, n_conn):
+        assert n_conn <= self.max_conns_per_db, \
+            'Requested %d connections, but pool only allows %d per db' % (
+                n_conn, self.max_conns_per_db)
+
+        with self.cond:
+            dbname = self.dbnames.next()
+            idle = self.idle[dbname]
+
+            wait_start = None
+            while True:
+                now = time.time()
+                self._evict_idle(dbname, now)
+                n_available = len(idle) + \
+                    self.max_conns_per_db - self.n_open[dbname]
+                if n_available >= n_conn:
+                    break
+
+                if wait_start is None:
+                    wait_start = now
+                wait_timeout = None
+                if self.wait_timeout_seconds is not None:
+                    wait_timeout = \
+                        self.wait_timeout_seconds - (now - wait_start)
+                    if wait_timeout <= 0:
+                        self.wait_seconds += now - wait_start
+                        raise RuntimeError(
+                            'Timed out waiting for %d connections to %s' %
+                            (n_conn, dbname))
+                self.cond.wait(wait_timeout)
+
+            if wait_start is not None:
+                self.wait_seconds += time.time() - wait_start
+
+            # most recently used connections are at the end
+            n_reused = min(n_conn, len(idle))
+            conns = [conn for conn, last_used in idle[-n_reused:]] \
+                if n_reused else []
+            del idle[len(idle) - n_reused:]
+
+            n_new = n_conn - n_reused
+            self.n_open[dbname] += n_new
+            self.n_hits += n_reused
+            self.n_misses += n_new
+
+        conn_info_with_db = dict(self.conn_info, dbname=dbname)
+        try:
+            for i in range(n_new):
+                conn = self._make_conn(conn_info_with_db)
+                with self.lock:
+                    self.conn_meta[conn] = (dbname, time.time())
+                conns.append(conn)
+                n_new -= 1
+        except:
+            with self.cond:
+                # give back the slots for connections we failed to make
+                self.n_open[dbname] -= n_new
+                self.cond.notify_all()
+            self.put_conns(conns)
+            raise
+
+        return conns
+
+    def put_conns(self, conns):
+        now = time.time()
+        with self.cond:
+            for conn in conns:
+                if conn not in self.conn_meta:
+                    # not one of ours, or already discarded
+                    continue
+                if self._is_usable(conn, now):
+                    dbname, created = self.conn_meta[conn]
+                    self.idle[dbname].append((conn, now))
+                else:
+                    self._discard(conn)
+            self.cond.notify_all()
+
+    def get_stats(self):
+        with self.lock:
+            n_idle = sum(len(x) for x in self.idle.values())
+            n_open = sum(self.n_open.values())
+            return dict(
+                hits=self.n_hits,
+                misses=self.n_misses,
+                discarded=self.n_discarded,
+                wait_seconds=self.wait_seconds,
+                idle=n_idle,
+                in_use=n_open - n_idle,
+            )
+
+    def closeall(self):
+        with self.cond:
+            for dbname, idle in self.idle.items():
+                for conn, last_used in idle:
+                    self._discard(conn)
+                self.idle[dbname] = []
+            self.cond.notify_all()
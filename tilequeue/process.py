@@ -2,7 +2,10 @@ from collections import namedtuple
 from cStringIO import StringIO
 from shapely.geometry import MultiPolygon
 from shapely import geometry
+from shapely.prepared import prep
+from shapely.strtree import STRtree
 from shapely.wkb import loads
+from tilequeue.columnar import ColumnarFeatures
 from tilequeue.config import create_query_bounds_pad_fn
 from tilequeue.tile import calc_meters_per_pixel_dim
 from tilequeue.tile import coord_to_mercator_bounds
@@ -11,6 +14,8 @@ from tilequeue.transform import mercator_point_to_lnglat
 from tilequeue.transform import transform_feature_layers_shape
 from zope.dottedname.resolve import resolve
 from sys import getsizeof
+import multiprocessing
+import time
 
 
 def make_transform_fn(transform_fns):
@@ -24,10 +29,38 @@ def make_transform_fn(transform_fns):
     return transform_fn
 
 
+# resolving dotted names is relatively expensive, and the same names are
+# resolved for every tile, so the results are kept for the life of the
+# process.
+_resolved_fns = {}
+
+
+def resolve_fn(fn_dotted_name):
+    fn = _resolved_fns.get(fn_dotted_name)
+    if fn is None:
+        fn = resolve(fn_dotted_name)
+        _resolved_fns[fn_dotted_name] = fn
+    return fn
+
+
 def resolve_transform_fns(fn_dotted_names):
     if not fn_dotted_names:
         return None
-    return map(resolve, fn_dotted_names)
+    return map(resolve_fn, fn_dotted_names)
+
+
+# the combined transform function for each distinct list of transform names
+_layer_transform_fns = {}
+
+
+def resolve_layer_transform_fn(fn_dotted_names):
+    if not fn_dotted_names:
+        return None
+    key = tuple(fn_dotted_names)
+    if key not in _layer_transform_fns:
+        transform_fns = resolve_transform_fns(fn_dotted_names)
+        _layer_transform_fns[key] = make_transform_fn(transform_fns)
+    return _layer_transform_fns[key]
 
 
 def _sizeof(val):
@@ -36,6 +69,11 @@ def _sizeof(val):
     if isinstance(val, dict):
         for k, v in val.items():
             size += len(k) + _sizeof(v)
+    elif isinstance(val, ColumnarFeatures):
+        size += len(val.wkb) + len(val.offsets) * val.offsets.itemsize
+        size += _sizeof(val.ids)
+        for k, values in val.properties.items():
+            size += len(k) + _sizeof([v for v in values if v is not None])
     elif isinstance(val, list):
         for v in val:
             size += _sizeof(v)
@@ -63,11 +101,17 @@ Context = namedtuple('Context', [
 # computed centroids) or modifying layers based on the contents
 # of other layers (e.g: projecting attributes, deleting hidden
 # features, etc...)
+#
+# when step_seconds is a dict, the seconds taken by each step are added
+# to it, by function name, summed when a function is used more than once.
 def _postprocess_data(
-        feature_layers, post_process_data, nominal_zoom, unpadded_bounds):
+        feature_layers, post_process_data, nominal_zoom, unpadded_bounds,
+        step_seconds=None):
 
     for step in post_process_data:
-        fn = resolve(step['fn_name'])
+        start = time.time()
+        # the function is usually resolved when the config is parsed
+        fn = step.get('fn') or resolve_fn(step['fn_name'])
 
         ctx = Context(
             feature_layers=feature_layers,
@@ -92,26 +136,132 @@ def _postprocess_data(
             if layer is not None:
                 feature_layers.append(layer)
 
+        if step_seconds is not None:
+            fn_name = step['fn_name']
+            step_seconds[fn_name] = step_seconds.get(fn_name, 0) + \
+                time.time() - start
+
     return feature_layers
 
 
+class PaddedBoundsFilter(object):
+    """
+    Tests whether shapes intersect the padded bounds for their geometry
+    type. This is built once per layer, rather than making a new box for
+    each feature.
+
+    The bounding box of the shape is compared against the padded bounds
+    first, which is much cheaper than a full intersection test. Shapes
+    whose bounding boxes miss the padded bounds are rejected, and those
+    whose bounding boxes are inside them are accepted, without an
+    intersection. Only the remainder are tested against a prepared box.
+    """
+
+    def __init__(self, padded_bounds):
+        self.padded_bounds = padded_bounds
+        self.prepared_boxes = {}
+
+    def __call__(self, shape):
+        if shape.is_empty:
+            return False
+
+        geom_type = normalize_geometry_type(shape.type)
+        minx, miny, maxx, maxy = self.padded_bounds[geom_type]
+        shape_minx, shape_miny, shape_maxx, shape_maxy = shape.bounds
+
+        if shape_minx > maxx or shape_maxx < minx or \
+           shape_miny > maxy or shape_maxy < miny:
+            return False
+
+        if shape_minx >= minx and shape_maxx <= maxx and \
+           shape_miny >= miny and shape_maxy <= maxy:
+            return True
+
+        prepared_box = self.prepared_boxes.get(geom_type)
+        if prepared_box is None:
+            prepared_box = prep(geometry.box(minx, miny, maxx, maxy))
+            self.prepared_boxes[geom_type] = prepared_box
+        return prepared_box.intersects(shape)
+
+
+class FeatureIndex(object):
+    """
+    Spatial index over the features of a single layer, so that the
+    features which might be in a child tile can be found without testing
+    every feature in the layer.
+    """
+
+    def __init__(self, features):
+        self.features = features
+        # the tree gives back the shapes it was built with, so keep track
+        # of which features each shape belongs to.
+        self.feature_indexes = {}
+        shapes = []
+        for i, (shape, props, feature_id) in enumerate(features):
+            if shape.is_empty:
+                continue
+            indexes = self.feature_indexes.get(id(shape))
+            if indexes is None:
+                self.feature_indexes[id(shape)] = [i]
+                shapes.append(shape)
+            else:
+                indexes.append(i)
+        self.tree = STRtree(shapes) if shapes else None
+
+    def candidates(self, bounds):
+        """
+        Returns the features with bounding boxes intersecting the bounds,
+        in the same order as they are in the layer.
+        """
+
+        if self.tree is None:
+            return []
+
+        indexes = []
+        for shape in self.tree.query(geometry.box(*bounds)):
+            indexes.extend(self.feature_indexes[id(shape)])
+        indexes.sort()
+        return [self.features[i] for i in indexes]
+
+
+def _index_feature_layers(feature_layers):
+    return [FeatureIndex(feature_layer['features'])
+            for feature_layer in feature_layers]
+
+
+def _envelope_of_padded_bounds(padded_bounds):
+    all_bounds = padded_bounds.values()
+    return (
+        min(b[0] for b in all_bounds),
+        min(b[1] for b in all_bounds),
+        max(b[2] for b in all_bounds),
+        max(b[3] for b in all_bounds),
+    )
+
+
 def _cut_coord(
-        feature_layers, unpadded_bounds, meters_per_pixel_dim, buffer_cfg):
+        feature_layers, unpadded_bounds, meters_per_pixel_dim, buffer_cfg,
+        feature_indexes=None):
     cut_feature_layers = []
-    for feature_layer in feature_layers:
-        features = feature_layer['features']
+    for layer_index, feature_layer in enumerate(feature_layers):
         padded_bounds_fn = create_query_bounds_pad_fn(
             buffer_cfg, feature_layer['name'])
         padded_bounds = padded_bounds_fn(unpadded_bounds, meters_per_pixel_dim)
+        intersects_padded_bounds = PaddedBoundsFilter(padded_bounds)
+
+        if feature_indexes is None:
+            features = feature_layer['features']
+        else:
+            # only need to check the features which the index says are
+            # close to the tile.
+            features = feature_indexes[layer_index].candidates(
+                _envelope_of_padded_bounds(padded_bounds))
 
         cut_features = []
         for feature in features:
             shape, props, feature_id = feature
 
-            geom_type_bounds = padded_bounds[
-                normalize_geometry_type(shape.type)]
-            shape_padded_bounds = geometry.box(*geom_type_bounds)
-            if not shape_padded_bounds.intersects(shape):
+            if not intersects_padded_bounds(shape):
                 continue
             props_copy = props.copy()
             cut_feature = shape, props_copy, feature_id
@@ -176,26 +326,68 @@ def _visible_shape(shape, area_threshold_meters):
 
 def _create_formatted_tile(
         feature_layers, format, scale, unpadded_bounds, unpadded_bounds_lnglat,
-        coord, nominal_zoom, layer, meters_per_pixel_dim, buffer_cfg):
+        coord, nominal_zoom, layer, meters_per_pixel_dim, buffer_cfg,
+        clip_cache=None, format_cache=None):
 
     # perform format specific transformations
     transformed_feature_layers = transform_feature_layers_shape(
         feature_layers, format, scale, unpadded_bounds,
-        meters_per_pixel_dim, buffer_cfg)
+        meters_per_pixel_dim, buffer_cfg, clip_cache)
 
     # use the formatter to generate the tile
+    start = time.time()
     tile_data_file = StringIO()
     format.format_tile(
         tile_data_file, transformed_feature_layers, nominal_zoom,
-        unpadded_bounds, unpadded_bounds_lnglat)
+        unpadded_bounds, unpadded_bounds_lnglat, format_cache)
     tile = tile_data_file.getvalue()
+    encode_seconds = time.time() - start
 
-    formatted_tile = dict(format=format, tile=tile, coord=coord, layer=layer)
+    formatted_tile = dict(format=format, tile=tile, coord=coord, layer=layer,
+                          encode_seconds=encode_seconds)
     return formatted_tile
 
 
+def _read_feature_rows(feature_layer):
+    """
+    Yields (wkb, feature id, iterable of (key, value) properties) for
+    each row in the feature layer.
+
+    Rows are usually dicts, but rows streamed from the database are tuples
+    of values, with the column names shared for the layer in 'columns',
+    and the rows may also be stored together as ColumnarFeatures.
+    Properties with None values are skipped for tuple rows, as they would
+    have been left out of the dict rows.
+    """
+
+    features = feature_layer['features']
+    if isinstance(features, ColumnarFeatures):
+        for feature_row in features.iter_feature_rows():
+            yield feature_row
+        return
+
+    columns = feature_layer.get('columns')
+    if columns is None:
+        for row in feature_layer['features']:
+            wkb = row.pop('__geometry__')
+            feature_id = row.pop('__id__')
+            yield wkb, feature_id, row.iteritems()
+        return
+
+    geometry_index = columns.index('__geometry__')
+    id_index = columns.index('__id__')
+    property_columns = [
+        (i, k) for i, k in enumerate(columns)
+        if i not in (geometry_index, id_index)]
+    for row in feature_layer['features']:
+        props = [(k, row[i]) for i, k in property_columns
+                 if row[i] is not None]
+        yield row[geometry_index], row[id_index], props
+
+
 def process_coord_no_format(
-        feature_layers, nominal_zoom, unpadded_bounds, post_process_data):
+        feature_layers, nominal_zoom, unpadded_bounds, post_process_data,
+        step_seconds=None):
 
     extra_data = dict(size={})
     processed_feature_layers = []
@@ -206,25 +398,20 @@ def process_coord_no_format(
         geometry_types = layer_datum['geometry_types']
         padded_bounds = feature_layer['padded_bounds']
 
-        transform_fn_names = layer_datum['transform_fn_names']
-        if transform_fn_names:
-            transform_fns = resolve_transform_fns(transform_fn_names)
-            layer_transform_fn = make_transform_fn(transform_fns)
-        else:
-            layer_transform_fn = None
+        layer_transform_fn = resolve_layer_transform_fn(
+            layer_datum['transform_fn_names'])
+
+        intersects_padded_bounds = PaddedBoundsFilter(padded_bounds)
 
         features = []
         features_size = 0
-        for row in feature_layer['features']:
-            wkb = row.pop('__geometry__')
+        for wkb, feature_id, row_props in _read_feature_rows(
+                feature_layer):
             shape = loads(wkb)
 
             if shape.is_empty:
                 continue
 
-            if not shape.is_valid:
-                continue
-
             if geometry_types is not None:
                 if shape.type not in geometry_types:
                     continue
@@ -234,16 +421,18 @@ def process_coord_no_format(
             # any extra features
             # the formatter specific transformations will take
             # care of any additional filtering
-            geom_type_bounds = padded_bounds[
-                normalize_geometry_type(shape.type)]
-            shape_padded_bounds = geometry.box(*geom_type_bounds)
-            if not shape_padded_bounds.intersects(shape):
+            # this is done before the validity check, as checking the
+            # bounding box is much cheaper and rejects most features
+            # which are going to be dropped.
+            if not intersects_padded_bounds(shape):
+                continue
+
+            if not shape.is_valid:
                 continue
 
-            feature_id = row.pop('__id__')
             props = dict()
             feature_size = getsizeof(feature_id) + len(wkb)
-            for k, v in row.iteritems():
+            for k, v in row_props:
                 if k == 'mz_properties':
                     for output_key, output_val in v.items():
                         if output_val is not None:
@@ -259,9 +448,7 @@ def process_coord_no_format(
                 else:
                     props[k] = v
                     feature_size += len(k) + _sizeof(v)
-                features_size += feature_size
-
-            extra_data['size'][layer_datum['name']] = features_size
+            features_size += feature_size
 
             if layer_transform_fn:
                 shape, props, feature_id = layer_transform_fn(
@@ -270,9 +457,11 @@ def process_coord_no_format(
             feature = shape, props, feature_id
             features.append(feature)
 
+        extra_data['size'][layer_name] = features_size
+
         sort_fn_name = layer_datum['sort_fn_name']
         if sort_fn_name:
-            sort_fn = resolve(sort_fn_name)
+            sort_fn = resolve_fn(sort_fn_name)
             features = sort_fn(features, nominal_zoom)
 
         feature_layer = dict(
@@ -286,7 +475,7 @@ def process_coord_no_format(
     # post-process data here, before it gets formatted
     processed_feature_layers = _postprocess_data(
         processed_feature_layers, post_process_data, nominal_zoom,
-        unpadded_bounds)
+        unpadded_bounds, step_seconds)
 
     return processed_feature_layers, extra_data
 
@@ -304,46 +493,124 @@ def _format_feature_layers(
 
     # now, perform the format specific transformations
     # and format the tile itself
-    formatted_tiles = []
     layer = 'all'
-    for format in formats:
-        formatted_tile = _create_formatted_tile(
-            processed_feature_layers, format, scale, unpadded_bounds,
+    # formats with the same buffer config clip each shape the same way,
+    # so the clipped shapes are shared between the formats for this tile,
+    # as is any other work the formats themselves can share.
+    clip_cache = {}
+    format_cache = {}
+    # formats with a buffer are done first, so that formats without one
+    # can clip from their larger clipped shapes. mvt from mvtb's, say.
+    formatted_tiles = [None] * len(formats)
+    format_order = sorted(
+        range(len(formats)),
+        key=lambda i: not buffer_cfg or formats[i].extension not in buffer_cfg)
+    for i in format_order:
+        formatted_tiles[i] = _create_formatted_tile(
+            processed_feature_layers, formats[i], scale, unpadded_bounds,
             unpadded_bounds_lnglat, coord, nominal_zoom, layer,
-            meters_per_pixel_dim, buffer_cfg)
-        formatted_tiles.append(formatted_tile)
+            meters_per_pixel_dim, buffer_cfg, clip_cache, format_cache)
 
     return formatted_tiles
 
 
 def _cut_child_tiles(
-        feature_layers, cut_coord, nominal_zoom, formats, scale, buffer_cfg):
+        feature_layers, cut_coord, nominal_zoom, formats, scale, buffer_cfg,
+        feature_indexes=None):
 
     unpadded_cut_bounds = coord_to_mercator_bounds(cut_coord)
     meters_per_pixel_dim = calc_meters_per_pixel_dim(nominal_zoom)
 
     cut_feature_layers = _cut_coord(
-        feature_layers, unpadded_cut_bounds, meters_per_pixel_dim, buffer_cfg)
+        feature_layers, unpadded_cut_bounds, meters_per_pixel_dim, buffer_cfg,
+        feature_indexes)
 
     return _format_feature_layers(
         cut_feature_layers, cut_coord, nominal_zoom, formats,
         unpadded_cut_bounds, scale, buffer_cfg)
 
 
+# the arguments for cutting child tiles in a forked pool. these are set
+# before the pool is created, so that the pool processes inherit them
+# rather than needing them to be pickled.
+_cut_child_tiles_args = None
+
+
+def _cut_child_tiles_chunk(cut_coords):
+    feature_layers, nominal_zoom, formats, scale, buffer_cfg = \
+        _cut_child_tiles_args
+    feature_indexes = _index_feature_layers(feature_layers)
+    formatted_tiles = []
+    for cut_coord in cut_coords:
+        child_tiles = _cut_child_tiles(
+            feature_layers, cut_coord, nominal_zoom, formats, scale,
+            buffer_cfg, feature_indexes)
+        formatted_tiles.extend(child_tiles)
+    return formatted_tiles
+
+
+def _cut_child_tiles_parallel(
+        feature_layers, cut_coords, nominal_zoom, formats, scale, buffer_cfg,
+        n_processes):
+    """
+    Cut and format the child tiles across a pool of n_processes, each
+    taking a contiguous chunk of the cut_coords, and return the formatted
+    tiles in the same order as cut_coords.
+
+    The pool is forked for each call, after the feature layers have been
+    processed, so that they are shared with the pool processes rather than
+    sent to them. Only the formatted tiles are sent back.
+    """
+
+    global _cut_child_tiles_args
+
+    n_processes = min(n_processes, len(cut_coords))
+    chunk_size = -(-len(cut_coords) // n_processes)
+    chunks = [cut_coords[i:i + chunk_size]
+              for i in range(0, len(cut_coords), chunk_size)]
+
+    _cut_child_tiles_args = (
+        feature_layers, nominal_zoom, formats, scale, buffer_cfg)
+    try:
+        pool = multiprocessing.Pool(n_processes)
+        try:
+            chunk_results = pool.map(_cut_child_tiles_chunk, chunks)
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        _cut_child_tiles_args = None
+
+    formatted_tiles = []
+    for chunk_result in chunk_results:
+        formatted_tiles.extend(chunk_result)
+    return formatted_tiles
+
+
 def format_coord(
         coord, nominal_zoom, processed_feature_layers, formats,
-        unpadded_bounds, cut_coords, buffer_cfg, extra_data, scale=4096):
+        unpadded_bounds, cut_coords, buffer_cfg, extra_data, scale=4096,
+        cut_processes=None, cut_processes_min_coords=0):
 
     coord_formatted_tiles = _format_feature_layers(
         processed_feature_layers, coord, nominal_zoom, formats,
         unpadded_bounds, scale, buffer_cfg)
 
     children_formatted_tiles = []
-    if cut_coords:
+    if cut_coords and cut_processes and cut_processes > 1 and \
+       len(cut_coords) >= cut_processes_min_coords:
+        children_formatted_tiles = _cut_child_tiles_parallel(
+            processed_feature_layers, cut_coords, nominal_zoom, formats,
+            scale, buffer_cfg, cut_processes)
+
+    elif cut_coords:
+        # index the features once for the whole metatile, rather than
+        # checking every feature against every child.
+        feature_indexes = _index_feature_layers(processed_feature_layers)
         for cut_coord in cut_coords:
             child_tiles = _cut_child_tiles(
                 processed_feature_layers, cut_coord, nominal_zoom, formats,
-                scale, buffer_cfg)
+                scale, buffer_cfg, feature_indexes)
             children_formatted_tiles.extend(child_tiles)
 
     all_formatted_tiles = coord_formatted_tiles + children_formatted_tiles
@@ -358,14 +625,25 @@ def format_coord(
 # to actual tile coordinates in future versions of the code. it just
 # becomes a measure of the scale between tile features and intended
 # display size.
+#
+# when cut_processes is more than one, and there are at least
+# cut_processes_min_coords cut coords, the child tiles are cut and
+# formatted in parallel across that many processes.
+#
+# when step_seconds is a dict, the seconds taken by each post-process
+# step are added to it. each of the formatted tiles has the seconds taken
+# to encode it in encode_seconds.
 def process_coord(coord, nominal_zoom, feature_layers, post_process_data,
                   formats, unpadded_bounds, cut_coords, buffer_cfg,
-                  scale=4096):
+                  scale=4096, cut_processes=None, cut_processes_min_coords=0,
+                  step_seconds=None):
     processed_feature_layers, extra_data = process_coord_no_format(
-        feature_layers, nominal_zoom, unpadded_bounds, post_process_data)
+        feature_layers, nominal_zoom, unpadded_bounds, post_process_data,
+        step_seconds)
 
     all_formatted_tiles, extra_data = format_coord(
         coord, nominal_zoom, processed_feature_layers, formats,
-        unpadded_bounds, cut_coords, buffer_cfg, extra_data, scale)
+        unpadded_bounds, cut_coords, buffer_cfg, extra_data, scale,
+        cut_processes, cut_processes_min_coords)
 
     return all_formatted_tiles, extra_data
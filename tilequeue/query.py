@@ -1,8 +1,11 @@
 from psycopg2.extras import RealDictCursor
+from tilequeue.columnar import ColumnarFeatures
 from tilequeue.postgresql import DBAffinityConnectionsNoLimit
 from tilequeue.tile import calc_meters_per_pixel_dim
 from tilequeue.transform import calculate_padded_bounds
+from itertools import count
 import sys
+import time
 
 
 def generate_query(start_zoom, template, bounds, zoom):
@@ -114,6 +117,218 @@ def execute_query(conn, query, layer_datum, padded_bounds):
         raise
 
 
+# names for server side cursors only need to be unique per connection,
+# but it's simpler to make them unique per process.
+_cursor_name_ids = count()
+
+
+def execute_streaming_query(
+        conn, query, layer_datum, padded_bounds, itersize):
+    """
+    Execute the query with a server side cursor, fetching the rows from
+    the database itersize at a time rather than all at once.
+
+    Rows are returned as tuples rather than dicts, along with the list of
+    column names shared by all the rows in the layer. Buffers are read
+    into bytes as each row arrives, so that there is only ever one copy
+    of the full result set. Returns (rows, layer_datum, padded_bounds,
+    columns).
+    """
+
+    try:
+        # a named cursor without hold lives in a transaction, and sends
+        # rows as the query produces them. a cursor held open outside of
+        # a transaction, as it would need to be in autocommit mode, only
+        # returns its first rows after the whole query has run, so
+        # autocommit is turned off for the fetch.
+        conn.autocommit = False
+        try:
+            cursor_name = 'tilequeue_%d' % next(_cursor_name_ids)
+            cursor = conn.cursor(name=cursor_name)
+            cursor.itersize = itersize
+            try:
+                cursor.execute(query)
+                rows = []
+                for row in cursor:
+                    rows.append(tuple(
+                        bytes(v) if isinstance(v, buffer) else v
+                        for v in row))
+                # for named cursors, the description is only available
+                # after the first fetch.
+                columns = [col[0] for col in cursor.description or ()]
+            finally:
+                cursor.close()
+        finally:
+            # nothing is written, so the transaction is always rolled
+            # back, which also ends it if the fetch failed part way.
+            conn.rollback()
+            conn.autocommit = True
+
+        return rows, layer_datum, padded_bounds, columns
+    except:
+        # see execute_query, the connection may be in an invalid
+        # state so close it for the pool to replace
+        try:
+            conn.close()
+        except:
+            pass
+        raise
+
+
+# each layer query is wrapped so that all layers have the same columns
+# and can be combined with UNION ALL. the geometry is kept as a
+# separate column, and all the other columns are folded into a single
+# json object, built from a subselect of just those columns so that the
+# geometry isn't hex encoded into the json as well. hstore columns are
+# converted to json objects by the cast that the hstore extension
+# provides.
+batched_layer_query_template = '''SELECT
+  %(layer_index)d AS __layer_index__,
+  q.__geometry__ AS __geometry__,
+  %(row)s AS __row__
+FROM (
+%(query)s
+) AS q'''
+
+
+def _quote_column(column):
+    return '"%s"' % column.replace('"', '""')
+
+
+def build_batched_query(queries_to_execute, layer_columns):
+    """
+    Combine the (layer_datum, query, padded_bounds) list of layer queries
+    into a single query, so that all layers can be fetched in one round
+    trip on one connection. Layers without a query are skipped.
+
+    layer_columns is the list of the column names of each layer's query,
+    and rows of the combined query are (layer index, geometry, json object
+    of the other columns). Since the non-geometry columns make a round
+    trip through json, non-json types are returned as the nearest json
+    type: numerics are floats rather than Decimals, timestamps are
+    strings and hstores are dicts.
+    """
+
+    layer_queries = []
+    for layer_index, (layer_datum, query, padded_bounds) in enumerate(
+            queries_to_execute):
+        if query is None:
+            continue
+        query = query.strip().rstrip(';')
+        columns = [_quote_column(c) for c in layer_columns[layer_index]
+                   if c != '__geometry__']
+        if columns:
+            row = '(SELECT row_to_json(r) FROM (SELECT %s) AS r)' % \
+                ', '.join('q.%s' % c for c in columns)
+        else:
+            row = "'{}'::json"
+        layer_query = batched_layer_query_template % dict(
+            layer_index=layer_index,
+            query=query,
+            row=row,
+        )
+        layer_queries.append(layer_query)
+
+    if not layer_queries:
+        return None
+    return '\nUNION ALL\n'.join(layer_queries)
+
+
+# column names of each layer's query by layer name and zoom, as the
+# templates can select different columns at different zooms. these are
+# looked up once per process, the first time each is batched, which
+# assumes that the columns a template selects only depend on the zoom,
+# and that the template doesn't change while the process is running. so
+# they aren't cached when templates are reloaded.
+_batched_layer_columns = {}
+
+
+def _layer_columns(cursor, layer_datum, query, zoom, cache_columns=True):
+    key = layer_datum['name'], zoom
+    columns = _batched_layer_columns.get(key) if cache_columns else None
+    if columns is None:
+        cursor.execute('SELECT * FROM (\n%s\n) AS q LIMIT 0' %
+                       query.strip().rstrip(';'))
+        columns = [col[0] for col in cursor.description]
+        if cache_columns:
+            _batched_layer_columns[key] = columns
+    return columns
+
+
+def _utf8_encode(value):
+    # json strings are decoded as unicode, but columns read directly,
+    # including the keys and values of hstore columns, are utf8 encoded,
+    # so encode them the same way all the way down.
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, dict):
+        return dict((_utf8_encode(k), _utf8_encode(v))
+                    for k, v in value.iteritems())
+    elif isinstance(value, list):
+        return [_utf8_encode(v) for v in value]
+    return value
+
+
+def execute_batched_query(conn, queries_to_execute, zoom,
+                          cache_columns=True):
+    """
+    Execute all the layer queries as a single query, and split the result
+    rows back up by layer. Returns a list of (rows, layer_datum,
+    padded_bounds), as execute_query does, for each layer with a query.
+
+    The columns of each layer's query are cached by layer name and zoom
+    unless cache_columns is False, in which case they are looked up again
+    for every query.
+    """
+
+    rows_by_layer = {}
+    for layer_index, (layer_datum, query, padded_bounds) in enumerate(
+            queries_to_execute):
+        if query is not None:
+            rows_by_layer[layer_index] = []
+
+    if rows_by_layer:
+        try:
+            cursor = conn.cursor()
+            layer_columns = {}
+            for layer_index in rows_by_layer:
+                layer_datum, query, padded_bounds = \
+                    queries_to_execute[layer_index]
+                layer_columns[layer_index] = _layer_columns(
+                    cursor, layer_datum, query, zoom, cache_columns)
+            query = build_batched_query(queries_to_execute, layer_columns)
+            cursor.execute(query)
+            for layer_index, geometry, json_row in cursor:
+                row = _utf8_encode(json_row)
+                row['__geometry__'] = geometry
+                rows_by_layer[layer_index].append(row)
+        except:
+            # see execute_query, the connection may be in an invalid
+            # state so close it for the pool to replace
+            try:
+                conn.close()
+            except:
+                pass
+            raise
+
+    results = []
+    for layer_index, rows in sorted(rows_by_layer.items()):
+        layer_datum, query, padded_bounds = queries_to_execute[layer_index]
+        results.append((rows, layer_datum, padded_bounds))
+    return results
+
+
+def execute_timed(fn, args):
+    """
+    Call fn with args in the thread pool, returning its result along with
+    the seconds it took.
+    """
+
+    start = time.time()
+    result = fn(*args)
+    return result, time.time() - start
+
+
 def trim_layer_datum(layer_datum):
     layer_datum_result = dict(
         [(k, v) for k, v in layer_datum.items()
@@ -121,7 +336,8 @@ def trim_layer_datum(layer_datum):
     return layer_datum_result
 
 
-def enqueue_queries(sql_conns, thread_pool, layer_data, zoom, unpadded_bounds):
+def enqueue_queries(sql_conns, thread_pool, layer_data, zoom, unpadded_bounds,
+                    itersize=None):
 
     queries_to_execute = build_feature_queries(
         unpadded_bounds, layer_data, zoom)
@@ -139,26 +355,80 @@ def enqueue_queries(sql_conns, thread_pool, layer_data, zoom, unpadded_bounds):
                 padded_bounds=padded_bounds,
             )
             empty_results.append(empty_feature_layer)
+        elif itersize:
+            async_result = thread_pool.apply_async(
+                execute_timed, (execute_streaming_query, (
+                    sql_conn, query, layer_datum, padded_bounds, itersize)))
+            async_results.append(async_result)
         else:
             async_result = thread_pool.apply_async(
-                execute_query, (sql_conn, query, layer_datum, padded_bounds))
+                execute_timed, (execute_query, (
+                    sql_conn, query, layer_datum, padded_bounds)))
             async_results.append(async_result)
 
     return empty_results, async_results
 
 
+def enqueue_batched_query(
+        sql_conn, thread_pool, layer_data, zoom, unpadded_bounds):
+
+    queries_to_execute = build_feature_queries(
+        unpadded_bounds, layer_data, zoom)
+
+    # templates which are reloaded can change the columns they select
+    cache_columns = not any(
+        isinstance(layer_datum['query_generator'], DevJinjaQueryGenerator)
+        for layer_datum in layer_data)
+
+    empty_results = []
+    batched_queries = []
+    for layer_datum, query, padded_bounds in queries_to_execute:
+        layer_datum = trim_layer_datum(layer_datum)
+        if query is None:
+            empty_feature_layer = dict(
+                name=layer_datum['name'],
+                features=[],
+                layer_datum=layer_datum,
+                padded_bounds=padded_bounds,
+            )
+            empty_results.append(empty_feature_layer)
+        else:
+            batched_queries.append((layer_datum, query, padded_bounds))
+
+    async_results = []
+    if batched_queries:
+        async_result = thread_pool.apply_async(
+            execute_timed, (execute_batched_query, (
+                sql_conn, batched_queries, zoom, cache_columns)))
+        async_results.append(async_result)
+
+    return empty_results, async_results
+
+
 class DataFetcher(object):
 
-    def __init__(self, conn_info, layer_data, io_pool, n_conn):
+    def __init__(self, conn_info, layer_data, io_pool, n_conn,
+                 sql_conn_pool=None, batch_queries=False, itersize=None,
+                 columnar=False):
         self.conn_info = dict(conn_info)
         self.layer_data = layer_data
         self.io_pool = io_pool
 
         self.dbnames = self.conn_info.pop('dbnames')
         self.dbnames_query_index = 0
-        self.sql_conn_pool = DBAffinityConnectionsNoLimit(
-            self.dbnames, self.conn_info)
-        self.n_conn = n_conn
+        if sql_conn_pool is None:
+            sql_conn_pool = DBAffinityConnectionsNoLimit(
+                self.dbnames, self.conn_info)
+        self.sql_conn_pool = sql_conn_pool
+        # when batching, all the layers are fetched with a single query
+        # and so only need a single connection.
+        self.batch_queries = batch_queries
+        self.n_conn = 1 if batch_queries else n_conn
+        # when set, each layer is fetched through a server side cursor
+        # this many rows at a time, and the rows are kept as tuples.
+        self.itersize = itersize
+        # whether to store the rows for each layer as ColumnarFeatures
+        self.columnar = columnar
 
     def __call__(self, zoom, unpadded_bounds, layer_data=None):
         if layer_data is None:
@@ -169,14 +439,23 @@ class DataFetcher(object):
             # the padded bounds are used here in order to only have to
             # issue a single set of queries to the database for all
             # formats
-            empty_results, async_results = enqueue_queries(
-                sql_conns, self.io_pool, layer_data, zoom, unpadded_bounds)
-
-            feature_layers = []
+            if self.batch_queries:
+                empty_results, async_results = enqueue_batched_query(
+                    sql_conns[0], self.io_pool, layer_data, zoom,
+                    unpadded_bounds)
+            else:
+                empty_results, async_results = enqueue_queries(
+                    sql_conns, self.io_pool, layer_data, zoom,
+                    unpadded_bounds, self.itersize)
+
+            layer_results = []
+            # seconds taken by the query for each layer. when batching,
+            # there's only the one query, so these aren't known.
+            layer_seconds = {}
             async_exception = None
             for async_result in async_results:
                 try:
-                    rows, layer_datum, padded_bounds = async_result.get()
+                    result, seconds = async_result.get()
                 except:
                     exc_type, exc_value, exc_traceback = sys.exc_info()
                     async_exception = exc_value
@@ -190,6 +469,52 @@ class DataFetcher(object):
                 if async_exception is not None:
                     continue
 
+                if self.batch_queries:
+                    layer_results.extend(result)
+                else:
+                    layer_results.append(result)
+                    layer_seconds[result[1]['name']] = seconds
+
+            # bail if an error occurred
+            if async_exception is not None:
+                raise async_exception
+
+            feature_layers = []
+            for layer_result in layer_results:
+                if len(layer_result) == 4:
+                    # streamed rows are already read, and are tuples
+                    # sharing the list of column names.
+                    rows, layer_datum, padded_bounds, columns = layer_result
+                    if self.columnar:
+                        features = ColumnarFeatures.from_tuple_rows(
+                            columns, rows)
+                        feature_layer = dict(
+                            name=layer_datum['name'], features=features,
+                            layer_datum=layer_datum,
+                            padded_bounds=padded_bounds,
+                        )
+                    else:
+                        feature_layer = dict(
+                            name=layer_datum['name'], features=rows,
+                            columns=columns,
+                            layer_datum=layer_datum,
+                            padded_bounds=padded_bounds,
+                        )
+                    feature_layers.append(feature_layer)
+                    continue
+
+                rows, layer_datum, padded_bounds = layer_result
+                if self.columnar:
+                    # buffers are read into bytes along the way
+                    features = ColumnarFeatures.from_dict_rows(rows)
+                    feature_layer = dict(
+                        name=layer_datum['name'], features=features,
+                        layer_datum=layer_datum,
+                        padded_bounds=padded_bounds,
+                    )
+                    feature_layers.append(feature_layer)
+                    continue
+
                 # read the bytes out of each row, otherwise the pickle
                 # will fail because the geometry is a read buffer
                 # only keep values that are not None
@@ -210,16 +535,13 @@ class DataFetcher(object):
                 )
                 feature_layers.append(feature_layer)
 
-            # bail if an error occurred
-            if async_exception is not None:
-                raise async_exception
-
             feature_layers.extend(empty_results)
 
             return dict(
                 feature_layers=feature_layers,
                 unpadded_bounds=unpadded_bounds,
                 padded_bounds=padded_bounds,
+                layer_seconds=layer_seconds,
             )
 
         finally:
@@ -3,22 +3,48 @@
 from boto import connect_s3
 from boto.s3.bucket import Bucket
 from builtins import range
+from collections import OrderedDict
 from future.utils import raise_from
-import md5
+from tilequeue.utils import StatsThreadPool
+import hashlib
 import os
+from tilequeue.metatile import metatile_contents_hash
 from tilequeue.metatile import metatiles_are_equal
 from tilequeue.format import zip_format
 import random
+import sys
 import threading
+import time
 
 
 def calc_hash(s):
-    m = md5.new()
+    m = hashlib.md5()
     m.update(s)
     md5_hash = m.hexdigest()
     return md5_hash[:5]
 
 
+# name of the S3 object metadata which holds the hash of the tile data
+TILE_HASH_METADATA = 'tile-hash'
+
+
+def tile_data_hash(tile_data, fmt, deterministic_metatiles=False):
+    """
+    Returns a hex digest of the tile data, such that tiles_are_equal tiles
+    have the same hash. For most formats this is the md5 of the bytes, which
+    is also what S3 uses as the ETag of an object uploaded in one part. For
+    zipped metatiles it's a hash of the files they contain, and None if the
+    metatile can't be read, unless deterministic_metatiles is set to say
+    they were made deterministic, and so can be hashed as bytes too.
+    """
+
+    if fmt and fmt == zip_format and not deterministic_metatiles:
+        return metatile_contents_hash(tile_data)
+
+    else:
+        return hashlib.md5(tile_data).hexdigest()
+
+
 def s3_tile_key(date, path, layer, coord, extension):
     prefix = '/%s' % path if path else ''
     path_to_hash = '%(prefix)s/%(layer)s/%(z)d/%(x)d/%(y)d.%(ext)s' % dict(
@@ -41,16 +67,35 @@ def s3_tile_key(date, path, layer, coord, extension):
 class S3(object):
 
     def __init__(
-            self, bucket, date_prefix, path, reduced_redundancy):
-        self.bucket = bucket
+            self, bucket, date_prefix, path, reduced_redundancy,
+            make_bucket=None):
+        self._bucket = bucket
         self.date_prefix = date_prefix
         self.path = path
         self.reduced_redundancy = reduced_redundancy
-
-    def write_tile(self, tile_data, coord, format, layer):
+        self.make_bucket = make_bucket
+        self.local = threading.local()
+
+    @property
+    def bucket(self):
+        # when given make_bucket, each thread gets a bucket with its own
+        # connection, which keeps its HTTP connections to S3 open between
+        # requests, rather than sharing one connection between threads.
+        if self.make_bucket is None:
+            return self._bucket
+        bucket = getattr(self.local, 'bucket', None)
+        if bucket is None:
+            bucket = self.local.bucket = self.make_bucket()
+        return bucket
+
+    def write_tile(self, tile_data, coord, format, layer, data_hash=None):
         key_name = s3_tile_key(
             self.date_prefix, self.path, layer, coord, format.extension)
         key = self.bucket.new_key(key_name)
+        if data_hash is None:
+            data_hash = tile_data_hash(tile_data, format)
+        if data_hash is not None:
+            key.set_metadata(TILE_HASH_METADATA, data_hash)
         key.set_contents_from_string(
             tile_data,
             headers={'Content-Type': format.mimetype},
@@ -67,6 +112,22 @@ class S3(object):
         tile_data = key.get_contents_as_string()
         return tile_data
 
+    def read_tile_hash(self, coord, format, layer):
+        key_name = s3_tile_key(
+            self.date_prefix, self.path, layer, coord, format.extension)
+        # get_key only makes a HEAD request, so this fetches the metadata
+        # without the tile data.
+        key = self.bucket.get_key(key_name)
+        if key is None:
+            return None
+        data_hash = key.get_metadata(TILE_HASH_METADATA)
+        if data_hash is None and key.etag:
+            # tiles written before the hash was stored in the metadata. the
+            # ETag is the md5 of the data, which matches the hash of all but
+            # zipped metatiles, and those will just be written again.
+            data_hash = key.etag.strip('"')
+        return data_hash
+
     def delete_tiles(self, coords, format, layer):
         key_names = [
             s3_tile_key(self.date_prefix, self.path, layer, coord, format.extension)
@@ -91,6 +152,10 @@ def make_file_path(base_path, coord, layer, extension):
     return full_path
 
 
+def make_hash_file_path(file_path):
+    return file_path + '.md5'
+
+
 def os_replace(src, dst):
     '''
     Simple emulation of function `os.replace(..)` from modern version
@@ -169,7 +234,7 @@ class TileDirectory(object):
 
         self.base_path = base_path
 
-    def write_tile(self, tile_data, coord, format, layer):
+    def write_tile(self, tile_data, coord, format, layer, data_hash=None):
         dir_path = make_dir_path(self.base_path, coord, layer)
         try:
             os.makedirs(dir_path)
@@ -178,6 +243,22 @@ class TileDirectory(object):
 
         file_path = make_file_path(self.base_path, coord, layer,
                                    format.extension)
+        hash_file_path = make_hash_file_path(file_path)
+        if data_hash is None:
+            data_hash = tile_data_hash(tile_data, format)
+
+        # the old hash is removed first, so that if we stop part way through
+        # it can't be taken as the hash of the new tile data.
+        try:
+            os.remove(hash_file_path)
+        except OSError:
+            pass
+
+        self._write_file(file_path, tile_data)
+        if data_hash is not None:
+            self._write_file(hash_file_path, data_hash)
+
+    def _write_file(self, file_path, data):
         swap_file_path = '%s.swp-%s-%s-%s' % (
             file_path,
             os.getpid(),
@@ -186,8 +267,8 @@ class TileDirectory(object):
         )
 
         try:
-            with open(swap_file_path, 'w') as tile_fp:
-                tile_fp.write(tile_data)
+            with open(swap_file_path, 'w') as fp:
+                fp.write(data)
 
             # write file as atomic operation
             os_replace(swap_file_path, file_path)
@@ -208,6 +289,21 @@ class TileDirectory(object):
         except IOError:
             return None
 
+    def read_tile_hash(self, coord, format, layer):
+        file_path = make_file_path(self.base_path, coord, layer,
+                                   format.extension)
+        try:
+            with open(make_hash_file_path(file_path), 'r') as hash_fp:
+                return hash_fp.read()
+        except IOError:
+            pass
+
+        # no hash was written alongside the tile, so hash the tile itself
+        tile_data = self.read_tile(coord, format, layer)
+        if tile_data is None:
+            return None
+        return tile_data_hash(tile_data, format)
+
     def delete_tiles(self, coords, format, layer):
         delete_count = 0
         for coord in coords:
@@ -215,6 +311,9 @@ class TileDirectory(object):
             if os.path.isfile(file_path):
                 os.remove(file_path)
                 delete_count += 1
+            hash_file_path = make_hash_file_path(file_path)
+            if os.path.isfile(hash_file_path):
+                os.remove(hash_file_path)
 
         return delete_count
 
@@ -230,7 +329,7 @@ class Memory(object):
     def __init__(self):
         self.data = None
 
-    def write_tile(self, tile_data, coord, format, layer):
+    def write_tile(self, tile_data, coord, format, layer, data_hash=None):
         self.data = tile_data, coord, format, layer
 
     def read_tile(self, coord, format, layer):
@@ -239,13 +338,22 @@ class Memory(object):
         tile_data, coord, format, layer = self.data
         return tile_data
 
+    def read_tile_hash(self, coord, format, layer):
+        if self.data is None:
+            return None
+        tile_data, coord, format, layer = self.data
+        return tile_data_hash(tile_data, format)
+
 
 def make_s3_store(bucket_name,
                   aws_access_key_id=None, aws_secret_access_key=None,
                   path='osm', reduced_redundancy=False, date_prefix=''):
-    conn = connect_s3(aws_access_key_id, aws_secret_access_key)
-    bucket = Bucket(conn, bucket_name)
-    s3_store = S3(bucket, date_prefix, path, reduced_redundancy)
+    def make_bucket():
+        conn = connect_s3(aws_access_key_id, aws_secret_access_key)
+        return Bucket(conn, bucket_name)
+
+    # each thread makes its own bucket when it first needs one
+    s3_store = S3(None, date_prefix, path, reduced_redundancy, make_bucket)
     return s3_store
 
 
@@ -264,14 +372,145 @@ def tiles_are_equal(tile_data_1, tile_data_2, fmt):
         return tile_data_1 == tile_data_2
 
 
-def write_tile_if_changed(store, tile_data, coord, format, layer):
+class WrittenTileHashes(object):
+    """
+    A least recently used cache of the hash of the data last written to each
+    tile, or found to be there already, so that tiles which are rendered
+    again without changing can be skipped without a request to the store.
+
+    It only knows about tiles written by this process, so a tile changed by
+    something else, and then rendered here as it was before, won't be
+    written again until it drops out of the cache.
+    """
+
+    def __init__(self, max_entries):
+        assert max_entries > 0
+        self.max_entries = max_entries
+        self.hashes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _key(self, coord, format, layer):
+        return (int(coord.zoom), int(coord.column), int(coord.row),
+                format.extension, layer)
+
+    def get(self, coord, format, layer):
+        key = self._key(coord, format, layer)
+        with self.lock:
+            data_hash = self.hashes.pop(key, None)
+            if data_hash is not None:
+                # move it to the most recently used end
+                self.hashes[key] = data_hash
+            return data_hash
+
+    def set(self, coord, format, layer, data_hash):
+        key = self._key(coord, format, layer)
+        with self.lock:
+            self.hashes.pop(key, None)
+            self.hashes[key] = data_hash
+            while len(self.hashes) > self.max_entries:
+                self.hashes.popitem(last=False)
+
+
+class StoreWriterPool(object):
+    """
+    Runs writes to a store on a pool of threads of its own, so that they
+    don't compete for threads with the database queries, and a burst of
+    slow writes can't hold up fetching data.
+
+    Writes which raise are retried up to max_retries times, waiting a
+    random time of up to retry_backoff_seconds, doubling after each
+    attempt, first. If max_in_flight_bytes is set, apply_async blocks
+    until the tile data for writes which haven't finished is less than
+    that, although a write is always let through if there are none.
+    """
+
+    def __init__(self, n_threads, logger, max_in_flight_bytes=None,
+                 max_retries=0, retry_backoff_seconds=1.0):
+        assert n_threads > 0
+        self.pool = StatsThreadPool(n_threads)
+        self.logger = logger
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.in_flight_bytes = 0
+        self.in_flight_cond = threading.Condition()
+        self.n_retries = 0
+
+    def apply_async(self, fn, args, n_bytes):
+        """
+        Call fn with args on the pool, returning the AsyncResult. n_bytes
+        is the size of the tile data being written.
+        """
+
+        with self.in_flight_cond:
+            if self.max_in_flight_bytes:
+                while self.in_flight_bytes > 0 and \
+                        self.in_flight_bytes + n_bytes > \
+                        self.max_in_flight_bytes:
+                    self.in_flight_cond.wait()
+            self.in_flight_bytes += n_bytes
+
+        return self.pool.apply_async(self._call, (fn, args, n_bytes))
+
+    def _call(self, fn, args, n_bytes):
+        try:
+            attempt = 0
+            while True:
+                try:
+                    return fn(*args)
+                except:
+                    if attempt >= self.max_retries:
+                        raise
+                    exc_info = sys.exc_info()
+                    with self.in_flight_cond:
+                        self.n_retries += 1
+                    self.logger.warn('Retrying store write after: %s' % (
+                        exc_info[1],))
+                    time.sleep(random.uniform(
+                        0, self.retry_backoff_seconds * (2 ** attempt)))
+                    attempt += 1
+        finally:
+            with self.in_flight_cond:
+                self.in_flight_bytes -= n_bytes
+                self.in_flight_cond.notify_all()
+
+    def get_stats(self):
+        stats = self.pool.get_stats()
+        with self.in_flight_cond:
+            stats['in_flight_bytes'] = self.in_flight_bytes
+            stats['retries'] = self.n_retries
+            self.n_retries = 0
+        return stats
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def write_tile_if_changed(store, tile_data, coord, format, layer,
+                          data_hash=None):
     """
     Only write tile data if different from existing.
 
-    Try to read the tile data from the store first. If the existing
-    data matches, don't write. Returns whether the tile was written.
+    If the store can read the hash of the existing tile, that's compared
+    with the hash of the tile data, which avoids fetching the existing
+    data. Otherwise, try to read the tile data from the store first. If
+    the existing data matches, don't write. Returns whether the tile was
+    written.
+
+    Pass data_hash if the hash of the tile data is already known.
     """
 
+    read_tile_hash = getattr(store, 'read_tile_hash', None)
+    if read_tile_hash is not None:
+        if data_hash is None:
+            data_hash = tile_data_hash(tile_data, format)
+        if data_hash is not None and \
+           read_tile_hash(coord, format, layer) == data_hash:
+            return False
+        store.write_tile(tile_data, coord, format, layer, data_hash)
+        return True
+
     existing_data = store.read_tile(coord, format, layer)
     if not existing_data or \
        not tiles_are_equal(existing_data, tile_data, format):
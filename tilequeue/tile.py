@@ -1,6 +1,7 @@
 from itertools import chain
 from ModestMaps.Core import Coordinate
 import math
+import numpy as np
 import pyproj
 
 
@@ -312,6 +313,12 @@ def bounds_buffer(bounds, buf_size):
     )
 
 
+def round_half_away_from_zero(a):
+    # numpy rounds halves to even, where python 2's round() rounds them
+    # away from zero.
+    return np.copysign(np.floor(np.abs(a) + 0.5), a)
+
+
 # radius from http://wiki.openstreetmap.org/wiki/Zoom_levels
 earth_equatorial_radius_meters = 6372798.2
 earth_equatorial_circumference_meters = 40041472.01586051
@@ -7,7 +7,9 @@ from tilequeue.format import topojson_format
 from tilequeue.format import vtm_format
 from tilequeue.tile import bounds_buffer
 from tilequeue.tile import normalize_geometry_type
+from tilequeue.tile import round_half_away_from_zero
 import math
+import numpy as np
 
 
 half_circumference_meters = 20037508.342789244
@@ -27,10 +29,10 @@ def mercator_point_to_lnglat(x, y, z=None):
 
 def rescale_point(bounds, scale):
     minx, miny, maxx, maxy = bounds
+    xfac = scale / (maxx - minx)
+    yfac = scale / (maxy - miny)
 
     def fn(x, y, z=None):
-        xfac = scale / (maxx - minx)
-        yfac = scale / (maxy - miny)
         x = xfac * (x - minx)
         y = yfac * (y - miny)
 
@@ -43,6 +45,74 @@ def apply_to_all_coords(fn):
     return lambda shape: transform(fn, shape)
 
 
+# the array versions of the point transforms take arrays of all the x and y
+# coordinates of a ring or line, and return the transformed arrays. they
+# must give the same results as the point versions above.
+
+def mercator_to_lnglat_arrays(xs, ys):
+    xs = xs / half_circumference_meters
+    ys = ys / half_circumference_meters
+
+    ys = (2 * np.arctan(np.exp(ys * math.pi)) - (math.pi / 2)) / math.pi
+
+    xs *= 180
+    ys *= 180
+
+    return xs, ys
+
+
+def rescale_arrays(bounds, scale):
+    minx, miny, maxx, maxy = bounds
+    xfac = scale / (maxx - minx)
+    yfac = scale / (maxy - miny)
+
+    def fn(xs, ys):
+        xs = round_half_away_from_zero(xfac * (xs - minx))
+        ys = round_half_away_from_zero(yfac * (ys - miny))
+        return xs, ys
+
+    return fn
+
+
+def _transform_coords_array(fn, coords):
+    coords = np.asarray(coords)
+    xs, ys = fn(coords[:, 0], coords[:, 1])
+    return np.column_stack((xs, ys))
+
+
+def transform_arrays(fn, shape):
+    """
+    Like shapely.ops.transform, but fn is called once with arrays of the x
+    and y coordinates for each ring or line in the shape, rather than once
+    per coordinate.
+    """
+
+    if shape.is_empty:
+        return shape
+
+    shape_type = shape.type
+    if shape_type == 'Point':
+        coords = _transform_coords_array(fn, shape.coords)
+        return geometry.Point(coords[0])
+    elif shape_type in ('LineString', 'LinearRing'):
+        return type(shape)(_transform_coords_array(fn, shape.coords))
+    elif shape_type == 'Polygon':
+        shell = _transform_coords_array(fn, shape.exterior.coords)
+        holes = [_transform_coords_array(fn, ring.coords)
+                 for ring in shape.interiors]
+        return geometry.Polygon(shell, holes)
+    elif shape_type.startswith('Multi') or \
+            shape_type == 'GeometryCollection':
+        return type(shape)([transform_arrays(fn, part)
+                            for part in shape.geoms])
+    else:
+        raise ValueError('Type %r not recognized' % shape_type)
+
+
+def apply_to_all_coord_arrays(fn):
+    return lambda shape: transform_arrays(fn, shape)
+
+
 # returns a geometry which is the given bounds expanded by `factor`. that is,
 # if the original shape was a 1x1 box, the new one will be `factor`x`factor`
 # box, with the same centroid as the original box.
@@ -158,14 +228,79 @@ def _clip_shape(shape, buffer_padded_bounds, is_clipped, clip_factor):
     return shape
 
 
+def _bounds_contain(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and \
+        outer[2] >= inner[2] and outer[3] >= inner[3]
+
+
+def _clip_shape_reusing(
+        shape, i, buffer_padded_bounds, is_clipped, clip_factor,
+        clipped_by_bounds):
+    """
+    Return the shape, the i'th in its layer, clipped as _clip_shape does,
+    starting from the shape already clipped to larger bounds if there is
+    one in clipped_by_bounds, which maps bounds to the shapes clipped to
+    them by their index.
+    """
+
+    for other_bounds, other_clipped_shapes in clipped_by_bounds.iteritems():
+        if other_bounds == buffer_padded_bounds or \
+           not _bounds_contain(other_bounds, buffer_padded_bounds):
+            continue
+
+        larger_shape = other_clipped_shapes.get(i, False)
+        if larger_shape is False:
+            continue
+
+        # anything outside the larger bounds is outside the smaller ones
+        if larger_shape is None or larger_shape.is_empty:
+            return None
+
+        # when the shape clipped to the larger bounds is already within the
+        # smaller ones, it's kept as it is. this also lets formats see that
+        # it's the same shape. multipolygons also lose any parts outside
+        # the buffered bounds when clipped, so are only kept when all
+        # their parts are inside. otherwise the original shape is clipped,
+        # as clipping the larger clipped shape again can lose parts which
+        # clipping split off from the rest of the shape.
+        if is_clipped:
+            layer_padded_bounds = calculate_padded_bounds(
+                clip_factor, buffer_padded_bounds)
+            shape_buf_bounds = geometry.box(*buffer_padded_bounds)
+            if larger_shape.type == 'MultiPolygon':
+                parts = larger_shape.geoms
+            else:
+                parts = [larger_shape]
+            if layer_padded_bounds.contains(larger_shape) and \
+               all(shape_buf_bounds.intersects(part) for part in parts):
+                return larger_shape
+
+        break
+
+    return _clip_shape(shape, buffer_padded_bounds, is_clipped, clip_factor)
+
+
 def transform_feature_layers_shape(
         feature_layers, format, scale, unpadded_bounds,
-        meters_per_pixel_dim, buffer_cfg):
+        meters_per_pixel_dim, buffer_cfg, clip_cache=None):
+    """
+    Clip and transform the shapes in the feature layers for the format.
+
+    When transforming the same feature layers for several formats, a dict
+    can be passed as clip_cache to share the clipped shapes between them.
+    Clipping only depends on the layer, geometry type, buffered bounds and
+    clip factor, so formats which agree on those reuse the clip result,
+    and only the format specific coordinate transform is run for each.
+    Formats with smaller buffered bounds than one already transformed,
+    such as mvt after mvtb, reuse the shapes clipped to the larger bounds
+    where those are already within the smaller bounds.
+    """
+
     if format in (json_format, topojson_format):
-        transform_fn = apply_to_all_coords(mercator_point_to_lnglat)
+        transform_fn = apply_to_all_coord_arrays(mercator_to_lnglat_arrays)
     elif format == vtm_format:
-        transform_fn = apply_to_all_coords(
-            rescale_point(unpadded_bounds, scale))
+        transform_fn = apply_to_all_coord_arrays(
+            rescale_arrays(unpadded_bounds, scale))
     else:
         # mvt and unknown formats get no geometry transformation
         transform_fn = _noop
@@ -180,7 +315,8 @@ def transform_feature_layers_shape(
         is_clipped = layer_datum['is_clipped']
         clip_factor = layer_datum.get('clip_factor', 1.0)
 
-        for shape, props, feature_id in feature_layer['features']:
+        for i, (shape, props, feature_id) in enumerate(
+                feature_layer['features']):
 
             if shape.is_empty or shape.type == 'GeometryCollection':
                 continue
@@ -189,8 +325,28 @@ def transform_feature_layers_shape(
                 format, unpadded_bounds, meters_per_pixel_dim, layer_name,
                 shape.type, buffer_cfg)
 
-            shape = _clip_shape(
-                shape, buffer_padded_bounds, is_clipped, clip_factor)
+            if clip_cache is None:
+                shape = _clip_shape(
+                    shape, buffer_padded_bounds, is_clipped, clip_factor)
+            else:
+                clip_key = (layer_name, shape.type, clip_factor)
+                clipped_by_bounds = clip_cache.get(clip_key)
+                if clipped_by_bounds is None:
+                    clipped_by_bounds = clip_cache[clip_key] = {}
+                clipped_shapes = clipped_by_bounds.get(buffer_padded_bounds)
+                if clipped_shapes is None:
+                    clipped_shapes = \
+                        clipped_by_bounds[buffer_padded_bounds] = {}
+                # None is a valid clip result, for shapes outside the
+                # bounds, so the absence of a result is marked with False.
+                clipped_shape = clipped_shapes.get(i, False)
+                if clipped_shape is False:
+                    clipped_shape = _clip_shape_reusing(
+                        shape, i, buffer_padded_bounds, is_clipped,
+                        clip_factor, clipped_by_bounds)
+                    clipped_shapes[i] = clipped_shape
+                shape = clipped_shape
+
             if shape is None or shape.is_empty:
                 continue
 
@@ -0,0 +1,155 @@
+from tilequeue.columnar import ColumnarFeatures
+import cPickle as pickle
+import mmap
+import os
+import os.path
+import struct
+import tempfile
+
+
+# the header is the length of the pickled layer data, which follows the
+# geometry arena.
+_header = struct.Struct('<Q')
+
+
+def default_transport_path():
+    # prefer a memory backed filesystem, so that the "files" never need to
+    # touch the disk.
+    shm_path = '/dev/shm'
+    if os.path.isdir(shm_path):
+        return shm_path
+    return tempfile.gettempdir()
+
+
+class MmapFeatureLayersTransport(object):
+    """
+    Hands off feature layers between the fetch threads and the processor
+    processes through a memory mapped file, so that only a small handle
+    needs to be sent over the multiprocessing queue.
+
+    The WKB for each row is written once, contiguously, into the file and
+    read back as slices of the mapping, so geometries are never pickled.
+    The rest of each row and the layer metadata are small in comparison,
+    and are pickled into the tail of the same file.
+    """
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+
+    def write(self, feature_layers):
+        fd, path = tempfile.mkstemp(
+            prefix='tilequeue-', suffix='.layers', dir=self.dir_path)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(_header.pack(0))
+                offset = _header.size
+
+                layers = []
+                for feature_layer in feature_layers:
+                    features = feature_layer['features']
+                    if isinstance(features, ColumnarFeatures):
+                        # the WKB is already in a single buffer
+                        fp.write(features.wkb)
+                        geometry_refs = (offset, len(features.wkb))
+                        offset += len(features.wkb)
+                        layer = dict(feature_layer)
+                        layer['features'] = ColumnarFeatures(
+                            features.ids, '', features.offsets,
+                            features.properties)
+                        layers.append((layer, geometry_refs))
+                        continue
+
+                    rows = []
+                    geometry_refs = []
+                    columns = feature_layer.get('columns')
+                    if columns is not None:
+                        geometry_index = columns.index('__geometry__')
+
+                    for row in feature_layer['features']:
+                        if columns is None:
+                            row = dict(row)
+                            wkb = row.pop('__geometry__')
+                        else:
+                            row = list(row)
+                            wkb = row[geometry_index]
+                            row[geometry_index] = None
+                        fp.write(wkb)
+                        geometry_refs.append((offset, len(wkb)))
+                        offset += len(wkb)
+                        rows.append(row)
+
+                    layer = dict(feature_layer)
+                    layer['features'] = rows
+                    layers.append((layer, geometry_refs))
+
+                pickle.dump(layers, fp, pickle.HIGHEST_PROTOCOL)
+                fp.seek(0)
+                fp.write(_header.pack(offset))
+
+        except:
+            os.remove(path)
+            raise
+
+        return path
+
+    def read(self, handle):
+        """
+        Read the feature layers back from the handle, and remove the file
+        backing it.
+        """
+
+        path = handle
+        try:
+            with open(path, 'rb') as fp:
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                pickle_offset, = _header.unpack(mm[:_header.size])
+                layers = pickle.loads(mm[pickle_offset:])
+
+                feature_layers = []
+                for layer, geometry_refs in layers:
+                    features = layer['features']
+                    if isinstance(features, ColumnarFeatures):
+                        offset, length = geometry_refs
+                        features.wkb = mm[offset:offset + length]
+                        feature_layers.append(layer)
+                        continue
+
+                    columns = layer.get('columns')
+                    if columns is not None:
+                        geometry_index = columns.index('__geometry__')
+
+                    rows = layer['features']
+                    for i, (offset, length) in enumerate(geometry_refs):
+                        wkb = mm[offset:offset + length]
+                        if columns is None:
+                            rows[i]['__geometry__'] = wkb
+                        else:
+                            row = rows[i]
+                            row[geometry_index] = wkb
+                            rows[i] = tuple(row)
+                    feature_layers.append(layer)
+
+            finally:
+                mm.close()
+        finally:
+            self.discard(handle)
+
+        return feature_layers
+
+    def discard(self, handle):
+        try:
+            os.remove(handle)
+        except OSError:
+            pass
+
+
+def make_feature_layers_transport(transport_type, path=None):
+    if transport_type in (None, 'queue'):
+        return None
+    elif transport_type == 'mmap':
+        return MmapFeatureLayersTransport(path or default_transport_path())
+    else:
+        raise ValueError(
+            'Unrecognized feature layers transport type: `{}`'.format(
+                transport_type))
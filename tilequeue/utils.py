@@ -1,8 +1,11 @@
 import sys
+import threading
+import time
 import traceback
 import re
 from itertools import islice
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from tilequeue.tile import coord_marshall_int
 from tilequeue.tile import create_coord
 
@@ -18,6 +21,78 @@ def format_stacktrace_one_line(exc_info=None):
     return stacktrace
 
 
+class StatsThreadPool(ThreadPool):
+    """
+    ThreadPool which counts the jobs given to apply_async that are waiting
+    for a thread and running, and how busy its threads have been, for
+    get_stats.
+    """
+
+    def __init__(self, processes):
+        ThreadPool.__init__(self, processes)
+        self.n_threads = processes
+        self.stats_lock = threading.Lock()
+        self.n_queued = 0
+        self.n_active = 0
+        self.n_done = 0
+        # seconds spent on jobs which have finished, and the sum of the
+        # start times of those still running.
+        self.done_seconds = 0.0
+        self.active_start_sum = 0.0
+        self.last_stats_time = time.time()
+        self.last_busy_seconds = 0.0
+
+    def apply_async(self, func, args=(), kwds={}, callback=None):
+        with self.stats_lock:
+            self.n_queued += 1
+        return ThreadPool.apply_async(
+            self, self._run, (func, args, kwds), callback=callback)
+
+    def _run(self, func, args, kwds):
+        start = time.time()
+        with self.stats_lock:
+            self.n_queued -= 1
+            self.n_active += 1
+            self.active_start_sum += start
+        try:
+            return func(*args, **kwds)
+        finally:
+            end = time.time()
+            with self.stats_lock:
+                self.n_active -= 1
+                self.n_done += 1
+                self.active_start_sum -= start
+                self.done_seconds += end - start
+
+    def get_stats(self):
+        """
+        Returns the number of jobs queued and running now, and the number
+        finished and fraction of the threads' time spent running jobs
+        since the last call.
+        """
+
+        now = time.time()
+        with self.stats_lock:
+            busy_seconds = self.done_seconds + \
+                self.n_active * now - self.active_start_sum
+            elapsed = now - self.last_stats_time
+            utilisation = 0.0
+            if elapsed > 0:
+                utilisation = (busy_seconds - self.last_busy_seconds) / \
+                    (elapsed * self.n_threads)
+            stats = dict(
+                threads=self.n_threads,
+                queued=self.n_queued,
+                active=self.n_active,
+                done=self.n_done,
+                utilisation=utilisation,
+            )
+            self.n_done = 0
+            self.last_stats_time = now
+            self.last_busy_seconds = busy_seconds
+        return stats
+
+
 def grouper(iterable, n):
     """Yield n-length chunks of the iterable"""
     it = iter(iterable)
@@ -1,6 +1,7 @@
 from operator import attrgetter
 from psycopg2.extensions import TransactionRollbackError
 from tilequeue.process import process_coord
+from tilequeue.store import tile_data_hash
 from tilequeue.store import write_tile_if_changed
 from tilequeue.tile import coord_children_range
 from tilequeue.tile import coord_to_mercator_bounds
@@ -8,9 +9,11 @@ from tilequeue.tile import serialize_coord
 from tilequeue.utils import format_stacktrace_one_line
 from tilequeue.metatile import make_metatiles
 import logging
+import math
 import Queue
 import signal
 import sys
+import threading
 import time
 
 
@@ -43,9 +46,10 @@ def _force_empty_queue(q):
 # so that we can simultaneously check for the "stop" signal when it's time
 # to shut down.
 class OutputQueue(object):
-    def __init__(self, output_queue, stop):
+    def __init__(self, output_queue, stop, logger):
         self.output_queue = output_queue
         self.stop = stop
+        self.logger = logger
 
     def __call__(self, coord, data):
         """
@@ -95,7 +99,7 @@ class SqsQueueReader(object):
             self, sqs_queue, output_queue, logger, stop, max_zoom,
             sqs_msgs_to_read_size=10):
         self.sqs_queue = sqs_queue
-        self.output = OutputQueue(output_queue, stop)
+        self.output = OutputQueue(output_queue, stop, logger)
         self.sqs_msgs_to_read_size = sqs_msgs_to_read_size
         self.logger = logger
         self.stop = stop
@@ -140,6 +144,9 @@ class SqsQueueReader(object):
                         process_seconds=None,
                         s3_seconds=None,
                         ack_seconds=None,
+                        layer_fetch_seconds=None,
+                        post_process_seconds=None,
+                        encode_seconds=None,
                     ),
                     coord_message=msg,
                 )
@@ -158,7 +165,8 @@ class DataFetch(object):
 
     def __init__(
             self, fetcher, input_queue, output_queue, io_pool,
-            logger, metatile_zoom, max_zoom):
+            logger, metatile_zoom, max_zoom, transport=None, limit=None,
+            memory_budget=None):
         self.fetcher = fetcher
         self.input_queue = input_queue
         self.output_queue = output_queue
@@ -166,12 +174,22 @@ class DataFetch(object):
         self.logger = logger
         self.metatile_zoom = metatile_zoom
         self.max_zoom = max_zoom
+        # optional transport for the feature layers, which sends a handle
+        # to them over the output queue instead of the layers themselves
+        self.transport = transport
+        # optional StageLimit on how many of the threads fetch at once
+        self.limit = limit
+        # optional MemoryBudget to admit each metatile to before fetching
+        self.memory_budget = memory_budget
 
     def __call__(self, stop):
         saw_sentinel = False
-        output = OutputQueue(self.output_queue, stop)
+        output = OutputQueue(self.output_queue, stop, self.logger)
+        slot = self.limit.take_slot() if self.limit else None
 
         while not stop.is_set():
+            if self.limit and not self.limit.wait_for_turn(slot, stop):
+                continue
             try:
                 data = self.input_queue.get(timeout=timeout_seconds)
             except Queue.Empty:
@@ -183,6 +201,13 @@ class DataFetch(object):
             coord = data['coord']
             nominal_zoom = coord.zoom + self.metatile_zoom
             unpadded_bounds = coord_to_mercator_bounds(coord)
+            metadata = data['metadata']
+
+            if self.memory_budget:
+                reservation = self.memory_budget.reserve(nominal_zoom, stop)
+                if reservation is None:
+                    break
+                metadata['memory_reservation'] = reservation
 
             start = time.time()
 
@@ -198,10 +223,12 @@ class DataFetch(object):
                     log_level = logging.ERROR
                 self.logger.log(log_level, 'Error fetching: %s - %s' % (
                     serialize_coord(coord), stacktrace))
+                self._release(metadata)
                 continue
 
-            metadata = data['metadata']
             metadata['timing']['fetch_seconds'] = time.time() - start
+            metadata['timing']['layer_fetch_seconds'] = \
+                fetch_data.get('layer_seconds')
 
             # every tile job that we get from the queue is a "parent" tile
             # and its four children to cut from it. at zoom 15, this may
@@ -214,26 +241,47 @@ class DataFetch(object):
             data = dict(
                 metadata=metadata,
                 coord=coord,
-                feature_layers=fetch_data['feature_layers'],
                 unpadded_bounds=fetch_data['unpadded_bounds'],
                 cut_coords=cut_coords,
                 nominal_zoom=nominal_zoom,
             )
 
+            feature_layers = fetch_data['feature_layers']
+            if self.transport is None:
+                data['feature_layers'] = feature_layers
+            else:
+                try:
+                    data['feature_layers_handle'] = \
+                        self.transport.write(feature_layers)
+                except:
+                    stacktrace = format_stacktrace_one_line()
+                    self.logger.error('Error writing layers: %s - %s' % (
+                        serialize_coord(coord), stacktrace))
+                    self._release(metadata)
+                    continue
+
             if output(coord, data):
+                if self.transport is not None:
+                    self.transport.discard(data['feature_layers_handle'])
                 break
 
         if not saw_sentinel:
             _force_empty_queue(self.input_queue)
         self.logger.debug('data fetch stopped')
 
+    def _release(self, metadata):
+        reservation = metadata.pop('memory_reservation', None)
+        if reservation:
+            self.memory_budget.release(reservation)
+
 
 class ProcessAndFormatData(object):
 
     scale = 4096
 
     def __init__(self, post_process_data, formats, input_queue,
-                 output_queue, buffer_cfg, logger):
+                 output_queue, buffer_cfg, logger, transport=None,
+                 cut_processes=None, cut_processes_min_coords=0):
         formats.sort(key=attrgetter('sort_key'))
         self.post_process_data = post_process_data
         self.formats = formats
@@ -241,12 +289,15 @@ class ProcessAndFormatData(object):
         self.output_queue = output_queue
         self.buffer_cfg = buffer_cfg
         self.logger = logger
+        self.transport = transport
+        self.cut_processes = cut_processes
+        self.cut_processes_min_coords = cut_processes_min_coords
 
     def __call__(self, stop):
         # ignore ctrl-c interrupts when run from terminal
         signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-        output = OutputQueue(self.output_queue, stop)
+        output = OutputQueue(self.output_queue, stop, self.logger)
 
         saw_sentinel = False
         while not stop.is_set():
@@ -259,28 +310,57 @@ class ProcessAndFormatData(object):
                 break
 
             coord = data['coord']
-            feature_layers = data['feature_layers']
             unpadded_bounds = data['unpadded_bounds']
             cut_coords = data['cut_coords']
             nominal_zoom = data['nominal_zoom']
 
             start = time.time()
+            step_seconds = {}
 
             try:
+                feature_layers = data.get('feature_layers')
+                if feature_layers is None:
+                    feature_layers = self.transport.read(
+                        data['feature_layers_handle'])
+
                 formatted_tiles, extra_data = process_coord(
                     coord, nominal_zoom, feature_layers,
                     self.post_process_data, self.formats, unpadded_bounds,
-                    cut_coords, self.buffer_cfg)
+                    cut_coords, self.buffer_cfg, self.scale,
+                    self.cut_processes, self.cut_processes_min_coords,
+                    step_seconds)
             except:
                 stacktrace = format_stacktrace_one_line()
                 self.logger.error('Error processing: %s - %s' % (
                     serialize_coord(coord), stacktrace))
+                # pass the failure on, without any tiles, so that the
+                # storage can release anything held for the metatile.
+                failed = dict(
+                    metadata=data['metadata'],
+                    coord=coord,
+                    formatted_tiles=None,
+                )
+                if output(coord, failed):
+                    break
                 continue
 
             metadata = data['metadata']
             metadata['timing']['process_seconds'] = time.time() - start
+            metadata['timing']['post_process_seconds'] = step_seconds
             metadata['layers'] = extra_data
 
+            # the encoding time and size of the tiles in each format
+            encode_seconds = {}
+            format_bytes = {}
+            for tile in formatted_tiles:
+                ext = tile['format'].extension
+                encode_seconds[ext] = encode_seconds.get(ext, 0) + \
+                    tile['encode_seconds']
+                format_bytes[ext] = format_bytes.get(ext, 0) + \
+                    len(tile['tile'])
+            metadata['timing']['encode_seconds'] = encode_seconds
+            metadata['format_bytes'] = format_bytes
+
             data = dict(
                 metadata=metadata,
                 coord=coord,
@@ -297,21 +377,34 @@ class ProcessAndFormatData(object):
 
 class S3Storage(object):
 
-    def __init__(self, input_queue, output_queue, io_pool, store, logger,
-                 metatile_size):
+    def __init__(self, input_queue, output_queue, writer_pool, store, logger,
+                 metatile_size, written_hashes=None,
+                 deterministic_metatiles=False, metatile_format=None,
+                 compress_metatiles=False, limit=None, memory_budget=None):
         self.input_queue = input_queue
         self.output_queue = output_queue
-        self.io_pool = io_pool
+        self.writer_pool = writer_pool
         self.store = store
         self.logger = logger
         self.metatile_size = metatile_size
+        self.written_hashes = written_hashes
+        self.deterministic_metatiles = deterministic_metatiles
+        self.metatile_format = metatile_format
+        self.compress_metatiles = compress_metatiles
+        # optional StageLimit on how many of the threads store at once
+        self.limit = limit
+        # optional MemoryBudget which the metatiles were admitted to
+        self.memory_budget = memory_budget
 
     def __call__(self, stop):
         saw_sentinel = False
 
-        queue_output = OutputQueue(self.output_queue, stop)
+        queue_output = OutputQueue(self.output_queue, stop, self.logger)
+        slot = self.limit.take_slot() if self.limit else None
 
         while not stop.is_set():
+            if self.limit and not self.limit.wait_for_turn(slot, stop):
+                continue
             try:
                 data = self.input_queue.get(timeout=timeout_seconds)
             except Queue.Empty:
@@ -321,10 +414,17 @@ class S3Storage(object):
                 break
 
             coord = data['coord']
+            metadata = data['metadata']
+
+            if data['formatted_tiles'] is None:
+                # the processor failed, and has already logged why
+                self._release(metadata)
+                continue
 
             start = time.time()
             try:
-                async_jobs = self.save_tiles(data['formatted_tiles'])
+                async_jobs, n_cached = self.save_tiles(
+                    data['formatted_tiles'])
 
             except:
                 # cannot propagate this error - it crashes the thread and
@@ -332,11 +432,12 @@ class S3Storage(object):
                 stacktrace = format_stacktrace_one_line(sys.exc_info())
                 self.logger.error('Error saving tiles: %s - %s' % (
                     serialize_coord(coord), stacktrace))
+                self._release(metadata)
                 continue
 
             async_exc_info = None
             n_stored = 0
-            n_not_stored = 0
+            n_not_stored = n_cached
             for async_job in async_jobs:
                 try:
                     did_store = async_job.get()
@@ -351,17 +452,20 @@ class S3Storage(object):
                     # different exceptions when uploading to s3
                     async_exc_info = sys.exc_info()
 
+            # the tiles are no longer held, whether they were stored or not
+            self._release(metadata)
+
             if async_exc_info:
                 stacktrace = format_stacktrace_one_line(async_exc_info)
                 self.logger.error('Error storing: %s - %s' % (
                     serialize_coord(coord), stacktrace))
                 continue
 
-            metadata = data['metadata']
             metadata['timing']['s3_seconds'] = time.time() - start
             metadata['store'] = dict(
                 stored=n_stored,
                 not_stored=n_not_stored,
+                cached=n_cached,
             )
 
             data = dict(
@@ -376,37 +480,77 @@ class S3Storage(object):
             _force_empty_queue(self.input_queue)
         self.logger.debug('s3 storage stopped')
 
+    def _release(self, metadata):
+        reservation = metadata.pop('memory_reservation', None)
+        if reservation:
+            # the size of the features is only known after processing
+            n_bytes = None
+            layers = metadata.get('layers')
+            if layers:
+                n_bytes = sum(layers['size'].values())
+            self.memory_budget.release(reservation, n_bytes)
+
     def save_tiles(self, tiles):
+        """
+        Start writing the tiles which have changed, returning the async
+        jobs writing them, and the number of tiles which the written
+        hashes cache showed were unchanged, and so weren't written.
+        """
+
         async_jobs = []
+        n_cached = 0
 
         if self.metatile_size:
-            tiles = make_metatiles(self.metatile_size, tiles)
+            tiles = make_metatiles(
+                self.metatile_size, tiles,
+                deterministic=self.deterministic_metatiles,
+                metatile_format=self.metatile_format,
+                compress=self.compress_metatiles)
 
         for tile in tiles:
+            # important to use the coord from the formatted tile here,
+            # because we could have cut children tiles that have separate
+            # zooms too
+            coord = tile['coord']
+            fmt = tile['format']
+            layer = tile['layer']
+
+            data_hash = tile_data_hash(
+                tile['tile'], fmt, self.deterministic_metatiles)
+            if self.written_hashes is not None and data_hash is not None and \
+               self.written_hashes.get(coord, fmt, layer) == data_hash:
+                n_cached += 1
+                continue
 
-            async_result = self.io_pool.apply_async(
-                write_tile_if_changed, (
-                    self.store,
-                    tile['tile'],
-                    # important to use the coord from the
-                    # formatted tile here, because we could have
-                    # cut children tiles that have separate zooms
-                    # too
-                    tile['coord'],
-                    tile['format'],
-                    tile['layer']))
+            async_result = self.writer_pool.apply_async(
+                self._write_tile_if_changed, (
+                    tile['tile'], coord, fmt, layer, data_hash),
+                len(tile['tile']))
             async_jobs.append(async_result)
 
-        return async_jobs
+        return async_jobs, n_cached
+
+    def _write_tile_if_changed(self, tile_data, coord, fmt, layer, data_hash):
+        did_write = write_tile_if_changed(
+            self.store, tile_data, coord, fmt, layer, data_hash)
+        # either way, the store now has this data for the tile
+        if self.written_hashes is not None and data_hash is not None:
+            self.written_hashes.set(coord, fmt, layer, data_hash)
+        return did_write
 
 
 class SqsQueueWriter(object):
 
-    def __init__(self, sqs_queue, input_queue, logger, stop):
+    def __init__(self, sqs_queue, input_queue, logger, stop,
+                 controller=None, stats=None):
         self.sqs_queue = sqs_queue
         self.input_queue = input_queue
         self.logger = logger
         self.stop = stop
+        # optional PipelineController to tell the timings of each tile
+        self.controller = controller
+        # optional statsd client to send the timings of each tile to
+        self.stats = stats
 
     def __call__(self):
         saw_sentinel = False
@@ -436,6 +580,9 @@ class SqsQueueWriter(object):
             now = time.time()
             timing['ack_seconds'] = now - start
 
+            if self.controller:
+                self.controller.observe(timing)
+
             coord_message = metadata['coord_message']
             msg_metadata = coord_message.metadata
             time_in_queue = 0
@@ -472,18 +619,72 @@ class SqsQueueWriter(object):
                     store_info['not_stored'],
                 ))
 
+            if self.stats:
+                try:
+                    self._send_stats(metadata, time_in_queue)
+                except:
+                    stacktrace = format_stacktrace_one_line()
+                    self.logger.error('Error sending stats: %s - %s' % (
+                        serialize_coord(coord), stacktrace))
+
         if not saw_sentinel:
             _force_empty_queue(self.input_queue)
         self.logger.debug('sqs queue writer stopped')
 
+    def _send_stats(self, metadata, time_in_queue):
+        # statsd timers are in milliseconds, and give the distribution of
+        # the values as well as their counts, so the sizes of the tiles
+        # are sent as timers too.
+        timing = metadata['timing']
+        pipe = self.stats.pipeline()
+        for key, name in (('fetch_seconds', 'fetch'),
+                          ('process_seconds', 'process'),
+                          ('s3_seconds', 's3'),
+                          ('ack_seconds', 'ack')):
+            pipe.timing('process.%s' % name, timing[key] * 1000)
+        pipe.timing('process.sqs', time_in_queue * 1000)
+
+        for prefix, values in (
+                ('process.fetch.layer', timing['layer_fetch_seconds']),
+                ('process.post-process', timing['post_process_seconds']),
+                ('process.encode', timing['encode_seconds'])):
+            for name, seconds in (values or {}).iteritems():
+                pipe.timing('%s.%s' % (prefix, _stat_name(name)),
+                            seconds * 1000)
+        for ext, n_bytes in metadata['format_bytes'].iteritems():
+            pipe.timing('process.encode.%s.bytes' % ext, n_bytes)
+
+        store_info = metadata['store']
+        pipe.incr('process.stored', store_info['stored'])
+        pipe.incr('process.not-stored', store_info['not_stored'])
+        pipe.send()
+
+
+def _format_stat(value):
+    if isinstance(value, float):
+        return '%.2f' % value
+    return value
+
+
+def _stat_name(name):
+    # dots separate the parts of statsd names, so the ones in post-process
+    # function names would each make a level of their own.
+    return name.replace('.', '_')
+
 
 class QueuePrint(object):
 
-    def __init__(self, interval_seconds, queue_info, logger, stop):
+    def __init__(self, interval_seconds, queue_info, logger, stop,
+                 pool_info=(), stats=None):
         self.interval_seconds = interval_seconds
         self.queue_info = queue_info
         self.logger = logger
         self.stop = stop
+        # sequence of (pool, name) for anything with a get_stats method,
+        # such as the sql connection pool
+        self.pool_info = pool_info
+        # optional statsd client to send the sizes as gauges to as well
+        self.stats = stats
 
     def __call__(self):
         # sleep in smaller increments, so that when we're asked to
@@ -501,15 +702,251 @@ class QueuePrint(object):
             if self.stop.is_set():
                 break
 
+            gauges = {}
             self.logger.info('')
             for queue, queue_name in self.queue_info:
+                queue_size = queue.qsize()
+                gauges['process.queue.%s' % queue_name] = queue_size
                 self.logger.info(
                     '%s %d %s%s' % (
                         queue_name,
-                        queue.qsize(),
+                        queue_size,
                         'empty ' if queue.empty() else '',
                         'full' if queue.full() else '',
                     ))
+            for pool, pool_name in self.pool_info:
+                pool_stats = pool.get_stats()
+                for k, v in pool_stats.iteritems():
+                    if isinstance(v, (int, long, float)):
+                        gauges['process.%s.%s' % (pool_name, k)] = v
+                self.logger.info(
+                    '%s %s' % (
+                        pool_name,
+                        ' '.join('%s(%s)' % (k, _format_stat(pool_stats[k]))
+                                 for k in sorted(pool_stats)),
+                    ))
             self.logger.info('')
 
+            if self.stats:
+                pipe = self.stats.pipeline()
+                for name, value in gauges.iteritems():
+                    pipe.gauge(name, value)
+                pipe.send()
+
         self.logger.debug('queue printer stopped')
+
+
+class StageLimit(object):
+    """
+    Limit on how many of the threads running a stage of the pipeline take
+    work from its input queue, which can be changed while they run. Each
+    thread takes a slot when it starts, and those with a slot at or above
+    the limit wait for their turn before taking any more work.
+    """
+
+    def __init__(self, limit, max_limit):
+        assert 1 <= limit <= max_limit
+        self.limit = limit
+        self.max_limit = max_limit
+        self.n_slots = 0
+        self.cond = threading.Condition()
+
+    def take_slot(self):
+        with self.cond:
+            slot = self.n_slots
+            self.n_slots += 1
+            return slot
+
+    def wait_for_turn(self, slot, stop):
+        """
+        Wait until the slot is below the limit, returning True, or until
+        stop is set, returning False.
+        """
+
+        with self.cond:
+            while slot >= self.limit:
+                if stop.is_set():
+                    return False
+                self.cond.wait(timeout_seconds)
+            return True
+
+    def set_limit(self, limit):
+        with self.cond:
+            self.limit = max(1, min(limit, self.max_limit))
+            self.cond.notify_all()
+            return self.limit
+
+
+def _queue_depth(q):
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        # multiprocessing queues don't support this on some platforms
+        return None
+
+
+class PipelineController(object):
+    """
+    Adjusts the number of threads fetching data and storing tiles while
+    the pipeline runs, to keep the processors busy without fetching or
+    formatting more than they, or the storage, can keep up with.
+
+    The number of threads each stage needs to keep up with the processors
+    is estimated from moving averages of the timings of the tiles, and is
+    then corrected by the depths of the queues around the processors:
+
+      * when the processors' input queue is empty, they're waiting for
+        data, so more fetching threads are let loose.
+      * when it's full, the fetched data would only wait in memory, so
+        fewer threads fetch.
+      * when the processors' output queue is full, they're waiting for
+        the storage, so more threads store tiles.
+
+    Each stage's limit moves by at most one thread each interval.
+    """
+
+    # weight of each new timing in the moving averages
+    smoothing = 0.1
+
+    def __init__(self, fetch_limit, store_limit, fetch_queue,
+                 fetch_queue_size, store_queue, store_queue_size,
+                 n_processors, interval_seconds, logger, stop):
+        self.fetch_limit = fetch_limit
+        self.store_limit = store_limit
+        self.fetch_queue = fetch_queue
+        self.fetch_queue_size = fetch_queue_size
+        self.store_queue = store_queue
+        self.store_queue_size = store_queue_size
+        self.n_processors = n_processors
+        self.interval_seconds = interval_seconds
+        self.logger = logger
+        self.stop = stop
+        self.lock = threading.Lock()
+        self.mean_seconds = {}
+
+    def observe(self, timing):
+        with self.lock:
+            for key in ('fetch_seconds', 'process_seconds', 's3_seconds'):
+                seconds = timing.get(key)
+                if seconds is None:
+                    continue
+                mean = self.mean_seconds.get(key)
+                if mean is None:
+                    self.mean_seconds[key] = seconds
+                else:
+                    self.mean_seconds[key] = \
+                        mean + self.smoothing * (seconds - mean)
+
+    def _needed(self, key):
+        # number of threads running the stage needed to keep up with the
+        # processors, or None if we haven't seen enough timings yet.
+        with self.lock:
+            stage_seconds = self.mean_seconds.get(key)
+            process_seconds = self.mean_seconds.get('process_seconds')
+        if not stage_seconds or not process_seconds:
+            return None
+        return int(math.ceil(
+            self.n_processors * stage_seconds / process_seconds))
+
+    def _step(self, limit, target, name):
+        current = limit.limit
+        if target is None or target == current:
+            return
+        step = 1 if target > current else -1
+        new = limit.set_limit(current + step)
+        if new != current:
+            self.logger.info('%s threads %d -> %d' % (name, current, new))
+
+    def adjust(self):
+        fetch_target = self._needed('fetch_seconds')
+        n_fetch = self.fetch_limit.limit
+        depth = _queue_depth(self.fetch_queue)
+        if depth == 0:
+            fetch_target = max(fetch_target or 0, n_fetch + 1)
+        elif depth is not None and depth >= self.fetch_queue_size:
+            fetch_target = min(fetch_target or n_fetch, n_fetch - 1)
+        self._step(self.fetch_limit, fetch_target, 'fetch')
+
+        store_target = self._needed('s3_seconds')
+        n_store = self.store_limit.limit
+        depth = _queue_depth(self.store_queue)
+        if depth is not None and depth >= self.store_queue_size:
+            store_target = max(store_target or 0, n_store + 1)
+        self._step(self.store_limit, store_target, 'store')
+
+    def __call__(self):
+        while not self.stop.wait(self.interval_seconds):
+            try:
+                self.adjust()
+            except:
+                stacktrace = format_stacktrace_one_line()
+                self.logger.error(
+                    'Error adjusting pipeline: %s' % stacktrace)
+
+        self.logger.debug('pipeline controller stopped')
+
+
+class MemoryBudget(object):
+    """
+    Admits metatiles to the pipeline while the memory reserved for those
+    already in it is within a budget.
+
+    The size of a metatile's features is only known once it has been
+    processed, as the size(...) logged for each metatile. So each is
+    admitted with an estimate for its zoom, which is a moving average of
+    the sizes seen at that zoom, starting from initial_estimate_bytes.
+    One metatile is always admitted when none are in the pipeline, however
+    large the estimate.
+    """
+
+    # weight of each new size in the moving averages
+    smoothing = 0.2
+
+    def __init__(self, budget_bytes, initial_estimate_bytes):
+        assert budget_bytes > 0
+        self.budget_bytes = budget_bytes
+        self.initial_estimate_bytes = initial_estimate_bytes
+        self.reserved_bytes = 0
+        self.estimates = {}
+        self.cond = threading.Condition()
+
+    def reserve(self, zoom, stop):
+        """
+        Wait until there's room in the budget for a metatile at the zoom,
+        and return the reservation for it, or None if stop is set first.
+        """
+
+        with self.cond:
+            n_bytes = self.estimates.get(zoom, self.initial_estimate_bytes)
+            while self.reserved_bytes > 0 and \
+                    self.reserved_bytes + n_bytes > self.budget_bytes:
+                if stop.is_set():
+                    return None
+                self.cond.wait(timeout_seconds)
+            self.reserved_bytes += n_bytes
+            return zoom, n_bytes
+
+    def release(self, reservation, actual_bytes=None):
+        """
+        Release the reservation, when the metatile is out of the pipeline.
+        Pass the size found for it, if any, to improve the estimates.
+        """
+
+        zoom, n_bytes = reservation
+        with self.cond:
+            self.reserved_bytes -= n_bytes
+            if actual_bytes is not None:
+                estimate = self.estimates.get(zoom)
+                if estimate is None:
+                    estimate = actual_bytes
+                else:
+                    estimate += self.smoothing * (actual_bytes - estimate)
+                self.estimates[zoom] = int(estimate)
+            self.cond.notify_all()
+
+    def get_stats(self):
+        with self.cond:
+            return dict(
+                budget_bytes=self.budget_bytes,
+                reserved_bytes=self.reserved_bytes,
+            )